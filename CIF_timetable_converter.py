@@ -2,15 +2,19 @@
 CIF_timetable_converter.py
 
 Analyze raw .cif files and convert them into .csv timetables proper. The only parameter
-to adjust is the path to .cif file folder below and the output folder.
+to adjust is the path to .cif file folder below and the output folder. To run without editing
+the source use: python cif_timetable_reader.py convert --help
 
 """
 
 paths = {
-    'cif': r'C:\Users\kominem\Jacobs\STPR2 - TRACC\TRACC_COVID19 Support\Timetables',
-    'output': r'C:\Users\kominem\Jacobs\STPR2 - TRACC\TRACC_COVID19 Support\Timetables\Traveline',
+    'cif': 'CIF_data',
+    'output': 'timetables',
 }
 
+# Timetables are saved one file per value of this column - 'vehicle_type', 'operator' or 'route'.
+PARTITION_BY = 'vehicle_type'
+
 
 # Do not edit below this point!
 # ===================================================================================================
@@ -21,6 +25,87 @@ import sys
 import re
 import datetime
 import time
+from atco_cif_parser import iter_atco_cif, flatten_journey, flatten_journey_records
+from compressed_input import get_member_name, list_cif_files, open_cif
+from duplicate_journeys import DuplicateJourneys, JourneyFingerprints, get_journey_fingerprint
+from instrumentation import RunReport, get_report
+from gtfs_writer import write_atco_gtfs
+from normalized_timetable import ATCO_CALENDAR_COLUMNS, ATCO_STOP_TIME_COLUMNS, get_calendar_dates, \
+    normalize_timetable, write_normalized_timetable
+from partitioned_writer import PartitionedWriter
+from record_validation import Quarantine
+from route_patterns import extract_patterns, write_patterns
+from timetable_model import TimetableModel, as_numpy
+from timetable_store import write_timetable
+
+# Column order of the output timetable.
+TIMETABLE_COLUMNS = [
+    'record_identity',
+    'operator',
+    'unique_journey_identifier',
+    'unique_identifier',
+    'route_number_(identifier)',
+    'route_direction',
+    'has_duplicated_stops',
+    'location',
+    'published_arrival_time',
+    'published_departure_time',
+    'next_stop_id',
+    'next_stop_arrival_time',
+    'operates_on_mondays',
+    'operates_on_tuesdays',
+    'operates_on_wednesdays',
+    'operates_on_thursdays',
+    'operates_on_fridays',
+    'operates_on_saturdays',
+    'operates_on_sundays',
+    'first_date_of_operation',
+    'last_date_of_operation',
+    'school_term_time',
+    'activity_flag',
+    'bank_holidays',
+    'running_board',
+    'vehicle_type',
+    'registration_number',
+    'bay_number',
+    'fare_stage_indicator',
+    'timing_point_indicator',
+]
+
+# Column order of duplicated journey rows - stop fields first, then journey header fields.
+DUPLICATE_COLUMNS = [
+    'record_identity',
+    'location',
+    'published_departure_time',
+    'bay_number',
+    'timing_point_indicator',
+    'fare_stage_indicator',
+    'next_stop_id',
+    'next_stop_arrival_time',
+    'has_duplicated_stops',
+    'transaction_type',
+    'operator',
+    'unique_journey_identifier',
+    'first_date_of_operation',
+    'last_date_of_operation',
+    'operates_on_mondays',
+    'operates_on_tuesdays',
+    'operates_on_wednesdays',
+    'operates_on_thursdays',
+    'operates_on_fridays',
+    'operates_on_saturdays',
+    'operates_on_sundays',
+    'school_term_time',
+    'bank_holidays',
+    'route_number_(identifier)',
+    'running_board',
+    'vehicle_type',
+    'registration_number',
+    'route_direction',
+    'unique_identifier',
+    'published_arrival_time',
+    'activity_flag',
+]
 
 
 def extract_raw_timetable(f):
@@ -106,10 +191,9 @@ def get_journey_data(signature):
     record_identity = signature[0:2]
     try:
         specification = specification_dict[record_identity]
-    except KeyError as e:
-        print("{} - CIF signature not found for this record. Please expand specification_dict.".
-              format(signature, file=sys.stderr))
-        sys.exit(1)
+    except KeyError:
+        raise ValueError("{} - CIF signature not found for this record. Please expand specification_dict."
+                         .format(signature.rstrip()))
 
     # Create a parsed dictionary.
     d = dict.fromkeys(list(specification.keys()))
@@ -208,6 +292,8 @@ def process_raw_timetable(raw_timetable):
     """
     timetable = []
     journey_count = 0
+    report = get_report()
+    progress = report.progress("Journeys analyzed")
     for i, signature in enumerate(raw_timetable):
         #   'QS' prefix designates a start of a new journey header.
         if signature.startswith('QS'):
@@ -220,7 +306,6 @@ def process_raw_timetable(raw_timetable):
             #       Count stops from 1 to next to next journey header.
             stop_count = 1
             #       Set up a container list for journey stop id's.
-            print("Analyzing journey no {}: {}".format(journey_count + 1, service_id))
             #           Gather a list of stop_indices respective to currently analyzed journey.
             stops_id = []
             while not next_journey_found:
@@ -231,99 +316,187 @@ def process_raw_timetable(raw_timetable):
                         next_journey_found = True
                         continue
                     stops_id.append(current_id)
-                except:
+                except IndexError:
                     break
                 stop_count += 1
             # Create a journey timetable given a list of stop id's.
             journey_timetable = create_journey_timetable(stops_id, journey_header, raw_timetable)
             timetable.extend(journey_timetable)
             journey_count += 1
+            progress.update()
 
+    report.count('journeys', journey_count)
+    report.count('rows_emitted', len(timetable))
     print("{} journeys analyzed.\n".format(journey_count))
     return timetable
 
 
+def prepare_timetable(df):
+    """
+    Rearrange the columns of a timetable, exclude journeys starting after today and fill in unknown routes.
+    :param df: timetable dataframe exported from TimetableModel
+    :return: timetable dataframe
+    """
+    # Rearrange columns.
+    df = df[TIMETABLE_COLUMNS]
+
+    # Exclude records with first date of operation exceeding today.
+    df['first_date_of_operation'] = pd.to_datetime(df['first_date_of_operation'])
+    df = df[df['first_date_of_operation'] < datetime.datetime.now()]
+    # Safeguard against routes listed as 'UNKN'; "unknown".
+    df.loc[(df['route_number_(identifier)'] == 'UNKN'),'route_number_(identifier)']=df['unique_identifier']
+    return df
+
+
+def parse_chunk(rows):
+    """
+    Parse a chunk of a .cif file holding whole journeys - used by pipeline.py to parse a file in parallel.
+    :param rows: list of .cif rows, starting at a journey header
+    :return: tuple of (timetable dataframe, journey index of every row, list of journey fingerprints, dictionary of
+    notes, exceptions, locations, quarantine (bad records), decoded, skipped and quarantined)
+    """
+    cif = {'notes': [], 'exceptions': []}
+    model = TimetableModel()
+    fingerprints = JourneyFingerprints()
+    quarantine = Quarantine()
+    cif['quarantine'] = quarantine.rows
+    for journey in iter_atco_cif(rows, records=['QS', 'QE', 'QN', 'QO', 'QI', 'QT', 'QL', 'QB'], tables=cif,
+                                 quarantine=quarantine):
+        if not fingerprints.is_duplicate(get_journey_fingerprint(journey['header'], journey['stops'])):
+            model.add_journey(journey)
+        cif['notes'].extend(flatten_journey_records([journey], 'notes'))
+        cif['exceptions'].extend(flatten_journey_records([journey], 'exceptions'))
+    return model.to_frame(), as_numpy(model.stop_journeys), fingerprints.fingerprints, cif
+
+
+def get_output_name(file):
+    """
+    Get the base name used for all outputs of a .cif file, e.g. 'CIF_data/Tram_5.cif' -> 'Tram_5'.
+    :param file: path to .cif file
+    :return: file name without folder and extension
+    """
+    return get_member_name(file).split('.')[0]
+
+
+def convert_file(file, output_folder, formats=('csv', 'xlsx'), profile=False, trace_memory=False, partition_by=None):
+    """
+    Convert a single .cif file into .csv timetables, one per vehicle type, and save journey notes, date running
+    exceptions, stop locations and duplicated records next to them. Journeys with bad records are left out and the
+    records saved to the quarantine folder. Stage timings and counters are saved as a .json run report in the output
+    folder.
+    :param file: path to .cif file
+    :param output_folder: folder to save the results in
+    :param formats: output formats of the timetables - 'csv', 'xlsx', 'normalized', 'patterns', 'gtfs', 'sqlite'
+    and/or 'duckdb'
+    :param profile: True to save a cProfile of the conversion with the run report
+    :param trace_memory: True to trace memory allocations with tracemalloc
+    :param partition_by: split timetables by 'vehicle_type', 'operator' or 'route' - PARTITION_BY when not provided
+    :return: list of saved timetable paths
+    """
+    start = time.time()
+    print("\nAnalyzing: {}".format(file))
+    name = get_output_name(file)
+    os.makedirs(os.path.join(output_folder, 'duplicates'), exist_ok=True)
+    with RunReport(name, output_folder, profile=profile, trace_memory=trace_memory) as report:
+        saved = []
+        if 'gtfs' in formats:
+            # GTFS feed is streamed straight from the .cif file in a pass of its own.
+            with report.stage('gtfs'):
+                feed, counters = write_atco_gtfs(file, output_folder, name)
+            print('Saving GTFS feed:\n{}'.format(feed))
+            saved.append(feed)
+            for counter, n in counters.items():
+                report.count('gtfs_' + counter, n)
+            if not set(formats) - {'gtfs'}:
+                return saved
+        # Open the .cif file.
+        duplicates = DuplicateJourneys(os.path.join(output_folder, 'duplicates', name + '_duplicates.csv'),
+                                       columns=DUPLICATE_COLUMNS)
+        quarantine = Quarantine(os.path.join(output_folder, 'quarantine', name + '_quarantine.csv'))
+        with report.stage('parse'), open_cif(file) as f, duplicates, quarantine:
+            # Process the data - journeys, notes, date running exceptions and locations come out of a single read.
+            # Journeys go straight into a compact model instead of being kept as dictionaries, duplicated journeys
+            # go to the duplicates .csv instead and journeys with bad records to the quarantine .csv.
+            cif = {}
+            model = TimetableModel()
+            notes = []
+            exceptions = []
+            progress = report.progress("Journeys analyzed")
+            for journey in iter_atco_cif(f, records=['QS', 'QE', 'QN', 'QO', 'QI', 'QT', 'QL', 'QB'], tables=cif,
+                                         quarantine=quarantine):
+                if duplicates.is_duplicate(get_journey_fingerprint(journey['header'], journey['stops'])):
+                    duplicates.write(flatten_journey(journey))
+                else:
+                    model.add_journey(journey)
+                notes.extend(flatten_journey_records([journey], 'notes'))
+                exceptions.extend(flatten_journey_records([journey], 'exceptions'))
+                progress.update()
+        journey_count = model.journey_count + duplicates.journeys + quarantine.journeys
+        report.count('records_decoded', cif['decoded'])
+        report.count('records_skipped', sum(cif['skipped'].values()))
+        report.count('journeys', journey_count)
+        report.count('duplicated_journeys', duplicates.journeys)
+        report.count('duplicated_rows', duplicates.rows)
+        report.count('quarantined_journeys', quarantine.journeys)
+        report.count('quarantined_records', quarantine.records)
+        print("{} journeys analyzed.".format(journey_count))
+        if cif['skipped']:
+            print("Records skipped: {}".format(cif['skipped']))
+        if quarantine.journeys:
+            print("Journeys quarantined: {} - {}\n{}".format(quarantine.journeys, quarantine.problems, quarantine.path),
+                  file=sys.stderr)
+        with report.stage('frame'):
+            df = model.to_frame()
+        # Save journey notes, date running exceptions and stop locations.
+        with report.stage('write_tables'):
+            for table, records in [('notes', notes), ('exceptions', exceptions), ('locations', cif['locations'])]:
+                if records:
+                    table_filename = name + '_{}.csv'.format(table)
+                    pd.DataFrame(records).to_csv(os.path.join(output_folder, table_filename), index=False)
+                report.count(table, len(records))
+        with report.stage('filter'):
+            df = prepare_timetable(df)
+        # Split timetable by vehicle type and save each vehicle type individually - partitions are written in the
+        # background while the other formats are being saved.
+        with report.stage('write'):
+            writer = PartitionedWriter(output_folder, name, formats=formats)
+            writer.write_frame(df, partition_by=partition_by or PARTITION_BY)
+            if 'normalized' in formats:
+                # Journeys, stop times, stops and calendar in separate tables.
+                tables = normalize_timetable(df, ATCO_STOP_TIME_COLUMNS, ATCO_CALENDAR_COLUMNS)
+                tables['stops'] = pd.DataFrame(cif['locations'])
+                tables['calendar_dates'] = get_calendar_dates(exceptions, tables['journeys'])
+                print('Saving normalized timetable:\n{}'.format(os.path.join(output_folder, name + '_*.csv')))
+                saved.extend(write_normalized_timetable(tables, output_folder, name))
+            if 'patterns' in formats:
+                # Journeys grouped by stop sequence, each with a start time and shared running times.
+                print('Saving route patterns:\n{}'.format(os.path.join(output_folder, name + '_pattern*.csv')))
+                saved.extend(write_patterns(extract_patterns(df, ATCO_STOP_TIME_COLUMNS, ATCO_CALENDAR_COLUMNS), output_folder, name))
+            for store_format in ['sqlite', 'duckdb']:
+                if store_format in formats:
+                    # Indexed timetable store for SQL queries.
+                    store = os.path.join(output_folder, '{}.{}'.format(name, store_format))
+                    print('Saving timetable store:\n{}'.format(store))
+                    saved.append(write_timetable(df, store))
+            saved.extend(writer.close())
+        report.count('rows_emitted', len(df))
+
+    print('Runtime: {0:.2f}'.format(time.time() - start))
+    return saved
+
+
 def main():
     # Clock starts.
     START = time.time()
     path = paths['cif']
     print("Checking directory tree.")
-    if not os.path.exists(paths['output']):
-        os.mkdir(os.path.join(paths['output']))
-    if not os.path.exists(os.path.join(paths['output'], 'duplicates')):
-        os.mkdir(os.path.join(paths['output'], 'duplicates'))
-            
+    os.makedirs(os.path.join(paths['output'], 'duplicates'), exist_ok=True)
+
     print("CIF Timetable conversion commencing.\nAnalyzing files in: {}".format(path))
-    filepaths = [os.path.join(path, file) for file in os.listdir(path) if file.endswith('.cif')]
+    filepaths = list_cif_files(path)
     print(".cif file list:\n", *filepaths, sep="\n")
-    for i, file in enumerate(filepaths):
-        start = time.time()
-        print("\nAnalyzing: {}".format(file))
-        output_filename = file.split('\\')[-1].split('.')[0] + '_timetable.csv'
-        # Open the .cif file.
-        f = open(filepaths[i], "r")
-        # Process the data.,
-        raw_timetable = extract_raw_timetable(f)
-        timetable = process_raw_timetable(raw_timetable)
-        df = pd.DataFrame(timetable)
-        # Check for duplicate entries.
-        duplicates = df[df.duplicated()]
-        if not duplicates.empty:
-            duplicates_filename = file.split('\\')[-1].split('.')[0] + '_duplicates.csv'
-            duplicates.to_csv(os.path.join(paths['output'], 'duplicates', duplicates_filename))
-        df.drop_duplicates(inplace=True)
-
-        # Rearrange columns.
-        df = df[[
-            'record_identity',
-            'operator',
-            'unique_journey_identifier',
-            'unique_identifier',
-            'route_number_(identifier)',
-            'route_direction',
-            'has_duplicated_stops',
-            'location',
-            'published_arrival_time',
-            'published_departure_time',
-            'next_stop_id',
-            'next_stop_arrival_time',
-            'operates_on_mondays',
-            'operates_on_tuesdays',
-            'operates_on_wednesdays',
-            'operates_on_thursdays',
-            'operates_on_fridays',
-            'operates_on_saturdays',
-            'operates_on_sundays',
-            'first_date_of_operation',
-            'last_date_of_operation',
-            'school_term_time',
-            'activity_flag',
-            'bank_holidays',
-            'running_board',
-            'vehicle_type',
-            'registration_number',
-            'bay_number',
-            'fare_stage_indicator',
-            'timing_point_indicator',
-        ]]
-
-        # Exclude records with first date of operation exceeding today.
-        df['first_date_of_operation'] = pd.to_datetime(df['first_date_of_operation'])
-        df = df[df['first_date_of_operation'] < datetime.datetime.now()]
-        # Safeguard against routes listed as 'UNKN'; "unknown".
-        df.loc[(df['route_number_(identifier)'] == 'UNKN'),'route_number_(identifier)']=df['unique_identifier']
-        # Split timetable by vehicle type and save each vehicle type individually.
-        for mode in df['vehicle_type'].unique():
-            temp_df = df[df['vehicle_type'] == mode]
-            output_filename = file.split('\\')[-1].split('.')[0] + '_{}_timetable.csv'.format(mode)
-            print('Saving {} timetable:\n{}'.format(mode, os.path.join(paths['output'], output_filename)))
-            temp_df.to_csv(os.path.join(paths['output'], output_filename), index=False)
-            try:
-                temp_df.to_excel(os.path.join(paths['output'], output_filename.replace('.csv', '.xlsx')), index=False)
-            except:
-                print("Error writing {} timetable to excel.".format(mode))
-
-        print('Runtime: {0:.2f}'.format(time.time() - start))
+    for file in filepaths:
+        convert_file(file, paths['output'])
 
     print("Finished successfully.")
 
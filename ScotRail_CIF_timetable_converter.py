@@ -2,13 +2,14 @@
 ScotRail_CIF_timetable_converter.py
 
 Analyze raw Scot Rail .cif files and convert them into .csv timetables proper. The only parameter
-to adjust is the path to .cif file folder below and the output folder.
+to adjust is the path to .cif file folder below and the output folder. To run without editing
+the source use: python cif_timetable_reader.py convert --help
 
 """
 
 paths = {
-    'cif': r'C:\Users\kominem\Jacobs\STPR2 - TRACC\TRACC_COVID19 Support\New Rail Timetables',
-    'output': r'C:\Users\kominem\Jacobs\STPR2 - TRACC\TRACC_COVID19 Support\Timetables\ScotRail',
+    'cif': 'CIF_data',
+    'output': 'timetables',
 }
 
 # Do not edit below this point!
@@ -18,29 +19,134 @@ import os
 import pandas as pd
 import sys
 import re
-import datetime
 import time
+from atco_cif_parser import decode_time
+from compressed_input import get_member_name, list_cif_files, open_cif
+from duplicate_journeys import DuplicateJourneys, JourneyFingerprints, get_journey_fingerprint
+from instrumentation import RunReport, get_report
+from gtfs_writer import write_rail_gtfs
+from normalized_timetable import RAIL_CALENDAR_COLUMNS, RAIL_STOP_TIME_COLUMNS, normalize_timetable, \
+    write_normalized_timetable
+from rail_cif_parser import RAIL_CIF_SPECIFICATION
+from record_validation import BAD_DATE, BAD_DAYS, BAD_TIME, NO_STOPS, UNKNOWN_RECORD, Quarantine, \
+    get_quarantine_record, is_date, is_day_flags
+from route_patterns import extract_patterns, write_patterns
+from tiploc_reference import MAPPED_COLUMNS, load_reference, map_timetable
+from timetable_store import write_timetable
 pd.set_option('display.max_columns', None)
 
+# Column order of the output timetable.
+TIMETABLE_COLUMNS = [
+    'record_identity',
+    'train_uid',
+    'train_status',
+    'train_category',
+    'train_identity',
+    'train_class',
+    'unique_identifier',
+    'has_duplicated_stops',
+    'location',
+    'scheduled_arrival_time',
+    'scheduled_departure_time',
+    'public_arrival_time',
+    'public_departure_time',
+    'scheduled_pass',
+    'next_stop_id',
+    'next_stop_arrival_time',
+    'operates_on_mondays',
+    'operates_on_tuesdays',
+    'operates_on_wednesdays',
+    'operates_on_thursdays',
+    'operates_on_fridays',
+    'operates_on_saturdays',
+    'operates_on_sundays',
+    'date_runs_from',
+    'date_runs_to',
+    'bank_holiday_running',
+    'platform',
+    'line',
+    'path',
+    'engineering_allowance',
+    'pathing_allowance',
+    'activity',
+    'performance_allowance',
+    'transaction_type',
+    'headcode',
+    'course_indicator',
+    'profit_centre_code',
+    'business_sector',
+    'power_type',
+    'timing_load',
+    'speed',
+    'operating_chars',
+    'sleepers',
+    'reservations',
+    'connect_indicator',
+    'catering_code',
+    'service_branding',
+    'stp_indicator',
+]
+
+# Transaction types and short term plan indicators of schedules which run - new, revised, permanent, new short term
+# plan and overlay schedules. Deleted schedules (transaction type D) and short term plan cancellations (C) carry no
+# locations.
+SCHEDULE_TRANSACTION_TYPES = ['N', 'R']
+SCHEDULE_STP_INDICATORS = ['P', 'N', 'O']
+
+# Column order of duplicated journey rows - stop fields first, then journey header fields.
+DUPLICATE_COLUMNS = [
+    'record_identity',
+    'location',
+    'scheduled_departure_time',
+    'public_departure_time',
+    'platform',
+    'line',
+    'engineering_allowance',
+    'pathing_allowance',
+    'activity',
+    'performance_allowance',
+    'spare',
+    'next_stop_id',
+    'next_stop_arrival_time',
+    'has_duplicated_stops',
+    'transaction_type',
+    'train_uid',
+    'date_runs_from',
+    'date_runs_to',
+    'days_run',
+    'bank_holiday_running',
+    'train_status',
+    'train_category',
+    'train_identity',
+    'headcode',
+    'course_indicator',
+    'profit_centre_code',
+    'business_sector',
+    'power_type',
+    'timing_load',
+    'speed',
+    'operating_chars',
+    'train_class',
+    'sleepers',
+    'reservations',
+    'connect_indicator',
+    'catering_code',
+    'service_branding',
+    'stp_indicator',
+    'unique_identifier',
+    'scheduled_arrival_time',
+    'scheduled_pass',
+    'public_arrival_time',
+    'path',
+]
+
+
 def get_file_header(file):
-    f = open(file, "r")
+    f = open_cif(file, threaded=False)
     for row in f:
         header = row
         break
-    header_specification_dict =  {
-            #   'data_type': (chunk size, starting point [1-indexed])
-            'record_identity': (2, 1),
-            'file_identity': (20, 3),
-            'date_of_extract': (6, 23),
-            'time_of_extract': (4, 29),
-            'current_file_reference': (7, 33),
-            'last_file_reference': (7, 41),
-            'update_indicator': (1, 48),
-            'version': (1, 49),
-            'extract_start_date': (6, 50),
-            'extract_end_date': (6, 61),
-            'spare': (20, 62)
-    }
+    header_specification_dict = RAIL_CIF_SPECIFICATION['HD']
 
     d = dict.fromkeys(list(header_specification_dict.keys()))
     for key in d.keys():
@@ -50,7 +156,23 @@ def get_file_header(file):
         d[key] = value
     return d
     
-def extract_raw_scotrail_timetable(f):
+def is_public_call(signature):
+    """
+    Check whether an intermediate location record is a call passengers can use, from its raw fields only - passing
+    points (scheduled pass time), stops without public times (blank or 0000) and stops not advertised (activity N)
+    are not.
+    :param signature: LI record from .cif file
+    :return: True for public calls
+    """
+    if signature[20:25].strip():
+        return False
+    if not signature[25:29].strip('0 ') and not signature[29:33].strip('0 '):
+        return False
+    activity = signature[42:54]
+    return all(activity[i:i + 2] != 'N ' for i in range(0, 12, 2))
+
+
+def extract_raw_scotrail_timetable(f, public_only=False, tables=None):
     """
     Given a ScotRail .cif file, extract a timetable containing only information on:
     BS - basic schedule signature
@@ -58,133 +180,89 @@ def extract_raw_scotrail_timetable(f):
     LI - intermediate location signature
     LT - terminatin location signature
     :param f: .cif file to be processed
+    :param public_only: True to leave out intermediate locations which are not public calls, see is_public_call -
+    before they are decoded, so the next stop of every call is the next public call
+    :param tables: optional dictionary to be filled with the number of 'non_public' records left out
     :return: raw timetable - a list of approved signatures.
     """
 
     approved_prefixes = ['BS', 'LO', 'LI', 'LT']
     raw_timetable = []
+    non_public = 0
     for row in f:
         record_identity = row[0:2]
         if record_identity in approved_prefixes:
+            if public_only and record_identity == 'LI' and not is_public_call(row):
+                non_public += 1
+                continue
             raw_timetable.append(row)
+    if tables is not None:
+        tables['non_public'] = non_public
     return raw_timetable
 
 def get_journey_data(signature):
     """
     Given a row signature from a .cif file, return the parsed data as dictionary
     :param signature: one record from .cif file
-    :return: dictionary with data parsed from .cif record
+    :return: dictionary with data parsed from .cif record, times as datetime.time objects - None for blank times and
+    times which can't be decoded
+    """
+    d, flags, fields = validate_journey_data(signature)
+    if flags & UNKNOWN_RECORD:
+        raise ValueError("{} - CIF signature not found for this record. Please expand specification_dict."
+                         .format(signature.rstrip()))
+    return d
+
+
+def validate_journey_data(signature):
+    """
+    Given a row signature from a .cif file, return the parsed data as dictionary and flag every field which can't be
+    decoded - bad times, dates and days run.
+    :param signature: one record from .cif file
+    :return: tuple of (dictionary with data parsed from .cif record, bit flags of problems found, list of bad fields)
     """
-    # This dictionary contains information on how to parse different records.
-    specification_dict = {
-        'BS': {
-            #   'data_type': (chunk size, starting point [1-indexed])
-            'record_identity': (2, 1),
-            'transaction_type': (1, 3),
-            'train_uid': (6, 4),
-            'date_runs_from': (6, 10),
-            'date_runs_to': (6, 16),
-            'days_run': (7, 22),
-            'bank_holiday_running': (1, 29),
-            'train_status': (1, 30),
-            'train_category': (2, 31),
-            'train_identity': (4, 33),
-            'headcode': (4, 37),
-            'course_indicator': (1, 41),
-            'profit_centre_code': (8, 42),
-            'business_sector': (1, 50),
-            'power_type': (3, 51),
-            'timing_load': (4, 54),
-            'speed': (3, 58),
-            'operating_chars': (6, 61),
-            'train_class': (1, 67),
-            'sleepers': (1, 68),
-            'reservations': (1, 69),
-            'connect_indicator': (1, 70),
-            'catering_code': (4, 71),
-            'service_branding': (4, 75),
-            'spare': (1, 79),
-            'stp_indicator': (1, 80), },
-        'LO': {
-            #   'data_type': (chunk size, starting point [1-indexed])
-            'record_identity': (2, 1),
-            'location': (8, 3),
-            'scheduled_departure_time': (5, 11),
-            'public_departure_time': (4, 16),
-            'platform': (3, 20),
-            'line': (3, 23),
-            'engineering_allowance': (2, 26),
-            'pathing_allowance': (2, 28),
-            'activity': (12, 30),
-            'performance_allowance': (2, 42),
-            'spare': (37, 44), },
-        'LI': {
-            #   'data_type': (chunk size, starting point [1-indexed])
-            'record_identity': (2, 1),
-            'location': (8, 3),
-            'scheduled_arrival_time': (5, 11),
-            'scheduled_departure_time': (5, 16),
-            'scheduled_pass': (5, 21),
-            'public_arrival_time': (4, 26),
-            'public_departure_time': (4, 30),
-            'platform': (4, 34),
-            'line': (3, 37),
-            'path': (3, 40),
-            'activity': (12, 43),
-            'engineering_allowance': (2, 55),
-            'pathing_allowance': (2, 57),
-            'performance_allowance': (2, 59),
-            'spare': (20, 61), },
-        'LT': {
-            #   'data_type': (chunk size, starting point [1-indexed])
-            'record_identity': (2, 1),
-            'location': (8, 3),
-            'scheduled_arrival_time': (5, 11),
-            'public_arrival_time': (4, 16),
-            'platform': (3, 20),
-            'path': (3, 23),
-            'activity': (12, 26),
-            'spare': (43, 80),}
-    }
+    # Record layouts are described in RAIL_CIF_SPECIFICATION.
+    specification_dict = RAIL_CIF_SPECIFICATION
 
     # Identify what the record holds.
     record_identity = signature[0:2]
     try:
         specification = specification_dict[record_identity]
-    except KeyError as e:
-        print("{} - CIF signature not found for this record. Please expand specification_dict.".
-              format(signature, file=sys.stderr))
-        sys.exit(1)
+    except KeyError:
+        return None, UNKNOWN_RECORD, []
 
     # Create a parsed dictionary.
     d = dict.fromkeys(list(specification.keys()))
+    flags = 0
+    fields = []
     for key in specification.keys():
         start = specification[key][1] - 1
         end = start + specification[key][0]
         value = signature[start:end].strip()
-        # Convert arrival, departure and passing times to proper datetime objects.
-        if record_identity != 'BS':
+        # Convert arrival, departure and passing times to proper datetime objects - the trailing 'H' of half minutes
+        # is dropped.
+        if record_identity != 'BS' and ('time' in key or key == 'scheduled_pass'):
             try:
-                if 'time' in key:
-                    value = datetime.datetime.strptime(value[0:4], "%H%M").time()
-                if 'public_arrival' in key:
-                    value = datetime.datetime.strptime(value[0:4], "%H%M").time()
-                if 'public_departure' in key:
-                    value = datetime.datetime.strptime(value[0:4], "%H%M").time()
-                if 'public_departure' in key:
-                    value = datetime.datetime.strptime(value[0:4], "%H%M").time()
-                if 'scheduled_pass' in key:
-                    value = datetime.datetime.strptime(value[0:4], "%H%M").time()
-            except:
-                pass
+                value = decode_time(value[0:4]) if value else None
+            except ValueError:
+                value = None
+                flags |= BAD_TIME
+                fields.append(key)
         d[key] = value
-        if record_identity == 'BS':
-            d['unique_identifier'] = str(d['train_uid'])\
+    if record_identity == 'BS':
+        d['unique_identifier'] = str(d['train_uid'])\
             + '_' + str(d['train_status'])\
             + '_' + str(d['train_category'])\
             + '_' + str(d['train_identity'])\
             + '_' + str(d['train_class'])
-    return d
+        for key in ['date_runs_from', 'date_runs_to']:
+            if not is_date(d[key], '%y%m%d'):
+                flags |= BAD_DATE
+                fields.append(key)
+        if len(d['days_run']) != 7 or not is_day_flags(d['days_run']):
+            flags |= BAD_DAYS
+            fields.append('days_run')
+    return d, flags, fields
 
 def check_duplicate_stops(timetable):
     stops = [stop['location'] for stop in timetable]
@@ -192,7 +270,7 @@ def check_duplicate_stops(timetable):
     if duplicates != []:
         return True
 
-def create_journey_timetable(id_list, journey_header, raw_timetable):
+def create_journey_timetable(id_list, journey_header, raw_timetable, problems=None):
     """
     Create a list of stops making up a particular journey. The assumption is that you feed only id's making up a full
     journey, so:
@@ -200,50 +278,28 @@ def create_journey_timetable(id_list, journey_header, raw_timetable):
     * last id has a LT signature
     * intermediate id's have LI signatures
 
-    There are two cases:
-    * journey with intermediate stops, i.e more than two stops in total are provided.
-    * journey without intermediate stops, i. two stops in total are provided.
+    Every stop holds the id and scheduled arrival time of the next stop, except for the last one.
 
     :param id_list: list of indices that make up the journey
     :param raw_timetable: raw timetable extracted from .cif file
     :param service_id: journey name/header
+    :param problems: optional list to append bad records to - see record_validation.get_quarantine_record
     :return: list of dictionaries containing information on stops in a particular journey
     """
     # Extract data from journey head - get everything except record identity
     journey_header_data = {key: value for (key, value) in journey_header.items() if not 'record_identity' in key}
 
-    # Set up a dictionary container.
+    # Set up a dictionary container - every record is decoded once.
     timetable = []
-    if len(id_list) > 2:
-        #               Create and append origin header.
-        origin_header = get_journey_data(raw_timetable[id_list[0]])
-        next_stop_header = get_journey_data(raw_timetable[id_list[1]])
-
-        origin_header['next_stop_id'] = next_stop_header['location']
-        origin_header['next_stop_arrival_time'] = next_stop_header['scheduled_arrival_time']
-        timetable.append(origin_header)
-
-        destination_header = get_journey_data(raw_timetable[id_list[-1]])
-
-        for header_id in id_list[1:-1]:
-            stop_header = get_journey_data(raw_timetable[header_id])
-            next_stop_header = get_journey_data(raw_timetable[header_id + 1])
-
-            stop_header['next_stop_id'] = next_stop_header['location']
-            stop_header['next_stop_arrival_time'] = next_stop_header['scheduled_arrival_time']
-            timetable.append(stop_header)
-
-        timetable.append(destination_header)
-    else:
-        origin_header = get_journey_data(raw_timetable[id_list[0]])
-        next_stop_header = get_journey_data(raw_timetable[id_list[1]])
-
-        origin_header['next_stop_id'] = next_stop_header['location']
-        origin_header['next_stop_arrival_time'] = next_stop_header['scheduled_arrival_time']
-        timetable.append(origin_header)
-
-        destination_header = get_journey_data(raw_timetable[id_list[-1]])
-        timetable.append(destination_header)
+    for header_id in id_list:
+        stop_header, flags, fields = validate_journey_data(raw_timetable[header_id])
+        if flags and problems is not None:
+            problems.append(get_quarantine_record(raw_timetable[header_id], flags, fields,
+                                                  journey_header['unique_identifier']))
+        timetable.append(stop_header)
+    for stop_header, next_stop_header in zip(timetable[:-1], timetable[1:]):
+        stop_header['next_stop_id'] = next_stop_header['location']
+        stop_header['next_stop_arrival_time'] = next_stop_header['scheduled_arrival_time']
 
     # Check for duplicated stops
     if check_duplicate_stops(timetable):
@@ -257,27 +313,34 @@ def create_journey_timetable(id_list, journey_header, raw_timetable):
 
     return timetable
 
-def process_raw_scotrail_timetable(raw_timetable):
+def process_raw_scotrail_timetable(raw_timetable, duplicates=None, quarantine=None):
     """
     Given a raw scotrail timetable, this function analyzes which stops belong to which journey and returns a proper timetable
-    as a list of dictionaries.
+    as a list of dictionaries. Journeys with bad records or schedules without any locations are left out; deleted
+    schedules and short term plan cancellations never have locations and are only counted.
     :param raw_timetable: raw timetable extracted from a .cif file
+    :param duplicates: optional DuplicateJourneys - duplicated journeys are written there instead of the timetable
+    :param quarantine: optional Quarantine - bad records of left out journeys are written there
     :return:
     """
+    if quarantine is None:
+        quarantine = Quarantine()
     timetable = []
     journey_count = 0
+    cancellation_count = 0
+    report = get_report()
+    progress = report.progress("Journeys analyzed")
     for i, signature in enumerate(raw_timetable):
         #   'BS' prefix designates a start of a new journey header.
         if signature.startswith('BS'):
             #       Set a flag to false until you find another 'BS' prefix.
             next_journey_found = False
             #       Get journey header and extract some data we'll append to individual stops.
-            journey_header = get_journey_data(signature)
+            journey_header, flags, fields = validate_journey_data(signature)
             train_uid = journey_header['train_uid']
             #       Count stops from 1 to next to next journey header.
             stop_count = 1
             #       Set up a container list for journey stop id's.
-            print("Analyzing journey no {}: {}".format(journey_count + 1, train_uid))
             #           Gather a list of stop_indices respective to currently analyzed journey.
             stops_id = []
             while not next_journey_found:
@@ -288,119 +351,196 @@ def process_raw_scotrail_timetable(raw_timetable):
                         next_journey_found = True
                         continue
                     stops_id.append(current_id)
-                except:
+                except IndexError:
                     break
                 stop_count += 1
+            if not stops_id:
+                if journey_header['transaction_type'] not in SCHEDULE_TRANSACTION_TYPES \
+                        or journey_header['stp_indicator'] not in SCHEDULE_STP_INDICATORS:
+                    cancellation_count += 1
+                    journey_count += 1
+                    progress.update()
+                    continue
+                flags |= NO_STOPS
+            problems = [get_quarantine_record(signature, flags, fields, journey_header['unique_identifier'])] \
+                if flags else []
 #             Create a journey timetable given a list of stop id's.
-            journey_timetable = create_journey_timetable(stops_id, journey_header, raw_timetable)
-            timetable.extend(journey_timetable)
+            journey_timetable = create_journey_timetable(stops_id, journey_header, raw_timetable, problems=problems)
+            if problems:
+                quarantine.write(problems)
+            elif duplicates is not None \
+                    and duplicates.is_duplicate(get_journey_fingerprint(journey_header, journey_timetable)):
+                duplicates.write(journey_timetable)
+            else:
+                timetable.extend(journey_timetable)
             journey_count += 1
+            progress.update()
 
+    report.count('journeys', journey_count)
+    report.count('cancellations', cancellation_count)
     print("{} journeys analyzed.\n".format(journey_count))
     return timetable
 
+def prepare_timetable(timetable):
+    """
+    Create a timetable dataframe with days of operation in separate columns.
+    :param timetable: list of stop dictionaries created with process_raw_scotrail_timetable, or a dataframe of them
+    :return: timetable dataframe
+    """
+    df = pd.DataFrame(timetable)
+    # Create "operates_on_(...) columns
+    df['operates_on_mondays'] = df['days_run'].str[0]
+    df['operates_on_tuesdays'] = df['days_run'].str[1]
+    df['operates_on_wednesdays'] = df['days_run'].str[2]
+    df['operates_on_thursdays'] = df['days_run'].str[3]
+    df['operates_on_fridays'] = df['days_run'].str[4]
+    df['operates_on_saturdays'] = df['days_run'].str[5]
+    df['operates_on_sundays'] = df['days_run'].str[6]
+
+    return df[TIMETABLE_COLUMNS]
+
+
+def parse_chunk(rows):
+    """
+    Parse a chunk of a .cif file holding whole journeys - used by pipeline.py to parse a file in parallel.
+    :param rows: list of .cif rows, starting at a journey header
+    :return: tuple of (timetable dataframe - all fields, not prepared yet, see prepare_timetable -, journey index of
+    every row, list of journey fingerprints, dictionary with a count of decoded records, quarantine (bad records) and
+    quarantined)
+    """
+    raw_timetable = extract_raw_scotrail_timetable(rows)
+    fingerprints = JourneyFingerprints()
+    quarantine = Quarantine()
+    timetable = process_raw_scotrail_timetable(raw_timetable, duplicates=fingerprints, quarantine=quarantine)
+    tables = {'decoded': len(raw_timetable), 'quarantine': quarantine.rows, 'quarantined': quarantine.journeys}
+    if not timetable:
+        return pd.DataFrame(columns=DUPLICATE_COLUMNS), [], [], tables
+    df = pd.DataFrame(timetable)
+    # Every journey starts with its origin record.
+    starts = (df['record_identity'] == 'LO').to_numpy()
+    journey_ids = starts.cumsum() - 1 if starts.sum() == len(fingerprints.fingerprints) else None
+    return df, journey_ids, fingerprints.fingerprints, tables
+
+
+def get_output_name(file):
+    """
+    Get the base name used for all outputs of a .cif file, e.g. 'data/ScotRail.CIF' -> 'ScotRail'.
+    :param file: path to .cif file
+    :return: file name without folder and extension
+    """
+    return get_member_name(file).split('.')[0]
+
+
+def convert_file(file, output_folder, formats=('csv', 'xlsx'), profile=False, trace_memory=False,
+                 tiploc_reference=None, public_only=False):
+    """
+    Convert a single ScotRail .cif file into a .csv timetable and save duplicated records next to it. Journeys with
+    bad records are left out and the records saved to the quarantine folder. Stage timings and counters are saved as
+    a .json run report in the output folder.
+    :param file: path to .cif file
+    :param output_folder: folder to save the results in
+    :param formats: output formats of the timetable - 'csv', 'xlsx', 'normalized', 'patterns', 'gtfs', 'sqlite'
+    and/or 'duckdb'
+    :param profile: True to save a cProfile of the conversion with the run report
+    :param trace_memory: True to trace memory allocations with tracemalloc
+    :param tiploc_reference: optional path to TIPLOC/CRS/NaPTAN correspondence .csv - locations are mapped to ATCO
+    and CRS codes and unmatched TIPLOCs saved next to the timetable, see tiploc_reference.py
+    :param public_only: True to only keep public calls - passing points and stops passengers can't use are left out
+    while reading
+    :return: list of saved timetable paths
+    """
+    start = time.time()
+    print("\nAnalyzing: {}".format(file))
+    name = get_output_name(file)
+    os.makedirs(os.path.join(output_folder, 'duplicates'), exist_ok=True)
+    with RunReport(name, output_folder, profile=profile, trace_memory=trace_memory) as report:
+        saved = []
+        if 'gtfs' in formats:
+            # GTFS feed is streamed straight from the .cif file in a pass of its own.
+            with report.stage('gtfs'):
+                feed, counters = write_rail_gtfs(file, output_folder, name)
+            print('Saving GTFS feed:\n{}'.format(feed))
+            saved.append(feed)
+            for counter, n in counters.items():
+                report.count('gtfs_' + counter, n)
+            if not set(formats) - {'gtfs'}:
+                return saved
+        # Open the .cif file.
+        with report.stage('read'), open_cif(file) as f:
+            # Process the data.,
+            tables = {}
+            raw_timetable = extract_raw_scotrail_timetable(f, public_only=public_only, tables=tables)
+        report.count('records_decoded', len(raw_timetable))
+        if public_only:
+            report.count('non_public_records_skipped', tables['non_public'])
+        # Duplicated journeys are set aside while parsing.
+        duplicates = DuplicateJourneys(os.path.join(output_folder, 'duplicates', name + '_duplicates.csv'),
+                                       columns=DUPLICATE_COLUMNS)
+        quarantine = Quarantine(os.path.join(output_folder, 'quarantine', name + '_quarantine.csv'))
+        with report.stage('parse'), duplicates, quarantine:
+            timetable = process_raw_scotrail_timetable(raw_timetable, duplicates=duplicates, quarantine=quarantine)
+        report.count('duplicated_journeys', duplicates.journeys)
+        report.count('duplicated_rows', duplicates.rows)
+        report.count('quarantined_journeys', quarantine.journeys)
+        report.count('quarantined_records', quarantine.records)
+        if quarantine.journeys:
+            print("Journeys quarantined: {} - {}\n{}".format(quarantine.journeys, quarantine.problems, quarantine.path),
+                  file=sys.stderr)
+
+        with report.stage('frame'):
+            df = prepare_timetable(timetable)
+        stop_time_columns = RAIL_STOP_TIME_COLUMNS
+        if tiploc_reference:
+            with report.stage('map_locations'):
+                df, unmatched = map_timetable(df, load_reference(tiploc_reference))
+            stop_time_columns = RAIL_STOP_TIME_COLUMNS + MAPPED_COLUMNS
+            unmatched.to_csv(os.path.join(output_folder, "{}_unmatched_tiplocs.csv".format(name)), index=False)
+            report.count('unmatched_tiplocs', len(unmatched))
+            if len(unmatched):
+                print("{} TIPLOCs not found in {}:\n{}".format(
+                    len(unmatched), tiploc_reference, os.path.join(output_folder, name + '_unmatched_tiplocs.csv')))
+
+        with report.stage('write'):
+            if 'csv' in formats:
+                df.to_csv(os.path.join(output_folder, "{}_timetable.csv".format(name)), index=False)
+                saved.append(os.path.join(output_folder, "{}_timetable.csv".format(name)))
+            if 'xlsx' in formats:
+                try:
+                    df.to_excel(os.path.join(output_folder, "{}_timetable.xlsx".format(name)), index=False)
+                except:
+                    print("Error saving {} to excel.".format(name))
+            if 'normalized' in formats:
+                tables = normalize_timetable(df, stop_time_columns, RAIL_CALENDAR_COLUMNS)
+                saved.extend(write_normalized_timetable(tables, output_folder, name))
+            if 'patterns' in formats:
+                # Journeys grouped by stop sequence, each with a start time and shared running times.
+                print('Saving route patterns:\n{}'.format(os.path.join(output_folder, name + '_pattern*.csv')))
+                saved.extend(write_patterns(extract_patterns(df, stop_time_columns, RAIL_CALENDAR_COLUMNS), output_folder, name))
+            for store_format in ['sqlite', 'duckdb']:
+                if store_format in formats:
+                    # Indexed timetable store for SQL queries.
+                    store = os.path.join(output_folder, '{}.{}'.format(name, store_format))
+                    print('Saving timetable store:\n{}'.format(store))
+                    saved.append(write_timetable(df, store))
+        report.count('rows_emitted', len(df))
+
+    print('Runtime: {0:.2f}'.format(time.time() - start))
+    return saved
+
+
 def main():
     # Clock starts.
     START = time.time()
     path = paths['cif']
     print("Checking directory tree.")
-    if not os.path.exists(paths['output']):
-        os.mkdir(os.path.join(paths['output']))
-    if not os.path.exists(os.path.join(paths['output'], 'duplicates')):
-        os.mkdir(os.path.join(paths['output'], 'duplicates'))
-        
+    os.makedirs(os.path.join(paths['output'], 'duplicates'), exist_ok=True)
+
     print("CIF Timetable conversion commencing.\nAnalyzing files in: {}".format(path))
-    filepaths = [os.path.join(path, file) for file in os.listdir(path) if file.lower().endswith('.cif')]
+    filepaths = list_cif_files(path)
     print(".cif file list:\n", *filepaths, sep="\n")
-    for i, file in enumerate(filepaths):
-        start = time.time()
-        print("\nAnalyzing: {}".format(file))
-        header = get_file_header(file)
-        # Open the .cif file.
-        f = open(filepaths[i], "r")
-        # Process the data.,
-        raw_timetable = extract_raw_scotrail_timetable(f)
-        timetable = process_raw_scotrail_timetable(raw_timetable)
-        
-        df = pd.DataFrame(timetable)
-        # Check for duplicate entries.
-        duplicates = df[df.duplicated()]
-        if not duplicates.empty:
-            duplicates_filename = file.split('\\')[-1].split('.')[0] + '_duplicates.csv'
-            duplicates.to_csv(os.path.join(paths['output'], 'duplicates', duplicates_filename))
-        df.drop_duplicates(inplace=True)
-        
-        df = pd.DataFrame(timetable)
-        # Create "operates_on_(...) columns
-        df['operates_on_mondays'] = df['days_run'].str[0]
-        df['operates_on_tuesdays'] = df['days_run'].str[1]
-        df['operates_on_wednesdays'] = df['days_run'].str[2]
-        df['operates_on_thursdays'] = df['days_run'].str[3]
-        df['operates_on_fridays'] = df['days_run'].str[4]
-        df['operates_on_saturdays'] = df['days_run'].str[5]
-        df['operates_on_sundays'] = df['days_run'].str[6]
-
-        df = df[[
-            'record_identity',
-            'train_uid',
-            'train_status',
-            'train_category',
-            'train_identity',
-            'train_class',
-            'unique_identifier',
-            'has_duplicated_stops',
-            'location',
-            'scheduled_arrival_time',
-            'scheduled_departure_time',
-            'public_arrival_time',
-            'public_departure_time',
-            'scheduled_pass',
-            'next_stop_id',
-            'next_stop_arrival_time',
-            'operates_on_mondays',
-            'operates_on_tuesdays',
-            'operates_on_wednesdays',
-            'operates_on_thursdays',
-            'operates_on_fridays',
-            'operates_on_saturdays',
-            'operates_on_sundays',
-            'date_runs_from',
-            'date_runs_to',
-            'bank_holiday_running',
-            'platform',
-            'line',
-            'path',
-            'engineering_allowance',
-            'pathing_allowance',
-            'activity',
-            'performance_allowance',
-            'transaction_type',
-            'headcode',
-            'course_indicator',
-            'profit_centre_code',
-            'business_sector',
-            'power_type',
-            'timing_load',
-            'speed',
-            'operating_chars',
-            'sleepers',
-            'reservations',
-            'connect_indicator',
-            'catering_code',
-            'service_branding',
-            'stp_indicator'
-        ]]
-        
-        df.to_csv(os.path.join(paths['output'], "{}_timetable.csv".format(os.path.basename(file).split('.')[0])), index=False)
-        try:
-            df.to_excel(os.path.join(paths['output'], "{}_timetable.xlsx".format(os.path.basename(file).split('.')[0])), index=False)
-        except:
-            print("Error saving {} to excel.".format(os.path.basename(file).split('.')[0]))
-        
-        print('Runtime: {0:.2f}'.format(time.time() - start))
+    for file in filepaths:
+        convert_file(file, paths['output'])
     print("Finished successfully.")
-    
+
 if __name__ == '__main__':
     main()
-
-        
@@ -8,15 +8,17 @@ and outbound
 - a summary of stops and their associated routes and their respective outbound
 and inbound frequencies
 
+To run without editing the source use: python cif_timetable_reader.py frequency --help
+
 
 """
 
 # GLOBAL PARAMETERS
 paths = {
     # Path to folder with timetable data (that is - .csv timetable converted from RAW CIF file)
-        'timetable': r'C:\Users\kominem\Jacobs\STPR2 - TRACC\TRACC_COVID19 Support\Timetables\ScotRail',
+        'timetable': 'timetables',
     # Name of folder in timetable data to store stop frequencies.
-       'output': r'C:\Users\kominem\Jacobs\STPR2 - TRACC\TRACC_COVID19 Support\Stop Frequency Results\Stop Frequency_Scripting_Output\Stop_Frequency_ScotRail'
+       'output': 'stop_frequency'
 }
 
 # Day of operation - from monday to sunday.
@@ -28,12 +30,24 @@ START_MINUTES = 00
 END_HOUR = 9
 END_MINUTES = 00
 
+# Number of timetable rows read at once. Set to None to load each timetable whole.
+CHUNKSIZE = None
+
 # Do not edit below this point!
 # ===================================================================================================
 import os
 import time
 import pandas as pd
 import datetime
+from instrumentation import RunReport, get_report
+from out_of_core import PartialSums, read_filtered_chunks
+from normalized_timetable import DAY_COLUMNS, load_normalized_timetable
+from tiploc_reference import get_join_keys
+
+# Timetable columns used by get_stop_frequency.
+FREQUENCY_COLUMNS = ['location', 'atco_code', 'unique_identifier', 'scheduled_arrival_time',
+                     'scheduled_departure_time', 'public_arrival_time', 'public_departure_time',
+                     'scheduled_pass'] + DAY_COLUMNS
 
 
 
@@ -53,19 +67,25 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_departu
     :param end_minute: ending minute
     :return: dataframe with stops and frequencies in a given time period.
     """
+    total = filter_timetable(df_timetable, day, start_hour, end_hour, start_minute=start_minute,
+                             end_minute=end_minute)
+    return summarize_frequency(total, day, group_by_routes=group_by_routes, get_services=get_services)
+
+
+def filter_timetable(df_timetable, day, start_hour, end_hour, start_minute=0, end_minute=0):
+    """
+    Trim the timetable to public calls on a given day, arriving or departing in a given time period. The result can
+    be summarized by stops and by routes without filtering the timetable again.
+    :param df_timetable: timetable dataframe
+    :param day: day of week
+    :return: trimmed timetable dataframe
+    """
     #   Set up parameters.
     start = datetime.time(hour=start_hour, minute=start_minute)
     end = datetime.time(hour=end_hour, minute=end_minute)
     day = 'operates_on_' + day.lower() + 's'
     arrival_column = 'public_arrival_time'
     departure_column = 'public_departure_time'
-    
-    if group_by_routes:
-        group_by_cols = ['location', 'unique_identifier']
-        output_columns = ['location', 'unique_identifier', day]
-    else:
-        group_by_cols = ['location']
-        output_columns = ['location', day]
 
     #   Trim the timetable to day, hour and direction.
     total = pd.concat([
@@ -90,6 +110,25 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_departu
         'public_departure_time',
         'scheduled_pass',
     ])
+    return total
+
+
+def summarize_frequency(total, day, group_by_routes=False, get_services=False):
+    """
+    Count calls of a timetable trimmed with filter_timetable.
+    :param total: trimmed timetable dataframe
+    :param day: day of week the timetable was trimmed to
+    :param group_by_routes: True if you want to get frequencies of particular routes on a stop
+    :param get_services: True to list the services calling at each stop
+    :return: dataframe with stops and frequencies in a given time period.
+    """
+    day = 'operates_on_' + day.lower() + 's'
+    if group_by_routes:
+        group_by_cols = ['location', 'unique_identifier']
+        output_columns = ['location', 'unique_identifier', day]
+    else:
+        group_by_cols = ['location']
+        output_columns = ['location', day]
 
     if get_services:
         #   Analyze services on each location.
@@ -98,20 +137,21 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_departu
         locations = total['location'].unique().tolist()
 
         #   Get a list of routes at evey location
+        progress = get_report().progress("Locations analyzed", total=len(locations))
         for i, location in enumerate(locations):
             data = dict.fromkeys(keys)
             data['location'] = location
         
             total_routes = set(total[total['location'] == location]['unique_identifier'] \
                                  .unique())
-            data['total_routes'] = list(total_routes)
+            data['total_routes'] = sorted(total_routes)
             locations_and_routes.append(data)
-            print("Location {}: {}/{}\nTotal routes: {}\n".format(location, i+1, len(locations), total_routes))
+            progress.update()
         
-        services = pd.DataFrame(locations_and_routes)
+        services = pd.DataFrame(locations_and_routes, columns=keys)
 
     # Analyze service frequencies.
-    total_freq = total \
+    total_freq = total[output_columns] \
         .groupby(group_by_cols) \
         .sum() \
         .reset_index() \
@@ -125,8 +165,81 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_departu
     if get_services:
         frequency = frequency.merge(services, how='left', on='location')
 
-    #       Add prefix for easier joining with shapefiles.
-    frequency['location'] = frequency['location'].apply(lambda x: 'QLN9100' + str(x).strip())
+    #       Add prefix for easier joining with shapefiles - ATCO codes of locations mapped at conversion time.
+    atco_codes = None
+    if 'atco_code' in total.columns:
+        atco_codes = frequency['location'].map(total.drop_duplicates('location').set_index('location')['atco_code'])
+    frequency['location'] = get_join_keys(frequency['location'], atco_codes)
+
+    return frequency
+
+
+def get_stop_frequency_out_of_core(csv, day, start_hour, end_hour, group_by_routes=False, get_services=False,
+                                   start_minute=0, end_minute=0, chunksize=500000):
+    """
+    Same as get_stop_frequency, but reads the timetable .csv in chunks instead of loading it whole. Only the columns
+    needed are parsed and every chunk is filtered to the day and timeframe straight away - memory is bounded by the
+    chunk size and the number of calls within the timeframe, not by the size of the timetable.
+    :param csv: path to timetable .csv created with ScotRail_CIF_timetable_converter.py
+    :param chunksize: number of rows read at once
+    :return: dataframe with stops and frequencies in a given time period, identical to get_stop_frequency.
+    """
+    # Times are saved as zero-padded hh:mm:ss, so comparing strings is the same as comparing datetime.time objects.
+    start = datetime.time(hour=start_hour, minute=start_minute).strftime('%H:%M:%S')
+    end = datetime.time(hour=end_hour, minute=end_minute).strftime('%H:%M:%S')
+    day = 'operates_on_' + day.lower() + 's'
+    arrival_column = 'public_arrival_time'
+    departure_column = 'public_departure_time'
+    subset = ['location', 'unique_identifier', day, 'scheduled_arrival_time', 'scheduled_departure_time',
+              'public_arrival_time', 'public_departure_time', 'scheduled_pass']
+
+    if group_by_routes:
+        group_by_cols = ['location', 'unique_identifier']
+    else:
+        group_by_cols = ['location']
+
+    def in_timeframe(chunk):
+        return (chunk[day] == 1) & (chunk['scheduled_pass'].isna()) & (
+            ((chunk[arrival_column] >= start) & (chunk[arrival_column] <= end))
+            | ((chunk[departure_column] >= start) & (chunk[departure_column] <= end)))
+
+    # ATCO codes of locations mapped at conversion time.
+    mapped = ['atco_code'] if 'atco_code' in pd.read_csv(csv, nrows=0).columns else []
+    atco_codes = {}
+
+    total = PartialSums(group_by_cols, day)
+    routes = {}
+    # Calls already counted - the same call may appear more than once, also across chunks.
+    seen = set()
+    for chunk in read_filtered_chunks(csv, usecols=subset + mapped,
+                                      dtype={col: str for col in subset + mapped if col != day},
+                                      mask=in_timeframe, chunksize=chunksize):
+        keys = list(zip(*[chunk[col].fillna('') for col in subset]))
+        is_new = []
+        for key in keys:
+            is_new.append(key not in seen)
+            seen.add(key)
+        chunk = chunk.loc[is_new]
+        total.add(chunk)
+        if get_services:
+            for location, unique_identifier in zip(chunk['location'], chunk['unique_identifier']):
+                routes.setdefault(location, set()).add(unique_identifier)
+        if mapped:
+            atco_codes.update(zip(chunk['location'], chunk['atco_code']))
+
+    # Get it all together.
+    frequency = total.result() \
+        .rename(columns={day: 'total_frequency'}) \
+        .sort_values(by='total_frequency', ascending=False)
+
+    if get_services:
+        services = pd.DataFrame([{'location': location, 'total_routes': sorted(total_routes)}
+                                 for location, total_routes in routes.items()], columns=['location', 'total_routes'])
+        frequency = frequency.merge(services, how='left', on='location')
+
+    #       Add prefix for easier joining with shapefiles - ATCO codes of locations mapped at conversion time.
+    frequency['location'] = get_join_keys(frequency['location'],
+                                          frequency['location'].map(atco_codes) if mapped else None)
 
     return frequency
 
@@ -156,11 +269,92 @@ def load_timetable(csv):
         'public_departure_time',
         'next_stop_arrival_time',]
     for col in time_cols:
-        df[col] = pd.to_datetime(df[col]).dt.time
+        df[col] = pd.to_datetime(df[col], format='%H:%M:%S').dt.time
+
+    return df
+
+
+def load_normalized(prefix):
+    """
+    Load a timetable saved with ScotRail_CIF_timetable_converter.py in normalized format - only the columns
+    get_stop_frequency needs are read and joined.
+    :param prefix: path prefix of the timetable tables, e.g. timetables/ScotRail
+    :return: timetable dataframe
+    """
+    df = load_normalized_timetable(prefix, columns=FREQUENCY_COLUMNS, dtype={
+        'unique_identifier': str,
+        'location': str
+    })
 
+    #   Cast time columns to datetime.time objects.
+    for col in ['scheduled_arrival_time', 'scheduled_departure_time', 'public_arrival_time', 'public_departure_time']:
+        df[col] = pd.to_datetime(df[col], format='%H:%M:%S').dt.time
     return df
 
 
+def get_output_names(file, day, start_hour, start_minutes, end_hour, end_minutes, name=None):
+    """
+    Names of the stop and route frequency .csv files saved for a timetable, day and timeframe.
+    :param name: optional name of the timetable, the file name up to the first '_' when not provided
+    :return: tuple of (stop frequency file name, route frequency file name)
+    """
+    prefix = "{}_{}_{}_{}_to_{}_{}".format(name or os.path.basename(file).split('_')[0], day, str(start_hour),
+                                            str(start_minutes), str(end_hour), str(end_minutes))
+    return prefix + '.csv', prefix + '_route_frequency.csv'
+
+
+def frequency_file(csv, output_folder, day, start_hour, end_hour, start_minute=0, end_minute=0,
+                   formats=('csv', 'xlsx'), profile=False, trace_memory=False, chunksize=None, name=None):
+    """
+    Calculate stop and route frequencies of a single timetable and save them to output folder, together with a .json
+    run report.
+    :param csv: path to timetable .csv created with ScotRail_CIF_timetable_converter.py
+    :param output_folder: folder to save the results in
+    :param formats: output formats - 'csv' and/or 'xlsx'
+    :param profile: True to save a cProfile of the calculation with the run report
+    :param trace_memory: True to trace memory allocations with tracemalloc
+    :param chunksize: number of rows read at once, None to load the timetable whole
+    :param name: optional name of the timetable to name the outputs after - see get_output_names
+    :return: list of saved paths
+    """
+    output_file, output_route_frequency = get_output_names(csv, day, start_hour, start_minute, end_hour, end_minute,
+                                                           name=name)
+    os.makedirs(output_folder, exist_ok=True)
+    with RunReport(output_file.replace('.csv', ''), output_folder, profile=profile,
+                   trace_memory=trace_memory) as report:
+        print('\tDay: {}\n\tTimeframe: {}-{}\n\tCalculating frequency...'.format(day, start_hour, end_hour))
+        if chunksize:
+            with report.stage('frequency'):
+                frequency = get_stop_frequency_out_of_core(csv, day, start_hour, end_hour, get_services=True,
+                                                           start_minute=start_minute, end_minute=end_minute,
+                                                           chunksize=chunksize)
+                route_frequency = get_stop_frequency_out_of_core(csv, day, start_hour, end_hour, group_by_routes=True,
+                                                                 start_minute=start_minute, end_minute=end_minute,
+                                                                 chunksize=chunksize)
+        else:
+            with report.stage('load'):
+                df_timetable = load_timetable(csv)
+            report.count('rows_read', len(df_timetable))
+            with report.stage('frequency'):
+                #   Filter once, summarize twice.
+                total = filter_timetable(df_timetable, day, start_hour, end_hour, start_minute=start_minute,
+                                         end_minute=end_minute)
+                frequency = summarize_frequency(total, day, get_services=True)
+                route_frequency = summarize_frequency(total, day, group_by_routes=True)
+
+        print('\tSaving.')
+        saved = []
+        with report.stage('write'):
+            for result, filename in [(frequency, output_file), (route_frequency, output_route_frequency)]:
+                if 'csv' in formats:
+                    result.to_csv(os.path.join(output_folder, filename), index=False)
+                    saved.append(os.path.join(output_folder, filename))
+                if 'xlsx' in formats:
+                    result.to_excel(os.path.join(output_folder, filename.replace('csv', 'xlsx')), index=False)
+                report.count('rows_emitted', len(result))
+    return saved
+
+
 def main():
     """
     Given variables: DAY / START_HOUR / END_HOUR, this function will analyze all timetables in source folder, perform
@@ -173,32 +367,14 @@ def main():
     output_folder = os.path.join(paths['output'],
                                  "{}_{}_{}_to_{}_{}".format(DAY, str(START_HOUR), str(START_MINUTES), str(END_HOUR),
                                                             str(END_MINUTES)))
-    if not os.path.exists(paths['output']):
-        os.mkdir(paths['output'])
-    if not os.path.exists(output_folder):
-        os.mkdir(output_folder)
+    os.makedirs(output_folder, exist_ok=True)
 
     filepaths = [file for file in os.listdir(paths['timetable']) if file.endswith('timetable.csv')]
     for i, file in enumerate(filepaths):
         print(os.path.join(paths['timetable'], file))
-        df_timetable = load_timetable(os.path.join(paths['timetable'], file))
-    
         print("{}/{} - Analyzing timetable from {}.".format(i + 1, len(filepaths), filepaths[i]))
-        print('\tDay: {}\n\tTimeframe: {}-{}\n\tCalculating frequency...'.format(DAY, START_HOUR, END_HOUR))
-        frequency = get_stop_frequency(df_timetable, DAY, START_HOUR, END_HOUR, get_services=True)
-        route_frequency = get_stop_frequency(df_timetable, DAY, START_HOUR, END_HOUR, group_by_routes=True)
-
-        print('\tSaving.')
-        output_file = "{}_{}_{}_{}_to_{}_{}.csv".format(os.path.basename(file).split('_')[0], DAY, str(START_HOUR), str(START_MINUTES), str(END_HOUR),
-                                                        str(END_MINUTES))
-        frequency.to_csv(os.path.join(output_folder, output_file), index=False)
-        frequency.to_excel(os.path.join(output_folder, output_file.replace('csv', 'xlsx')), index=False)
-
-        output_route_frequency = "{}_{}_{}_{}_to_{}_{}_route_frequency.csv".format(os.path.basename(file).split('_')[0], DAY, str(START_HOUR),
-                                                                                   str(START_MINUTES), str(END_HOUR),
-                                                                                   str(END_MINUTES))
-        route_frequency.to_csv(os.path.join(output_folder, output_route_frequency), index=False)
-        route_frequency.to_excel(os.path.join(output_folder, output_route_frequency.replace('csv' , 'xlsx')), index=False)
+        frequency_file(os.path.join(paths['timetable'], file), output_folder, DAY, START_HOUR, END_HOUR,
+                       start_minute=START_MINUTES, end_minute=END_MINUTES, chunksize=CHUNKSIZE)
 
     print("\nFinished.\nTotal runtime: {0:.7}".format(str(datetime.timedelta(time.time() - START))))
 
@@ -0,0 +1,593 @@
+"""
+atco_cif_parser.py
+
+Single pass parser for ATCO-CIF (.cif) files. Every record type listed in the ATCO-CIF 5.10 specification
+(atco-cif-spec1.pdf) is described below, so journeys, notes, date running exceptions, locations, operators and
+the remaining reference records can all be pulled out of one read of the file.
+
+Only the record types you ask for are decoded - every other row is skipped on its two letter record identity,
+without slicing the rest of the line. Likewise, each record type can be trimmed down to the fields you need.
+
+Journeys with a record that can't be decoded - a bad time, date or day of week flag - are not yielded; their bad
+records are flagged and quarantined instead (see record_validation.py), so a corrupt line never stops a file.
+
+"""
+import datetime
+
+from record_validation import BAD_DATE, BAD_DAYS, BAD_TIME, Quarantine, get_quarantine_record, is_date
+
+# This dictionary contains information on how to parse every record described in the ATCO-CIF specification.
+ATCO_CIF_SPECIFICATION = {
+    # 0. File header.
+    'AT': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'file_type': (8, 1),
+        'version_major': (2, 9),
+        'version_minor': (2, 11),
+        'file_originator': (32, 13),
+        'source_product': (16, 45),
+        'production_date': (8, 61),
+        'production_time': (6, 69)},
+    # 1a. Journey header.
+    'QS': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'operator': (4, 4),
+        'unique_journey_identifier': (6, 8),
+        'first_date_of_operation': (8, 14),
+        'last_date_of_operation': (8, 22),
+        'operates_on_mondays': (1, 30),
+        'operates_on_tuesdays': (1, 31),
+        'operates_on_wednesdays': (1, 32),
+        'operates_on_thursdays': (1, 33),
+        'operates_on_fridays': (1, 34),
+        'operates_on_saturdays': (1, 35),
+        'operates_on_sundays': (1, 36),
+        'school_term_time': (1, 37),
+        'bank_holidays': (1, 38),
+        'route_number_(identifier)': (4, 39),
+        'running_board': (6, 43),
+        'vehicle_type': (8, 49),
+        'registration_number': (8, 57),
+        'route_direction': (1, 65)},
+    # 1b. Journey date running.
+    'QE': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'start_of_exceptional_period': (8, 3),
+        'end_of_exceptional_period': (8, 11),
+        'operation_code': (1, 19)},
+    # 1c. Journey note.
+    'QN': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'note_code': (5, 3),
+        'note_text': (72, 8)},
+    # 1d. Journey origin.
+    'QO': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (12, 3),
+        'published_departure_time': (4, 15),
+        'bay_number': (3, 19),
+        'timing_point_indicator': (2, 22),
+        'fare_stage_indicator': (2, 24)},
+    # 1e. Journey intermediate.
+    'QI': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (12, 3),
+        'published_arrival_time': (4, 15),
+        'published_departure_time': (4, 19),
+        'activity_flag': (1, 23),
+        'bay_number': (3, 24),
+        'timing_point_indicator': (2, 27),
+        'fare_stage_indicator': (2, 29)},
+    # 1f. Journey destination.
+    'QT': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (12, 3),
+        'published_arrival_time': (4, 15),
+        'bay_number': (3, 19),
+        'timing_point_indicator': (2, 22),
+        'fare_stage_indicator': (2, 24)},
+    # 1g. Journey repetition.
+    'QR': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (12, 3),
+        'published_departure_time': (4, 15),
+        'unique_journey_identifier': (6, 19),
+        'running_board': (6, 25),
+        'vehicle_type': (8, 31)},
+    # 2a. Location.
+    'QL': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'location': (12, 4),
+        'full_location': (48, 16),
+        'gazetteer_code': (1, 64),
+        'point_type': (1, 65),
+        'national_gazetteer_id': (8, 66)},
+    # 2b. Additional location information.
+    'QB': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'location': (12, 4),
+        'grid_reference_easting': (8, 16),
+        'grid_reference_northing': (8, 24),
+        'district_name': (24, 32),
+        'town_name': (24, 56)},
+    # 2c. Alternative location.
+    'QA': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'location': (12, 4),
+        'full_location': (48, 16),
+        'gazetteer_code': (1, 64)},
+    # 3. Cluster.
+    'QC': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'cluster_code': (12, 4),
+        'cluster_name': (48, 16),
+        'location': (12, 64)},
+    # 4a. Operator.
+    'QP': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'operator': (4, 4),
+        'operator_short_form': (24, 8),
+        'operator_legal_name': (48, 32),
+        'enquiry_phone': (12, 80),
+        'contact_phone': (12, 92)},
+    # 4b. Operator continuation.
+    'QQ': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'operator_address': (78, 3)},
+    # 5a. Location interchange - four interchanges per record.
+    'QG': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'first_location_1': (12, 4),
+        'second_location_1': (12, 16),
+        'interchange_time_1': (3, 28),
+        'first_location_2': (12, 31),
+        'second_location_2': (12, 43),
+        'interchange_time_2': (3, 55),
+        'first_location_3': (12, 58),
+        'second_location_3': (12, 70),
+        'interchange_time_3': (3, 82),
+        'first_location_4': (12, 85),
+        'second_location_4': (12, 97),
+        'interchange_time_4': (3, 109)},
+    # 5b. Cluster interchange - seven clusters per record.
+    'QJ': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'cluster_1': (12, 4),
+        'interchange_time_1': (3, 16),
+        'cluster_2': (12, 19),
+        'interchange_time_2': (3, 31),
+        'cluster_3': (12, 34),
+        'interchange_time_3': (3, 46),
+        'cluster_4': (12, 49),
+        'interchange_time_4': (3, 61),
+        'cluster_5': (12, 64),
+        'interchange_time_5': (3, 76),
+        'cluster_6': (12, 79),
+        'interchange_time_6': (3, 91),
+        'cluster_7': (12, 94),
+        'interchange_time_7': (3, 106)},
+    # 5c. Cluster walk links - four links per record.
+    'QW': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'origin_cluster_1': (12, 4),
+        'destination_cluster_1': (12, 16),
+        'interchange_time_1': (3, 28),
+        'origin_cluster_2': (12, 31),
+        'destination_cluster_2': (12, 43),
+        'interchange_time_2': (3, 55),
+        'origin_cluster_3': (12, 58),
+        'destination_cluster_3': (12, 70),
+        'interchange_time_3': (3, 82),
+        'origin_cluster_4': (12, 85),
+        'destination_cluster_4': (12, 97),
+        'interchange_time_4': (3, 109)},
+    # 6. Vehicle type.
+    'QV': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'vehicle_type': (8, 4),
+        'vehicle_long_type': (24, 12)},
+    # 7. Route description.
+    'QD': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'operator': (4, 4),
+        'route_number': (4, 8),
+        'route_direction': (1, 12),
+        'route_description': (68, 13)},
+    # 8. Bank holiday dates.
+    'QH': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'date_of_bank_holiday': (8, 4)},
+    # 9a. Route association.
+    'QX': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'operator_1': (4, 4),
+        'route_number_1': (4, 8),
+        'route_direction_1': (1, 12),
+        'operator_2': (4, 13),
+        'route_number_2': (4, 17),
+        'route_direction_2': (1, 21),
+        'first_date_of_operation': (8, 22),
+        'last_date_of_operation': (8, 30),
+        'operates_on_mondays': (1, 38),
+        'operates_on_tuesdays': (1, 39),
+        'operates_on_wednesdays': (1, 40),
+        'operates_on_thursdays': (1, 41),
+        'operates_on_fridays': (1, 42),
+        'operates_on_saturdays': (1, 43),
+        'operates_on_sundays': (1, 44),
+        'location': (12, 45),
+        'association_type': (1, 57)},
+    # 9b. Journey association.
+    'QY': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'operator_1': (4, 4),
+        'journey_identifier_1': (6, 8),
+        'operator_2': (4, 14),
+        'journey_identifier_2': (6, 18),
+        'first_date_of_operation': (8, 24),
+        'last_date_of_operation': (8, 32),
+        'operates_on_mondays': (1, 40),
+        'operates_on_tuesdays': (1, 41),
+        'operates_on_wednesdays': (1, 42),
+        'operates_on_thursdays': (1, 43),
+        'operates_on_fridays': (1, 44),
+        'operates_on_saturdays': (1, 45),
+        'operates_on_sundays': (1, 46),
+        'location': (12, 47),
+        'association_type': (1, 59)},
+}
+
+# Records making up a single journey and the key under which they are collected in a journey dictionary.
+JOURNEY_RECORDS = {
+    'QE': 'exceptions',
+    'QN': 'notes',
+    'QO': 'stops',
+    'QI': 'stops',
+    'QT': 'stops',
+    'QR': 'repetitions',
+}
+
+# Records following a location record and describing the same location.
+LOCATION_RECORDS = ['QB', 'QA']
+
+# Records with hhmm times converted to datetime.time objects.
+TIMED_RECORDS = ['QO', 'QI', 'QT', 'QR']
+
+# Journey header fields holding dates (yyyymmdd) - journeys can't be dated without a first date of operation.
+DATE_FIELDS = ['first_date_of_operation', 'last_date_of_operation']
+
+# Journey header fields holding day of week flags.
+DAY_FIELDS = ['operates_on_mondays', 'operates_on_tuesdays', 'operates_on_wednesdays', 'operates_on_thursdays',
+              'operates_on_fridays', 'operates_on_saturdays', 'operates_on_sundays']
+
+# Records needed to convert a .cif file into a timetable.
+TIMETABLE_RECORDS = ['QS', 'QO', 'QI', 'QT']
+
+# hhmm -> datetime.time lookup; there are only 1440 valid values so decoding a time is a single dictionary lookup.
+_TIMES = {'{:02d}{:02d}'.format(hour, minute): datetime.time(hour=hour, minute=minute)
+          for hour in range(24) for minute in range(60)}
+
+
+def decode_time(value):
+    """
+    Convert a hhmm string into a datetime.time object. Only exactly four digits of a valid time are accepted - the
+    looser forms strptime would read, e.g. '930' as 09:30, are bad times.
+    :param value: stripped hhmm string
+    :return: datetime.time object, None for a blank value
+    :raises ValueError: for anything but a blank value or a valid hhmm time
+    """
+    if not value:
+        return None
+    try:
+        return _TIMES[value]
+    except KeyError:
+        raise ValueError("Invalid hhmm time: {!r}".format(value)) from None
+
+
+def compile_specification(record_identity, fields=None, specification=ATCO_CIF_SPECIFICATION):
+    """
+    Turn a record specification into a list of (key, start, end, is_time) slices ready to be applied on a row.
+    :param record_identity: two letter record identity
+    :param fields: optional list of fields to keep - all fields are decoded when not provided
+    :param specification: specification dictionary to compile from
+    :return: list of slices
+    """
+    layout = []
+    for key, (size, position) in specification[record_identity].items():
+        if fields is not None and key not in fields and key != 'record_identity':
+            continue
+        start = position - 1
+        layout.append((key, start, start + size, record_identity in TIMED_RECORDS and 'time' in key))
+    return layout
+
+
+def decode_record(signature, layout):
+    """
+    Given a row signature from a .cif file and a compiled layout, return the parsed data as dictionary.
+    :param signature: one record from .cif file
+    :param layout: list of slices returned by compile_specification
+    :return: dictionary with data parsed from .cif record
+    """
+    d = {}
+    for key, start, end, is_time in layout:
+        value = signature[start:end].strip()
+        if is_time:
+            value = decode_time(value)
+        d[key] = value
+    return d
+
+
+def validate_record(signature, layout):
+    """
+    Decode a record field by field, flagging fields which can't be decoded - used for records decode_record fails on.
+    :param signature: one record from .cif file
+    :param layout: list of slices returned by compile_specification
+    :return: tuple of (dictionary with bad fields set to None, bit flags of problems found, list of bad fields)
+    """
+    d = {}
+    flags = 0
+    fields = []
+    for key, start, end, is_time in layout:
+        value = signature[start:end].strip()
+        if is_time:
+            try:
+                value = decode_time(value)
+            except ValueError:
+                value = None
+                flags |= BAD_TIME
+                fields.append(key)
+        d[key] = value
+    return d, flags, fields
+
+
+def check_journey_header(header):
+    """
+    Check dates and day of week flags of a decoded journey header. The last date of operation may be left blank.
+    :param header: decoded QS record
+    :return: tuple of (bit flags of problems found, list of bad fields)
+    """
+    flags = 0
+    fields = []
+    for key in DATE_FIELDS:
+        value = header.get(key)
+        if value is None or (not value and key == 'last_date_of_operation'):
+            continue
+        if not is_date(value) and not (key == 'last_date_of_operation' and value.isdigit()):
+            flags |= BAD_DATE
+            fields.append(key)
+    for key in DAY_FIELDS:
+        if header.get(key, '0') not in ('0', '1'):
+            flags |= BAD_DAYS
+            fields.append(key)
+    return flags, fields
+
+
+def resolve_records(records=None):
+    """
+    Work out which record types have to be decoded. Journey records cannot be grouped without their journey header
+    and location records cannot be grouped without their location record, so both are pulled in when needed.
+    :param records: iterable of record identities, all records in the specification when not provided
+    :return: set of record identities
+    """
+    if records is None:
+        return set(ATCO_CIF_SPECIFICATION.keys())
+    records = set(records)
+    unknown = records - set(ATCO_CIF_SPECIFICATION.keys())
+    if unknown:
+        raise ValueError("{} - record types not found in ATCO-CIF specification.".format(sorted(unknown)))
+    if records & set(JOURNEY_RECORDS.keys()):
+        records.add('QS')
+    if records & set(LOCATION_RECORDS):
+        records.add('QL')
+    return records
+
+
+def new_journey(header):
+    """
+    Set up a journey container for a decoded journey header.
+    :param header: decoded QS record
+    :return: journey dictionary
+    """
+    header['unique_identifier'] = str(header.get('operator', '')) + str(header.get('unique_journey_identifier', ''))
+    return {'header': header, 'exceptions': [], 'notes': [], 'stops': [], 'repetitions': []}
+
+
+def iter_atco_cif(f, records=None, fields=None, tables=None, quarantine=None):
+    """
+    Read a .cif file once and yield its journeys one at a time. Records which are not a part of a journey (locations,
+    operators, clusters etc.) are collected in the tables dictionary, if one is provided.
+
+    Each journey is a dictionary holding:
+    * header - decoded QS record with an additional 'unique_identifier' (operator + unique journey identifier)
+    * exceptions - list of decoded QE records
+    * notes - list of decoded QN records
+    * stops - list of decoded QO/QI/QT records
+    * repetitions - list of decoded QR records
+
+    Locations are decoded QL records merged with their QB record, if any. QA records are kept in their own table.
+
+    :param f: .cif file (or any iterable of rows) to be processed
+    :param records: iterable of record identities to decode - everything else is skipped without being decoded
+    :param fields: optional dictionary of record identity: list of fields to decode
+    :param tables: optional dictionary to be filled with 'locations', other decoded records under their record
+    identity, 'decoded' - a count of decoded rows, 'skipped' - a count of rows skipped per record identity and
+    'quarantined' - a count of journeys left out because of bad records
+    :param quarantine: optional record_validation.Quarantine to write bad records of left out journeys to
+    :return: generator of journey dictionaries
+    """
+    records = resolve_records(records)
+    fields = fields or {}
+    layouts = {record_identity: compile_specification(record_identity, fields.get(record_identity))
+               for record_identity in records}
+    if tables is None:
+        tables = {}
+    tables.setdefault('skipped', {})
+    tables.setdefault('decoded', 0)
+    if 'QL' in records:
+        tables.setdefault('locations', [])
+    for record_identity in records - set(JOURNEY_RECORDS.keys()) - {'QS', 'QL', 'QB'}:
+        tables.setdefault(record_identity, [])
+    skipped = tables['skipped']
+    if quarantine is None:
+        quarantine = Quarantine()
+    quarantined = quarantine.journeys
+
+    journey = None
+    # Bad records of the current journey.
+    bad = []
+    location = None
+    decoded = 0
+    try:
+        for row in f:
+            record_identity = row[0:2]
+            layout = layouts.get(record_identity)
+            if layout is None:
+                skipped[record_identity] = skipped.get(record_identity, 0) + 1
+                continue
+            try:
+                d = decode_record(row, layout)
+            except ValueError:
+                d, flags, bad_fields = validate_record(row, layout)
+                if journey is not None:
+                    bad.append(get_quarantine_record(row, flags, bad_fields, journey['header']['unique_identifier']))
+            decoded += 1
+
+            if record_identity in JOURNEY_RECORDS:
+                if journey is not None:
+                    journey[JOURNEY_RECORDS[record_identity]].append(d)
+                else:
+                    skipped[record_identity] = skipped.get(record_identity, 0) + 1
+                continue
+            # Any other record closes the current journey.
+            if journey is not None:
+                if bad:
+                    quarantine.write(bad)
+                    bad = []
+                else:
+                    yield journey
+                journey = None
+            if record_identity == 'QS':
+                journey = new_journey(d)
+                flags, bad_fields = check_journey_header(d)
+                if flags:
+                    bad.append(get_quarantine_record(row, flags, bad_fields, d['unique_identifier']))
+            elif record_identity == 'QL':
+                location = d
+                tables['locations'].append(location)
+            elif record_identity == 'QB':
+                if location is not None and location['location'] == d.get('location', location['location']):
+                    location.update({key: value for key, value in d.items()
+                                     if key not in ('record_identity', 'transaction_type')})
+                else:
+                    skipped[record_identity] = skipped.get(record_identity, 0) + 1
+            else:
+                tables[record_identity].append(d)
+
+        if journey is not None:
+            if bad:
+                quarantine.write(bad)
+            else:
+                yield journey
+    finally:
+        tables['decoded'] = decoded
+        tables['quarantined'] = quarantine.journeys - quarantined
+
+
+def read_atco_cif(f, records=None, fields=None):
+    """
+    Read a whole .cif file in a single pass.
+    :param f: .cif file to be processed
+    :param records: iterable of record identities to decode - see iter_atco_cif
+    :param fields: optional dictionary of record identity: list of fields to decode
+    :return: dictionary with 'journeys', 'locations', 'decoded', 'skipped' and a list of decoded records for every other
+    requested record identity
+    """
+    tables = {}
+    tables['journeys'] = list(iter_atco_cif(f, records=records, fields=fields, tables=tables))
+    return tables
+
+
+def check_duplicate_stops(stops):
+    """
+    Check whether any location is visited more than once during a journey.
+    :param stops: list of decoded stop records
+    :return: 1 if there are duplicated stops, 0 otherwise
+    """
+    locations = [stop['location'] for stop in stops]
+    return int(len(set(locations)) != len(locations))
+
+
+def flatten_journey(journey):
+    """
+    Create a list of stops making up a particular journey, in the same form as create_journey_timetable in
+    CIF_timetable_converter.py - each stop holds the id and arrival time of the next stop as well as all journey
+    header data.
+    :param journey: journey dictionary yielded by iter_atco_cif
+    :return: list of dictionaries containing information on stops in a particular journey
+    """
+    # Extract data from journey head - get everything except record identity
+    journey_header_data = {key: value for (key, value) in journey['header'].items() if key != 'record_identity'}
+    stops = journey['stops']
+    has_duplicates = check_duplicate_stops(stops)
+
+    timetable = []
+    for i, stop in enumerate(stops):
+        stop = dict(stop)
+        if i + 1 < len(stops):
+            stop['next_stop_id'] = stops[i + 1]['location']
+            stop['next_stop_arrival_time'] = stops[i + 1].get('published_arrival_time')
+        stop['has_duplicated_stops'] = has_duplicates
+        stop.update(journey_header_data)
+        timetable.append(stop)
+    return timetable
+
+
+def flatten_journey_records(journeys, key):
+    """
+    Flatten journey notes, exceptions or repetitions into a table keyed by the journey unique identifier.
+    :param journeys: iterable of journey dictionaries
+    :param key: 'notes', 'exceptions' or 'repetitions'
+    :return: list of dictionaries
+    """
+    table = []
+    for journey in journeys:
+        for record in journey[key]:
+            d = {'unique_identifier': journey['header']['unique_identifier']}
+            d.update(record)
+            table.append(d)
+    return table
@@ -0,0 +1,451 @@
+"""
+benchmark.py
+
+Performance benchmark of the converters and frequency counters. Synthetic ATCO-CIF and rail .cif files of a given
+size are generated from the record specifications, then each stage of the conversion is timed separately:
+
+    read      - read the raw file into memory
+    filter    - keep the records needed for a timetable
+    segment   - split the records into journeys
+    decode    - parse the fixed width fields and link each stop with the next one
+    frame     - build the timetable dataframe
+    write     - save the timetable to .csv
+    frequency - load the .csv back and calculate stop frequency
+
+For every stage the run time, rows/s, MB/s and peak RSS are reported. Results can be saved as .json and compared
+against a previous run to catch regressions:
+
+    python benchmark.py --format atco rail --size 10 100 -o bench --save results.json
+    python benchmark.py --format atco --size 100 -o bench --compare results.json
+
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+from atco_cif_parser import ATCO_CIF_SPECIFICATION, TIMETABLE_RECORDS, compile_specification, decode_record, \
+    new_journey
+import CIF_timetable_converter
+import ScotRail_CIF_timetable_converter
+import ScotRail_TRACC_stop_frequency_counter
+import stop_frequency_counter
+from instrumentation import get_peak_rss
+from rail_cif_parser import RAIL_CIF_SPECIFICATION
+from timetable_model import TimetableModel
+
+STAGES = ['read', 'filter', 'segment', 'decode', 'frame', 'write', 'frequency']
+
+VEHICLE_TYPES = ['Bus', 'Coach', 'Tram', 'Metro', 'Ferry']
+
+
+def compile_layout(specification, record_identity, width=80):
+    """
+    Turn a record specification into a list of (key, start, size) slices sorted by position.
+    :param specification: specification dictionary
+    :param record_identity: two letter record identity
+    :param width: minimal record width
+    :return: tuple of (list of slices, record width)
+    """
+    layout = sorted(((key, position - 1, size) for key, (size, position) in specification[record_identity].items()
+                     if key != 'record_identity' and not key.startswith('spare')), key=lambda x: x[1])
+    width = max([width] + [start + size for key, start, size in layout])
+    return layout, width
+
+
+def format_record(record_identity, values, layout):
+    """
+    Write a fixed width record - the reverse of decode_record.
+    :param record_identity: two letter record identity
+    :param values: dictionary of field: value, missing fields are left blank
+    :param layout: tuple returned by compile_layout
+    :return: record string without a line break
+    """
+    fields, width = layout
+    row = [record_identity]
+    position = 2
+    for key, start, size in fields:
+        if start < position:
+            # Overlapping fields - the earlier field wins.
+            continue
+        row.append(' ' * (start - position))
+        row.append(str(values.get(key, ''))[:size].ljust(size))
+        position = start + size
+    row.append(' ' * (width - position))
+    return ''.join(row)
+
+
+def hhmm(minutes):
+    return '{:02d}{:02d}'.format(minutes // 60 % 24, minutes % 60)
+
+
+def make_routes(rng, n_stops, n_routes, prefix, min_length=3, max_length=40):
+    """
+    Create a set of stop codes and routes - ordered stop sequences drawn from them.
+    """
+    stops = ['{}{:06d}'.format(prefix, i) for i in range(n_stops)]
+    routes = []
+    for i in range(n_routes):
+        length = rng.randint(min_length, min(max_length, n_stops))
+        routes.append(rng.sample(stops, length))
+    return stops, routes
+
+
+def generate_atco_cif(path, size_mb, seed=0):
+    """
+    Generate a synthetic ATCO-CIF file of roughly the given size. Journeys follow a set of random routes with random
+    start times and run times, some of them carry notes and date running exceptions, and every stop gets a location
+    record with grid references at the end of the file.
+    :param path: path of the .cif file to create
+    :param size_mb: target size in MB
+    :param seed: random seed
+    :return: path
+    """
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 ** 2)
+    n_stops = max(50, int(size_mb * 200))
+    stops, routes = make_routes(rng, n_stops, max(10, n_stops // 10), '9100SYN')
+    layouts = {record_identity: compile_layout(ATCO_CIF_SPECIFICATION, record_identity)
+               for record_identity in ['QS', 'QE', 'QN', 'QO', 'QI', 'QT', 'QL', 'QB']}
+    # Leave room for location records.
+    target -= n_stops * 160
+
+    with open(path, 'w') as f:
+        f.write('ATCO-CIF0510Synthetic benchmark data            benchmark.py    20190701120000'.ljust(80) + '\n')
+        written = 81
+        journey_id = 0
+        while written < target:
+            route_id = rng.randrange(len(routes))
+            route = routes[route_id]
+            days = rng.choice(['1111100', '0000011', '1111111', '0000010', '1000000'])
+            journey_id += 1
+            records = [format_record('QS', {
+                'transaction_type': 'N',
+                'operator': 'SY{:02d}'.format(route_id % 100),
+                'unique_journey_identifier': journey_id % 1000000,
+                'first_date_of_operation': '20190701',
+                'last_date_of_operation': '20190707',
+                'operates_on_mondays': days[0], 'operates_on_tuesdays': days[1],
+                'operates_on_wednesdays': days[2], 'operates_on_thursdays': days[3],
+                'operates_on_fridays': days[4], 'operates_on_saturdays': days[5],
+                'operates_on_sundays': days[6],
+                'route_number_(identifier)': route_id % 10000,
+                'running_board': rng.randint(1, 99),
+                'vehicle_type': VEHICLE_TYPES[route_id % len(VEHICLE_TYPES)],
+                'route_direction': rng.choice('IO')}, layouts['QS'])]
+            if rng.random() < 0.05:
+                records.append(format_record('QE', {
+                    'start_of_exceptional_period': '20190703', 'end_of_exceptional_period': '20190704',
+                    'operation_code': '0'}, layouts['QE']))
+            if rng.random() < 0.1:
+                records.append(format_record('QN', {'note_code': 'SYN', 'note_text': 'Synthetic journey note'},
+                                             layouts['QN']))
+            t = rng.randint(300, 1380)
+            records.append(format_record('QO', {'location': route[0], 'published_departure_time': hhmm(t),
+                                                'timing_point_indicator': 'T1'}, layouts['QO']))
+            for stop in route[1:-1]:
+                t += rng.randint(1, 6)
+                records.append(format_record('QI', {'location': stop, 'published_arrival_time': hhmm(t),
+                                                    'published_departure_time': hhmm(t), 'activity_flag': 'B',
+                                                    'timing_point_indicator': 'T0'}, layouts['QI']))
+            t += rng.randint(1, 6)
+            records.append(format_record('QT', {'location': route[-1], 'published_arrival_time': hhmm(t),
+                                                'timing_point_indicator': 'T1'}, layouts['QT']))
+            chunk = '\n'.join(records) + '\n'
+            f.write(chunk)
+            written += len(chunk)
+
+        for i, stop in enumerate(stops):
+            f.write(format_record('QL', {'transaction_type': 'N', 'location': stop,
+                                         'full_location': 'Synthetic stop {}'.format(i), 'point_type': 'S'},
+                                  layouts['QL']) + '\n')
+            f.write(format_record('QB', {'transaction_type': 'N', 'location': stop,
+                                         'grid_reference_easting': rng.randint(200000, 400000),
+                                         'grid_reference_northing': rng.randint(600000, 900000)},
+                                  layouts['QB']) + '\n')
+    return path
+
+
+def generate_rail_cif(path, size_mb, seed=0):
+    """
+    Generate a synthetic rail .cif file of roughly the given size. Schedules follow a set of random routes, about a
+    fifth of intermediate locations are passing points without public times.
+    :param path: path of the .cif file to create
+    :param size_mb: target size in MB
+    :param seed: random seed
+    :return: path
+    """
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 ** 2)
+    n_stops = max(50, int(size_mb * 50))
+    stops, routes = make_routes(rng, n_stops, max(10, n_stops // 5), 'SY', min_length=2, max_length=30)
+    layouts = {record_identity: compile_layout(RAIL_CIF_SPECIFICATION, record_identity)
+               for record_identity in ['HD', 'BS', 'LO', 'LI', 'LT', 'ZZ']}
+
+    with open(path, 'w') as f:
+        f.write(format_record('HD', {'file_identity': 'TPS.USYNTH.PD190701', 'date_of_extract': '010719',
+                                     'time_of_extract': '1200', 'current_file_reference': 'SYNTH01',
+                                     'update_indicator': 'F', 'version': 'A', 'extract_start_date': '010719',
+                                     'extract_end_date': '311219'}, layouts['HD']) + '\n')
+        written = 81
+        schedule_id = 0
+        while written < target:
+            route = routes[rng.randrange(len(routes))]
+            schedule_id += 1
+            records = [format_record('BS', {
+                'transaction_type': 'N', 'train_uid': 'S{:05d}'.format(schedule_id % 100000),
+                'date_runs_from': '190701', 'date_runs_to': '191231',
+                'days_run': rng.choice(['1111100', '0000011', '1111111', '0000010']),
+                'train_status': 'P', 'train_category': 'OO', 'train_identity': '2S{:02d}'.format(schedule_id % 100),
+                'course_indicator': '1', 'profit_centre_code': '12345678', 'power_type': 'EMU', 'speed': '100',
+                'train_class': 'S', 'stp_indicator': 'P'}, layouts['BS'])]
+            t = rng.randint(300, 1380)
+            records.append(format_record('LO', {'location': route[0], 'scheduled_departure_time': hhmm(t),
+                                                'public_departure_time': hhmm(t), 'platform': '1',
+                                                'activity': 'TB'}, layouts['LO']))
+            for stop in route[1:-1]:
+                t += rng.randint(2, 8)
+                if rng.random() < 0.2:
+                    records.append(format_record('LI', {'location': stop, 'scheduled_pass': hhmm(t),
+                                                        'public_arrival_time': '0000',
+                                                        'public_departure_time': '0000'}, layouts['LI']))
+                else:
+                    records.append(format_record('LI', {'location': stop, 'scheduled_arrival_time': hhmm(t),
+                                                        'scheduled_departure_time': hhmm(t + 1),
+                                                        'public_arrival_time': hhmm(t),
+                                                        'public_departure_time': hhmm(t + 1),
+                                                        'activity': 'T'}, layouts['LI']))
+                    t += 1
+            t += rng.randint(2, 8)
+            records.append(format_record('LT', {'location': route[-1], 'scheduled_arrival_time': hhmm(t),
+                                                'public_arrival_time': hhmm(t), 'activity': 'TF'}, layouts['LT']))
+            chunk = '\n'.join(records) + '\n'
+            f.write(chunk)
+            written += len(chunk)
+        f.write(format_record('ZZ', {}, layouts['ZZ']) + '\n')
+    return path
+
+
+def run_stage(results, stage, nbytes, function, *args):
+    """
+    Time a single stage and add its measurements to results.
+    :param results: dictionary to store stage results in
+    :param stage: name of the stage
+    :param nbytes: bytes of input the stage works through
+    :param function: function to time, returning (output, number of rows)
+    :return: output of the function
+    """
+    start = time.perf_counter()
+    output, rows = function(*args)
+    seconds = time.perf_counter() - start
+    results[stage] = {
+        'seconds': round(seconds, 4),
+        'rows': rows,
+        'rows_per_s': round(rows / seconds, 1) if seconds else None,
+        'mb_per_s': round(nbytes / 1024 ** 2 / seconds, 2) if seconds else None,
+        'peak_rss_mb': get_peak_rss(),
+    }
+    return output
+
+
+def segment_journeys(raw_timetable, header_prefix):
+    """
+    Split records into journeys - lists of records starting with a journey header.
+    """
+    journeys = []
+    journey = None
+    for row in raw_timetable:
+        if row.startswith(header_prefix):
+            journey = [row]
+            journeys.append(journey)
+        elif journey is not None:
+            journey.append(row)
+    return journeys, len(journeys)
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    return lines, len(lines)
+
+
+def decode_atco(journeys):
+    layouts = {record_identity: compile_specification(record_identity) for record_identity in TIMETABLE_RECORDS}
+    model = TimetableModel()
+    for rows in journeys:
+        journey = new_journey(decode_record(rows[0], layouts['QS']))
+        journey['stops'] = [decode_record(row, layouts[row[0:2]]) for row in rows[1:]]
+        model.add_journey(journey)
+    return model, len(model)
+
+
+def decode_rail(journeys):
+    timetable = []
+    for rows in journeys:
+        if len(rows) < 3:
+            continue
+        journey_header = ScotRail_CIF_timetable_converter.get_journey_data(rows[0])
+        timetable.extend(ScotRail_CIF_timetable_converter.create_journey_timetable(
+            list(range(1, len(rows))), journey_header, rows))
+    return timetable, len(timetable)
+
+
+def build_atco_frame(model):
+    df = model.to_frame()[CIF_timetable_converter.TIMETABLE_COLUMNS]
+    return df, len(df)
+
+
+def build_rail_frame(timetable):
+    df = pd.DataFrame(timetable)
+    for i, day in enumerate(['mondays', 'tuesdays', 'wednesdays', 'thursdays', 'fridays', 'saturdays', 'sundays']):
+        df['operates_on_' + day] = df['days_run'].str[i]
+    df = df[ScotRail_CIF_timetable_converter.TIMETABLE_COLUMNS]
+    return df, len(df)
+
+
+def write_frame(df, path):
+    df.to_csv(path, index=False)
+    return path, len(df)
+
+
+def atco_frequency(path):
+    df = stop_frequency_counter.load_timetable(path)
+    frequency = stop_frequency_counter.get_stop_frequency(df, 'tuesday', 8, 9)
+    return frequency, len(df)
+
+
+def rail_frequency(path):
+    df = ScotRail_TRACC_stop_frequency_counter.load_timetable(path)
+    frequency = ScotRail_TRACC_stop_frequency_counter.get_stop_frequency(df, 'tuesday', 8, 9)
+    return frequency, len(df)
+
+
+def benchmark_file(path, cif_format, output_folder, stages=STAGES):
+    """
+    Run all stages over a single .cif file.
+    :param path: path to .cif file
+    :param cif_format: 'atco' or 'rail'
+    :param output_folder: folder to write the timetable in
+    :param stages: stages to run - each stage needs the previous ones
+    :return: dictionary of stage: measurements
+    """
+    nbytes = os.path.getsize(path)
+    results = {}
+    if cif_format == 'atco':
+        extract, header_prefix, decode, build, frequency = CIF_timetable_converter.extract_raw_timetable, 'QS', \
+            decode_atco, build_atco_frame, atco_frequency
+    else:
+        extract, header_prefix, decode, build, frequency = \
+            ScotRail_CIF_timetable_converter.extract_raw_scotrail_timetable, 'BS', decode_rail, build_rail_frame, \
+            rail_frequency
+    csv = os.path.join(output_folder, os.path.splitext(os.path.basename(path))[0] + '_timetable.csv')
+
+    output = None
+    for stage in STAGES[:max(STAGES.index(stage) for stage in stages) + 1]:
+        if stage == 'read':
+            output = run_stage(results, stage, nbytes, read_lines, path)
+        elif stage == 'filter':
+            output = run_stage(results, stage, nbytes, lambda lines: (extract(lines), len(lines)), output)
+        elif stage == 'segment':
+            output = run_stage(results, stage, nbytes, segment_journeys, output, header_prefix)
+        elif stage == 'decode':
+            output = run_stage(results, stage, nbytes, decode, output)
+        elif stage == 'frame':
+            output = run_stage(results, stage, nbytes, build, output)
+        elif stage == 'write':
+            output = run_stage(results, stage, nbytes, write_frame, output, csv)
+        elif stage == 'frequency':
+            output = run_stage(results, stage, os.path.getsize(csv), frequency, output)
+    return results
+
+
+def print_results(name, results):
+    print("\n{}".format(name))
+    print("{:<10}{:>10}{:>12}{:>14}{:>10}{:>14}".format('stage', 'seconds', 'rows', 'rows/s', 'MB/s', 'peak RSS MB'))
+    for stage, r in results.items():
+        print("{:<10}{:>10.3f}{:>12}{:>14.0f}{:>10.2f}{:>14.1f}".format(
+            stage, r['seconds'], r['rows'], r['rows_per_s'] or 0, r['mb_per_s'] or 0, r['peak_rss_mb'] or 0))
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Compare stage throughput against a previous run.
+    :param results: dictionary of run name: stage results
+    :param baseline: the same structure loaded from a previous run
+    :param tolerance: relative drop in MB/s reported as a regression
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for name, stages in results.items():
+        for stage, r in stages.items():
+            try:
+                before = baseline[name][stage]['mb_per_s']
+            except KeyError:
+                continue
+            if before and r['mb_per_s'] is not None and r['mb_per_s'] < before * (1 - tolerance):
+                regressions.append("{} {}: {:.2f} MB/s, was {:.2f} MB/s".format(name, stage, r['mb_per_s'], before))
+    return regressions
+
+
+def run_benchmark(formats, sizes, output_folder, stages=STAGES, seed=0, regenerate=False, save=None, compare=None,
+                  tolerance=0.1):
+    """
+    Generate synthetic files (unless already there) and benchmark every format and size.
+    :return: tuple of (dictionary of run name: stage results, list of regressions)
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    generators = {'atco': generate_atco_cif, 'rail': generate_rail_cif}
+    results = {}
+    for cif_format in formats:
+        for size in sizes:
+            name = '{}_{:g}MB'.format(cif_format, size)
+            path = os.path.join(output_folder, 'synthetic_{}.cif'.format(name))
+            if regenerate or not os.path.exists(path):
+                print("Generating {}".format(path))
+                generators[cif_format](path, size, seed=seed)
+            results[name] = benchmark_file(path, cif_format, output_folder, stages=stages)
+            print_results(name, results[name])
+
+    regressions = []
+    if compare:
+        with open(compare, 'r') as f:
+            regressions = compare_results(results, json.load(f), tolerance=tolerance)
+        print("\n{} regressions found.".format(len(regressions)))
+        for regression in regressions:
+            print("\t" + regression)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results, regressions
+
+
+def get_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description="Benchmark converters and frequency counters.")
+    parser.add_argument('--format', nargs='+', choices=['atco', 'rail'], default=['atco', 'rail'],
+                        help="synthetic .cif flavours to benchmark")
+    parser.add_argument('--size', nargs='+', type=float, default=[10], help="synthetic file sizes in MB")
+    parser.add_argument('-o', '--output', default='benchmark', help="folder for synthetic files and outputs")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="stages to run")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of synthetic data")
+    parser.add_argument('--regenerate', action='store_true', help="regenerate synthetic files")
+    parser.add_argument('--save', help="save results to .json")
+    parser.add_argument('--compare', help="compare results with a previously saved .json")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="relative slowdown reported as a regression")
+    return parser
+
+
+def main(args=None):
+    if not isinstance(args, argparse.Namespace):
+        args = get_parser().parse_args(args)
+    results, regressions = run_benchmark(args.format, args.size, args.output, stages=args.stages, seed=args.seed,
+                                         regenerate=args.regenerate, save=args.save, compare=args.compare,
+                                         tolerance=args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,775 @@
+"""
+cif_timetable_reader.py
+
+Command line entry point for the whole toolset, so nothing has to be edited in the source to process a batch
+of files:
+
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --workers 4
+    python cif_timetable_reader.py frequency "timetables/*_timetable.csv" -o stop_frequency --day tuesday friday
+        --window 07:00-10:00 16:00-19:00
+    python cif_timetable_reader.py frequency "timetables/*_timetable.csv" -o stop_frequency --workers 4 --shared-memory
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --pipeline --workers 4
+    python cif_timetable_reader.py convert "CIF_data/*.zip" "CIF_data/*.cif.gz" -o timetables
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --format normalized
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --format gtfs
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --format patterns
+    python cif_timetable_reader.py convert "CIF_data/*.CIF" -o timetables --tiploc-reference RailReferences.csv
+    python cif_timetable_reader.py convert "CIF_data/*.CIF" -o timetables --public-only
+    python cif_timetable_reader.py frequency "timetables/*_stop_times.csv" -o stop_frequency
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --format sqlite
+    python cif_timetable_reader.py headway "timetables/*.sqlite" -o headways --window 07:00-10:00
+    python cif_timetable_reader.py blocks "timetables/*_timetable.csv" -o blocks --day tuesday saturday
+    python cif_timetable_reader.py interchange "timetables/*_timetable.csv" -o interchange --max-transfer 15
+        --locations "timetables/*_locations.csv" --radius 250
+    python cif_timetable_reader.py od "timetables/*_timetable.csv" -o od --day tuesday --window 07:00-10:00
+    python cif_timetable_reader.py isochrone "timetables/*_timetable.csv" -o isochrones --origins origins.txt
+        --day tuesday --departure 08:00 --max-minutes 60
+    python cif_timetable_reader.py stops "CIF_data/*.cif" -o shapefiles --format shp
+    python cif_timetable_reader.py diff old_drop new_drop -o timetable_diff
+    python cif_timetable_reader.py benchmark --size 10 100 -o bench --save results.json
+
+ATCO-CIF and rail (ScotRail/Network Rail) .cif files are told apart by their first record, frequency inputs by
+their columns, so one invocation can process a whole national drop.
+
+"""
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def expand_inputs(patterns):
+    """
+    Expand a list of glob patterns (or plain paths) into a sorted list of unique files.
+    :param patterns: list of glob patterns
+    :return: list of file paths
+    """
+    filepaths = set()
+    for pattern in patterns:
+        matches = glob.glob(os.path.expanduser(pattern), recursive=True)
+        if not matches and os.path.isfile(pattern):
+            matches = [pattern]
+        filepaths.update(match for match in matches if os.path.isfile(match))
+    return sorted(filepaths)
+
+
+def parse_memory(value):
+    """
+    Parse a memory size like '512M', '4G' or a plain number of bytes.
+    :param value: memory size string
+    :return: number of bytes
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} - not a valid memory size, use e.g. 512M or 4G.".format(value))
+
+
+def parse_window(value):
+    """
+    Parse a time window like '07:00-10:00' or '7-10'.
+    :param value: time window string
+    :return: tuple of (start_hour, start_minute, end_hour, end_minute)
+    """
+    try:
+        start, end = value.split('-')
+        start_hour, _, start_minute = start.partition(':')
+        end_hour, _, end_minute = end.partition(':')
+        window = (int(start_hour), int(start_minute or 0), int(end_hour), int(end_minute or 0))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} - not a valid time window, use e.g. 07:00-10:00.".format(value))
+    if not (0 <= window[0] < 24 and 0 <= window[2] < 24 and 0 <= window[1] < 60 and 0 <= window[3] < 60):
+        raise argparse.ArgumentTypeError("{} - hours must be within 0-23 and minutes within 0-59.".format(value))
+    return window
+
+
+def parse_time(value):
+    """
+    Parse a time of day like '08:00' or '8'.
+    :param value: time string
+    :return: minutes past midnight
+    """
+    hour, _, minute = value.partition(':')
+    try:
+        hour, minute = int(hour), int(minute or 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} - not a valid time, use e.g. 08:00.".format(value))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise argparse.ArgumentTypeError("{} - hours must be within 0-23 and minutes within 0-59.".format(value))
+    return hour * 60 + minute
+
+
+def read_origins(values):
+    """
+    Collect origin stop codes given on the command line - either codes or files with one code per line.
+    :param values: list of stop codes and/or paths
+    :return: list of unique stop codes, in order, None when no origins were given
+    """
+    if not values:
+        return None
+    origins = []
+    for value in values:
+        if os.path.isfile(value):
+            with open(value, "r") as f:
+                origins.extend(row.strip() for row in f if row.strip())
+        else:
+            origins.append(value.strip())
+    return list(dict.fromkeys(origins))
+
+
+def run_tasks(function, tasks, workers=1, memory_limit=None):
+    """
+    Run function(*task) for every task, in parallel worker processes if more than one worker is requested. A failed
+    task is reported and does not stop the rest of the batch.
+    :param function: module level function to call
+    :param tasks: list of argument tuples
+    :param workers: number of worker processes
+    :param memory_limit: memory limit per worker in bytes
+    :return: tuple of (list of results, number of failed tasks)
+    """
+    from instrumentation import set_memory_limit
+    results = []
+    failed = 0
+    if workers <= 1 or len(tasks) <= 1:
+        set_memory_limit(memory_limit)
+        for task in tasks:
+            try:
+                results.append(function(*task))
+            except Exception as e:
+                print("{} - failed: {!r}".format(task[0], e), file=sys.stderr)
+                failed += 1
+        return results, failed
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=set_memory_limit,
+                                                initargs=(memory_limit,)) as executor:
+        futures = {executor.submit(function, *task): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("{} - failed: {!r}".format(futures[future][0], e), file=sys.stderr)
+                failed += 1
+    return results, failed
+
+
+def convert_file(file, output_folder, formats, profile=False, trace_memory=False, partition_by='vehicle_type',
+                 tiploc_reference=None, public_only=False):
+    """
+    Convert a single .cif file with the converter matching its flavour. Rail timetables are never partitioned, and
+    only rail locations are mapped with a TIPLOC reference or left out when not public calls.
+    """
+    from compressed_input import is_rail_cif
+    if is_rail_cif(file):
+        import ScotRail_CIF_timetable_converter as converter
+        return converter.convert_file(file, output_folder, formats=formats, profile=profile,
+                                      trace_memory=trace_memory, tiploc_reference=tiploc_reference,
+                                      public_only=public_only)
+    import CIF_timetable_converter as converter
+    return converter.convert_file(file, output_folder, formats=formats, profile=profile, trace_memory=trace_memory,
+                                  partition_by=partition_by)
+
+
+def frequency_file(csv, output_folder, days, windows, group_by_routes, formats, profile=False, trace_memory=False,
+                   chunksize=None, name=None):
+    """
+    Calculate stop frequencies of a single timetable for every requested day and time window. With a chunksize the
+    timetable is read in chunks of rows instead of being loaded whole. Outputs are named after the timetable unless
+    a name is given - see get_timetable_names.
+    """
+    from normalized_timetable import is_rail_timetable
+    saved = []
+    if is_rail_timetable(csv):
+        import ScotRail_TRACC_stop_frequency_counter as counter
+        for day in days:
+            for start_hour, start_minute, end_hour, end_minute in windows:
+                saved.extend(counter.frequency_file(csv, output_folder, day, start_hour, end_hour,
+                                                    start_minute=start_minute, end_minute=end_minute,
+                                                    formats=formats, profile=profile, trace_memory=trace_memory,
+                                                    chunksize=chunksize, name=name))
+        return saved
+
+    import stop_frequency_counter as counter
+    from instrumentation import RunReport
+    name = name or os.path.basename(csv).replace('_timetable.csv', '').split('.')[0]
+    with RunReport(name + '_frequency', output_folder, profile=profile, trace_memory=trace_memory) as report:
+        if not chunksize:
+            with report.stage('load'):
+                df_timetable = counter.load_timetable(csv)
+            report.count('rows_read', len(df_timetable))
+        for day in days:
+            for start_hour, start_minute, end_hour, end_minute in windows:
+                #   Stop frequencies are always saved, route frequencies on top of them.
+                for by_routes in ([False, True] if group_by_routes else [False]):
+                    with report.stage('frequency'):
+                        if chunksize:
+                            frequency = counter.get_stop_frequency_out_of_core(csv, day, start_hour, end_hour,
+                                                                               group_by_routes=by_routes,
+                                                                               start_minute=start_minute,
+                                                                               end_minute=end_minute,
+                                                                               chunksize=chunksize)
+                        else:
+                            frequency = counter.get_stop_frequency(df_timetable, day, start_hour, end_hour,
+                                                                   group_by_routes=by_routes,
+                                                                   start_minute=start_minute, end_minute=end_minute)
+                    output = "{}_{}_{}_{}_to_{}_{}{}.csv".format(name, day, start_hour, start_minute, end_hour,
+                                                                 end_minute, '_route_frequency' if by_routes else '')
+                    with report.stage('write'):
+                        if 'csv' in formats:
+                            frequency.to_csv(os.path.join(output_folder, output), index=False)
+                            saved.append(os.path.join(output_folder, output))
+                        if 'xlsx' in formats:
+                            frequency.to_excel(os.path.join(output_folder, output.replace('.csv', '.xlsx')),
+                                               index=False)
+                    report.count('rows_emitted', len(frequency))
+    return saved
+
+
+def store_file(path, output_folder, days, windows, group_by_routes, formats, headways=False, profile=False,
+               trace_memory=False):
+    """
+    Calculate stop frequencies (or headways) of a timetable store for every requested day and time window, as
+    indexed SQL queries.
+    """
+    import timetable_store
+    from instrumentation import RunReport
+    name = os.path.splitext(os.path.basename(path))[0]
+    saved = []
+    with RunReport(name + ('_headway' if headways else '_frequency'), output_folder, profile=profile,
+                   trace_memory=trace_memory) as report:
+        connection = timetable_store.connect(path, read_only=True)
+        try:
+            is_rail = timetable_store.is_rail_store(connection)
+            for day in days:
+                for start_hour, start_minute, end_hour, end_minute in windows:
+                    results = []
+                    with report.stage('query'):
+                        for by_routes in ([False, True] if group_by_routes else [False]):
+                            if headways:
+                                result = timetable_store.get_headways(connection, day, start_hour, end_hour,
+                                                                      group_by_routes=by_routes,
+                                                                      start_minute=start_minute, end_minute=end_minute)
+                                suffix = '_route_headway' if by_routes else '_headway'
+                            elif is_rail:
+                                result = timetable_store.get_rail_stop_frequency(
+                                    connection, day, start_hour, end_hour, group_by_routes=by_routes,
+                                    get_services=not by_routes, start_minute=start_minute, end_minute=end_minute)
+                                suffix = '_route_frequency' if by_routes else ''
+                            else:
+                                result = timetable_store.get_stop_frequency(
+                                    connection, day, start_hour, end_hour, group_by_routes=by_routes,
+                                    start_minute=start_minute, end_minute=end_minute)
+                                suffix = '_route_frequency' if by_routes else ''
+                            output = "{}_{}_{}_{}_to_{}_{}{}.csv".format(name, day, start_hour, start_minute,
+                                                                         end_hour, end_minute, suffix)
+                            results.append((output, result))
+                    with report.stage('write'):
+                        for output, result in results:
+                            if 'csv' in formats:
+                                result.to_csv(os.path.join(output_folder, output), index=False)
+                                saved.append(os.path.join(output_folder, output))
+                            if 'xlsx' in formats:
+                                result.to_excel(os.path.join(output_folder, output.replace('.csv', '.xlsx')),
+                                                index=False)
+                            report.count('rows_emitted', len(result))
+        finally:
+            connection.close()
+    return saved
+
+
+def get_timetable_name(path):
+    """
+    Name of a timetable, e.g. timetables/Coach_1_Coach_timetable.csv -> Coach_1_Coach, timetables/Coach_1_stop_times.csv
+    -> Coach_1, timetables/Coach_1.sqlite -> Coach_1.
+    """
+    from normalized_timetable import get_table_prefix, is_normalized_table
+    if is_normalized_table(path):
+        return os.path.basename(get_table_prefix(path))
+    return os.path.splitext(os.path.basename(path))[0].replace('_timetable', '')
+
+
+def get_timetable_names(paths):
+    """
+    Name every timetable, e.g. for outputs saved to one folder. Timetables of the same name in different folders are
+    told apart by their folder name, e.g. old/Coach_1_timetable.csv -> old_Coach_1.
+    :param paths: list of timetable paths
+    :return: dictionary of name: path
+    """
+    names = [get_timetable_name(path) for path in paths]
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    timetables = {}
+    for name, path in zip(names, paths):
+        if counts[name] > 1:
+            folder = os.path.basename(os.path.dirname(os.path.abspath(path)))
+            print("{} - more than one timetable named {}, saved as {}_{}.".format(path, name, folder, name),
+                  file=sys.stderr)
+            name = '{}_{}'.format(folder, name)
+        if name in timetables:
+            raise ValueError("{} and {} - timetables can't be told apart, rename one of them.".format(
+                timetables[name], path))
+        timetables[name] = path
+    return timetables
+
+
+def blocks_file(path, output_folder, days, date=None, formats=('csv',), profile=False, trace_memory=False):
+    """
+    Build the vehicle blocks of an ATCO-CIF timetable for every requested day.
+    """
+    import vehicle_blocks
+    from instrumentation import RunReport
+    name = get_timetable_name(path)
+    saved = []
+    with RunReport(name + '_blocks', output_folder, profile=profile, trace_memory=trace_memory) as report:
+        for day in days:
+            with report.stage('build'):
+                blocks, summary, peaks = vehicle_blocks.get_vehicle_blocks(path, day, date=date)
+            report.count('journeys', len(blocks))
+            report.count('blocks', len(summary))
+            with report.stage('write'):
+                for table, result in [('blocks', blocks), ('block_summary', summary), ('peak_vehicles', peaks)]:
+                    output = os.path.join(output_folder, "{}_{}_{}.csv".format(name, day, table))
+                    if 'csv' in formats:
+                        result.to_csv(output, index=False)
+                        saved.append(output)
+                    if 'xlsx' in formats:
+                        result.to_excel(output.replace('.csv', '.xlsx'), index=False)
+    return saved
+
+
+def interchange_day(filepaths, output_folder, day, windows=None, min_transfer=0, max_transfer=15, locations=None,
+                    radius=None, same_mode=False, formats=('csv',), profile=False, trace_memory=False):
+    """
+    Count interchange opportunities between all timetables on a day, for the whole day or every time window.
+    """
+    import pandas as pd
+    import interchange
+    from instrumentation import RunReport
+    saved = []
+    with RunReport('interchange_' + day, output_folder, profile=profile, trace_memory=trace_memory) as report:
+        groups = None
+        if locations and radius:
+            with report.stage('group'):
+                groups = interchange.group_nearby_stops(
+                    pd.concat([pd.read_csv(path, dtype=str) for path in locations], ignore_index=True), radius)
+        with report.stage('load'):
+            arrivals, departures = interchange.load_events(filepaths, day)
+        report.count('arrivals', len(arrivals))
+        report.count('departures', len(departures))
+        for window in windows or [None]:
+            with report.stage('count'):
+                result = interchange.get_interchanges(
+                    arrivals, departures, min_transfer=min_transfer, max_transfer=max_transfer, groups=groups,
+                    same_mode=same_mode, window=(window[0] * 60 + window[1], window[2] * 60 + window[3]) if window
+                    else None)
+            suffix = '_{}_{}_to_{}_{}'.format(*window) if window else ''
+            output = os.path.join(output_folder, "interchange_{}{}.csv".format(day, suffix))
+            with report.stage('write'):
+                if 'csv' in formats:
+                    result.to_csv(output, index=False)
+                    saved.append(output)
+                if 'xlsx' in formats:
+                    result.to_excel(output.replace('.csv', '.xlsx'), index=False)
+            report.count('rows_emitted', len(result))
+    return saved
+
+
+def od_day(filepaths, output_folder, day, windows=None, formats=('npz',), profile=False, trace_memory=False):
+    """
+    Count direct services between every pair of stops of all timetables on a day, for the whole day or every time
+    window.
+    """
+    import od_matrix
+    from instrumentation import RunReport
+    saved = []
+    with RunReport('od_' + day, output_folder, profile=profile, trace_memory=trace_memory) as report:
+        with report.stage('load'):
+            calls = od_matrix.load_calls(filepaths, day)
+        report.count('calls', len(calls))
+        with report.stage('count'):
+            matrices = od_matrix.build_od_matrices(
+                calls, windows=[(window[0] * 60 + window[1], window[2] * 60 + window[3]) for window in windows]
+                if windows else None)
+        stops_path = os.path.join(output_folder, "od_{}_stops.csv".format(day))
+        for window, matrix in zip(windows or [None], matrices):
+            suffix = '_{}_{}_to_{}_{}'.format(*window) if window else ''
+            output = os.path.join(output_folder, "od_{}{}.npz".format(day, suffix))
+            with report.stage('write'):
+                if 'npz' in formats:
+                    # The stop index is shared by all windows of the day.
+                    saved.extend(matrix.save(output, stops_path=None if stops_path in saved else stops_path))
+                if 'csv' in formats:
+                    matrix.to_frame().to_csv(output.replace('.npz', '.csv'), index=False)
+                    saved.append(output.replace('.npz', '.csv'))
+                if 'xlsx' in formats:
+                    matrix.to_frame().to_excel(output.replace('.npz', '.xlsx'), index=False)
+            report.count('stop_pairs', len(matrix))
+        report.count('stops', len(matrices[0].stops))
+    return saved
+
+
+def isochrone_file(path, output_folder, days, departures, max_minutes, origins=None, transfer_time=0, batch_size=256,
+                   formats=('csv',), profile=False, trace_memory=False):
+    """
+    Find the stops reachable from every origin of a timetable within the travel time, for every requested day and
+    departure time.
+    """
+    import connection_scan
+    from instrumentation import RunReport
+    name = get_timetable_name(path)
+    saved = []
+    with RunReport(name + '_isochrone', output_folder, profile=profile, trace_memory=trace_memory) as report:
+        for day in days:
+            with report.stage('build'):
+                connections = connection_scan.load_connections(path, day=day)
+            report.count('connections', len(connections))
+            #   Every stop of the timetable is an origin unless origins are given.
+            day_origins = list(connections.stops) if origins is None else origins
+            for departure in departures:
+                with report.stage('scan'):
+                    result = connections.isochrones(day_origins, departure, max_minutes, transfer_time=transfer_time,
+                                                    batch_size=batch_size)
+                output = os.path.join(output_folder, "{}_{}_{:02d}_{:02d}_{}_minutes_isochrones.csv".format(
+                    name, day, departure // 60, departure % 60, max_minutes))
+                with report.stage('write'):
+                    if 'csv' in formats:
+                        result.to_csv(output, index=False)
+                        saved.append(output)
+                    if 'xlsx' in formats:
+                        result.to_excel(output.replace('.csv', '.xlsx'), index=False)
+                report.count('origins', len(day_origins))
+                report.count('rows_emitted', len(result))
+    return saved
+
+
+def stops_file(file, output_folder, output_format):
+    """
+    Extract stop locations of a single .cif file into a shapefile or a .csv.
+    """
+    if output_format == 'shp':
+        import stop_location_to_shapefile
+        return stop_location_to_shapefile.convert_file(file, output_folder)
+
+    import pandas as pd
+    from atco_cif_parser import read_atco_cif
+    from compressed_input import get_member_name, open_cif
+    with open_cif(file) as f:
+        cif = read_atco_cif(f, records=['QL', 'QB'])
+    output = os.path.join(output_folder, os.path.splitext(get_member_name(file))[0] + '_locations.csv')
+    pd.DataFrame(cif['locations']).to_csv(output, index=False)
+    return output
+
+
+def convert(args):
+    from compressed_input import expand_archives, warn_name_collisions
+    filepaths = expand_archives(expand_inputs(args.inputs))
+    os.makedirs(args.output, exist_ok=True)
+    warn_name_collisions(filepaths)
+    print("CIF Timetable conversion commencing.\n{} files to analyze.".format(len(filepaths)))
+    if args.pipeline:
+        if set(args.format) - {'csv'}:
+            print("--pipeline writes .csv timetables only - converting file by file.", file=sys.stderr)
+        elif args.tiploc_reference:
+            print("--pipeline does not map rail locations - converting file by file.", file=sys.stderr)
+        elif args.public_only:
+            print("--pipeline keeps all rail locations - converting file by file.", file=sys.stderr)
+        else:
+            #   Read, parse and write all files at once.
+            import pipeline
+            from instrumentation import set_memory_limit
+            set_memory_limit(args.memory_limit)
+            saved, failed = pipeline.run_pipeline(filepaths, args.output, workers=args.workers,
+                                                  partition_by=args.partition_by, profile=args.profile,
+                                                  trace_memory=args.trace_memory)
+            return [saved], failed
+    tasks = [(file, args.output, args.format, args.profile, args.trace_memory, args.partition_by,
+              args.tiploc_reference, args.public_only) for file in filepaths]
+    return run_tasks(convert_file, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def frequency(args):
+    filepaths = expand_inputs(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    print("Frequency calculation commencing.\n{} timetables to analyze.".format(len(filepaths)))
+    chunksize = args.chunksize
+    if chunksize is None and args.memory_limit:
+        #   Stay within the memory limit - read timetables in chunks sized to it.
+        from out_of_core import get_chunksize
+        chunksize = get_chunksize(args.memory_limit)
+    results, failed = [], 0
+    #   Timetable stores are queried in place, nothing is loaded.
+    from timetable_store import is_store
+    tasks = [(path, args.output, args.day, args.window, args.by_routes, args.format, False, args.profile,
+              args.trace_memory) for path in filepaths if is_store(path)]
+    if tasks:
+        filepaths = [path for path in filepaths if not is_store(path)]
+        results, failed = run_tasks(store_file, tasks, workers=args.workers, memory_limit=args.memory_limit)
+    if chunksize:
+        #   Only flat timetables are read in chunks - normalized ones are compact enough to be joined in memory.
+        from normalized_timetable import is_normalized_table
+        names = {csv: name for name, csv in get_timetable_names(filepaths).items()}
+        tasks = [(csv, args.output, args.day, args.window, args.by_routes, args.format, args.profile,
+                  args.trace_memory, chunksize, names[csv]) for csv in filepaths if not is_normalized_table(csv)]
+        filepaths = [csv for csv in filepaths if is_normalized_table(csv)]
+        chunked_results, chunked_failed = run_tasks(frequency_file, tasks, workers=args.workers,
+                                                    memory_limit=args.memory_limit)
+        results, failed = results + chunked_results, failed + chunked_failed
+    if not filepaths:
+        return results, failed
+
+    #   Load every timetable once and analyze all days and windows in parallel.
+    import frequency_runner
+    timetables = get_timetable_names(filepaths)
+    saved, runner_failed = frequency_runner.run_frequencies(
+        timetables, args.day, args.window, args.output, groupings=['stops', 'routes'] if args.by_routes else ['stops'],
+        workers=args.workers, formats=args.format, memory_limit=args.memory_limit, profile=args.profile,
+        trace_memory=args.trace_memory, shared_memory=args.shared_memory)
+    return results + [saved], failed + runner_failed
+
+
+def headway(args):
+    filepaths = expand_inputs(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    print("Headway calculation commencing.\n{} timetable stores to analyze.".format(len(filepaths)))
+    tasks = [(path, args.output, args.day, args.window, args.by_routes, args.format, True, args.profile,
+              args.trace_memory) for path in filepaths]
+    return run_tasks(store_file, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def get_extract_files(pattern):
+    """
+    List the .cif files of an extract given as a folder, an archive or a glob pattern.
+    """
+    from compressed_input import expand_archives, list_cif_files
+    if os.path.isdir(pattern):
+        return list_cif_files(pattern)
+    return expand_archives(expand_inputs([pattern]))
+
+
+def diff(args):
+    import timetable_diff
+    from instrumentation import set_memory_limit
+    old_files, new_files = get_extract_files(args.old), get_extract_files(args.new)
+    print("Timetable diff commencing.\n{} old and {} new files to compare.".format(len(old_files), len(new_files)))
+    set_memory_limit(args.memory_limit)
+    saved = timetable_diff.diff_extracts(old_files, new_files, args.output, profile=args.profile,
+                                         trace_memory=args.trace_memory)
+    return [saved], 0
+
+
+def blocks(args):
+    filepaths = expand_inputs(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    print("Vehicle block reconstruction commencing.\n{} timetables to analyze.".format(len(filepaths)))
+    tasks = [(path, args.output, args.day, args.date, args.format, args.profile, args.trace_memory)
+             for path in filepaths]
+    return run_tasks(blocks_file, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def interchange(args):
+    filepaths = expand_inputs(args.inputs)
+    locations = expand_inputs(args.locations) if args.locations else None
+    os.makedirs(args.output, exist_ok=True)
+    print("Interchange analysis commencing.\n{} timetables to analyze.".format(len(filepaths)))
+    #   All timetables are merged - days are analyzed in parallel.
+    tasks = [(filepaths, args.output, day, args.window, args.min_transfer, args.max_transfer, locations, args.radius,
+              args.same_mode, args.format, args.profile, args.trace_memory) for day in args.day]
+    return run_tasks(interchange_day, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def od(args):
+    filepaths = expand_inputs(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    print("OD service matrix calculation commencing.\n{} timetables to analyze.".format(len(filepaths)))
+    #   All timetables are merged - days are analyzed in parallel.
+    tasks = [(filepaths, args.output, day, args.window, args.format, args.profile, args.trace_memory)
+             for day in args.day]
+    return run_tasks(od_day, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def isochrone(args):
+    filepaths = expand_inputs(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    origins = read_origins(args.origins)
+    print("Isochrone calculation commencing.\n{} timetables to analyze.".format(len(filepaths)))
+    tasks = [(path, args.output, args.day, args.departure, args.max_minutes, origins, args.transfer_time,
+              args.batch_size, args.format, args.profile, args.trace_memory) for path in filepaths]
+    return run_tasks(isochrone_file, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def stops(args):
+    from compressed_input import expand_archives, warn_name_collisions
+    filepaths = expand_archives(expand_inputs(args.inputs))
+    os.makedirs(args.output, exist_ok=True)
+    warn_name_collisions(filepaths)
+    print("CIF stop location extraction commencing.\n{} files to analyze.".format(len(filepaths)))
+    tasks = [(file, args.output, args.format) for file in filepaths]
+    return run_tasks(stops_file, tasks, workers=args.workers, memory_limit=args.memory_limit)
+
+
+def benchmark(args):
+    import benchmark as benchmark_module
+    results, regressions = benchmark_module.run_benchmark(
+        args.format, args.size, args.output, stages=args.stages, seed=args.seed, regenerate=args.regenerate,
+        save=args.save, compare=args.compare, tolerance=args.tolerance)
+    return results, len(regressions)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Convert and analyze ATCO-CIF and rail .cif timetables.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('inputs', nargs='+', help="input files or glob patterns (quote them to skip shell expansion)")
+    common.add_argument('-o', '--output', required=True, help="output folder")
+    common.add_argument('-w', '--workers', type=int, default=1, help="number of files processed in parallel")
+    common.add_argument('--memory-limit', type=parse_memory, default=None,
+                        help="memory limit per worker, e.g. 4G")
+    common.add_argument('--profile', action='store_true', help="save a cProfile of each file with its run report")
+    common.add_argument('--trace-memory', action='store_true', help="trace memory allocations with tracemalloc")
+
+    parser_convert = subparsers.add_parser('convert', parents=[common], help="convert .cif files into timetables")
+    parser_convert.add_argument('-f', '--format', nargs='+', choices=['csv', 'xlsx', 'normalized', 'patterns', 'gtfs', 'sqlite', 'duckdb'],
+                                default=['csv'],
+                                help="timetable output formats - 'normalized' saves journeys, stop_times, stops and "
+                                     "calendar tables, 'patterns' saves journeys grouped by stop sequence, 'gtfs' "
+                                     "saves a zipped GTFS feed, 'sqlite' and 'duckdb' save an indexed timetable "
+                                     "store")
+    parser_convert.add_argument('--partition-by', choices=['vehicle_type', 'operator', 'route'],
+                                default='vehicle_type',
+                                help="save ATCO-CIF timetables one file per vehicle type, operator or route")
+    parser_convert.add_argument('--pipeline', action='store_true',
+                                help="overlap reading, parsing and writing of all files, with --workers parser "
+                                     "workers (.csv output only)")
+    parser_convert.add_argument('--tiploc-reference', default=None,
+                                help="TIPLOC/CRS/NaPTAN correspondence .csv, e.g. NaPTAN RailReferences.csv - rail "
+                                     "locations are mapped to ATCO and CRS codes and unmatched TIPLOCs reported")
+    parser_convert.add_argument('--public-only', action='store_true',
+                                help="only keep public calls of rail timetables - passing points and stops "
+                                     "passengers can't use are left out while reading")
+    parser_convert.set_defaults(function=convert)
+
+    parser_frequency = subparsers.add_parser('frequency', parents=[common],
+                                             help="calculate stop frequencies of converted timetables")
+    parser_frequency.add_argument('-d', '--day', nargs='+', choices=DAYS, default=['tuesday'],
+                                  help="days of operation")
+    parser_frequency.add_argument('--window', nargs='+', type=parse_window, default=[(8, 0, 9, 0)],
+                                  help="time windows, e.g. 07:00-10:00")
+    parser_frequency.add_argument('--by-routes', action='store_true',
+                                  help="also get frequencies of particular routes on a stop")
+    parser_frequency.add_argument('-f', '--format', nargs='+', choices=['csv', 'xlsx'], default=['csv'],
+                                  help="output formats")
+    parser_frequency.add_argument('--chunksize', type=int, default=None,
+                                  help="read timetables in chunks of this many rows instead of loading them whole "
+                                       "(picked from --memory-limit when not given)")
+    parser_frequency.add_argument('--shared-memory', action='store_true',
+                                  help="hand loaded timetables to the workers in shared memory - a single copy of "
+                                       "every timetable, whichever way the workers are started")
+    parser_frequency.set_defaults(function=frequency)
+
+    parser_headway = subparsers.add_parser('headway', parents=[common],
+                                           help="calculate headways at stops of timetable stores")
+    parser_headway.add_argument('-d', '--day', nargs='+', choices=DAYS, default=['tuesday'], help="days of operation")
+    parser_headway.add_argument('--window', nargs='+', type=parse_window, default=[(8, 0, 9, 0)],
+                                help="time windows, e.g. 07:00-10:00")
+    parser_headway.add_argument('--by-routes', action='store_true', help="also get headways of particular routes")
+    parser_headway.add_argument('-f', '--format', nargs='+', choices=['csv', 'xlsx'], default=['csv'],
+                                help="output formats")
+    parser_headway.set_defaults(function=headway)
+
+    parser_diff = subparsers.add_parser('diff', help="list journeys added, removed and changed between two extracts")
+    parser_diff.add_argument('old', help="old extract - folder, archive or glob pattern of .cif files")
+    parser_diff.add_argument('new', help="new extract - folder, archive or glob pattern of .cif files")
+    parser_diff.add_argument('-o', '--output', required=True, help="output folder")
+    parser_diff.add_argument('--memory-limit', type=parse_memory, default=None, help="memory limit, e.g. 4G")
+    parser_diff.add_argument('--profile', action='store_true', help="save a cProfile of the run with its run report")
+    parser_diff.add_argument('--trace-memory', action='store_true', help="trace memory allocations with tracemalloc")
+    parser_diff.set_defaults(function=diff)
+
+    parser_blocks = subparsers.add_parser('blocks', parents=[common],
+                                          help="chain journeys of running boards into vehicle blocks")
+    parser_blocks.add_argument('-d', '--day', nargs='+', choices=DAYS, default=['tuesday'], help="days of operation")
+    parser_blocks.add_argument('--date', default=None,
+                               help="only keep journeys operating on this date, e.g. 2019-07-02")
+    parser_blocks.add_argument('-f', '--format', nargs='+', choices=['csv', 'xlsx'], default=['csv'],
+                               help="output formats")
+    parser_blocks.set_defaults(function=blocks)
+
+    parser_interchange = subparsers.add_parser('interchange', parents=[common],
+                                               help="count connections between modes at shared or nearby stops")
+    parser_interchange.add_argument('-d', '--day', nargs='+', choices=DAYS, default=['tuesday'],
+                                    help="days of operation")
+    parser_interchange.add_argument('--window', nargs='+', type=parse_window, default=None,
+                                    help="only count arrivals within time windows, e.g. 07:00-10:00")
+    parser_interchange.add_argument('--min-transfer', type=int, default=0,
+                                    help="minimum minutes between arrival and departure")
+    parser_interchange.add_argument('--max-transfer', type=int, default=15,
+                                    help="maximum minutes between arrival and departure")
+    parser_interchange.add_argument('--locations', nargs='+', default=None,
+                                    help="stop location tables (<name>_locations.csv) to match nearby stops with")
+    parser_interchange.add_argument('--radius', type=float, default=None,
+                                    help="merge stops within this many metres of each other (needs --locations)")
+    parser_interchange.add_argument('--same-mode', action='store_true',
+                                    help="also count connections between journeys of the same mode")
+    parser_interchange.add_argument('-f', '--format', nargs='+', choices=['csv', 'xlsx'], default=['csv'],
+                                    help="output formats")
+    parser_interchange.set_defaults(function=interchange)
+
+    parser_od = subparsers.add_parser('od', parents=[common],
+                                      help="count direct services between every pair of stops")
+    parser_od.add_argument('-d', '--day', nargs='+', choices=DAYS, default=['tuesday'], help="days of operation")
+    parser_od.add_argument('--window', nargs='+', type=parse_window, default=None,
+                           help="only count departures from the origin within time windows, e.g. 07:00-10:00")
+    parser_od.add_argument('-f', '--format', nargs='+', choices=['npz', 'csv', 'xlsx'], default=['npz'],
+                           help="output formats - 'npz' saves sparse matrices with a stop index, 'csv' and 'xlsx' "
+                                "save a list of stop pairs")
+    parser_od.set_defaults(function=od)
+
+    parser_isochrone = subparsers.add_parser('isochrone', parents=[common],
+                                             help="find stops reachable from origins within a travel time")
+    parser_isochrone.add_argument('--origins', nargs='+', default=None,
+                                  help="origin stop codes, or files with one code per line (all stops when not "
+                                       "given)")
+    parser_isochrone.add_argument('-d', '--day', nargs='+', choices=DAYS, default=['tuesday'],
+                                  help="days of operation")
+    parser_isochrone.add_argument('--departure', nargs='+', type=parse_time, default=[8 * 60],
+                                  help="departure times, e.g. 08:00")
+    parser_isochrone.add_argument('--max-minutes', type=int, default=60, help="maximum travel time in minutes")
+    parser_isochrone.add_argument('--transfer-time', type=int, default=0,
+                                  help="minimum minutes needed to change between journeys")
+    parser_isochrone.add_argument('--batch-size', type=int, default=256, help="number of origins scanned at once")
+    parser_isochrone.add_argument('-f', '--format', nargs='+', choices=['csv', 'xlsx'], default=['csv'],
+                                  help="output formats")
+    parser_isochrone.set_defaults(function=isochrone)
+
+    parser_stops = subparsers.add_parser('stops', parents=[common], help="extract stop locations from .cif files")
+    parser_stops.add_argument('-f', '--format', choices=['csv', 'shp'], default='csv', help="output format")
+    parser_stops.set_defaults(function=stops)
+
+    parser_benchmark = subparsers.add_parser('benchmark', help="benchmark converters on synthetic .cif files")
+    import benchmark as benchmark_module
+    benchmark_module.get_parser(parser_benchmark)
+    parser_benchmark.set_defaults(function=benchmark)
+    return parser
+
+
+def main(argv=None):
+    START = time.time()
+    args = get_parser().parse_args(argv)
+    results, failed = args.function(args)
+    print("\nFinished{}.\nTotal runtime: {:.2f}".format(
+        '' if not failed else ' with {} failures'.format(failed), time.time() - START))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
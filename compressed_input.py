@@ -0,0 +1,242 @@
+"""
+compressed_input.py
+
+Read .cif files straight from .zip, .gz and .bz2 archives, without extracting them to disk first. Files inside a
+.zip archive are addressed as 'archive.zip::member.cif', e.g. 'CIF_data/traveline.zip::ATCO_010_BUS.CIF'.
+
+Decompression runs in a background thread which feeds decompressed blocks through a bounded queue, so the parser
+works on one block while the next one is being decompressed - zlib and bz2 release the GIL while they work.
+
+    python cif_timetable_reader.py convert "CIF_data/*.zip" -o timetables
+    python cif_timetable_reader.py convert "CIF_data/*.cif.gz" -o timetables
+
+"""
+import bz2
+import gzip
+import io
+import os
+import queue
+import sys
+import threading
+import zipfile
+
+# Separates the path to a .zip archive from the name of a file inside it.
+ARCHIVE_SEPARATOR = '::'
+
+# Single file compression formats.
+COMPRESSED_EXTENSIONS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+}
+
+# Size of decompressed blocks and number of blocks decompressed ahead of the parser.
+BLOCK_SIZE = 1024 ** 2
+QUEUE_SIZE = 8
+
+
+def is_cif_file(name):
+    """
+    Check whether a file name is that of a .cif file, compressed or not, e.g. 'ATCO_010_BUS.CIF.gz'.
+    """
+    name = name.lower()
+    for extension in COMPRESSED_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name.endswith('.cif')
+
+
+def list_archive(path):
+    """
+    List the .cif files inside a .zip archive.
+    :param path: path to .zip archive
+    :return: list of 'archive.zip::member.cif' paths
+    """
+    with zipfile.ZipFile(path) as archive:
+        return [path + ARCHIVE_SEPARATOR + info.filename for info in archive.infolist()
+                if not info.is_dir() and is_cif_file(info.filename)]
+
+
+def expand_archives(filepaths):
+    """
+    Replace .zip archives in a list of paths with the .cif files inside them.
+    :param filepaths: list of file paths
+    :return: list of file paths
+    """
+    expanded = []
+    for path in filepaths:
+        if path.lower().endswith('.zip'):
+            expanded.extend(list_archive(path))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+def list_cif_files(folder):
+    """
+    List the .cif files in a folder - plain, compressed and inside .zip archives.
+    :param folder: path to folder
+    :return: sorted list of file paths
+    """
+    filepaths = []
+    for file in sorted(os.listdir(folder)):
+        path = os.path.join(folder, file)
+        if is_cif_file(file):
+            filepaths.append(path)
+        elif file.lower().endswith('.zip'):
+            filepaths.extend(list_archive(path))
+    return filepaths
+
+
+def get_member_name(path):
+    """
+    Name of the .cif file as it would be after decompression, e.g. 'data/x.zip::ATCO.CIF' -> 'ATCO.CIF',
+    'data/Tram_5.cif.gz' -> 'Tram_5.cif'.
+    """
+    name = os.path.basename(path.split(ARCHIVE_SEPARATOR)[-1])
+    for extension in COMPRESSED_EXTENSIONS:
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def get_name_collisions(paths):
+    """
+    Find inputs which would save their outputs under the same name, e.g. 'Coach_1.cif.gz' and 'a.zip::Coach_1.cif'
+    both save Coach_1_* files - the last one converted overwrites the others.
+    :param paths: list of paths to .cif files
+    :return: dictionary of output name: list of paths, for names shared by more than one path
+    """
+    names = {}
+    for path in paths:
+        names.setdefault(get_member_name(path).split('.')[0], []).append(path)
+    return {name: shared for name, shared in names.items() if len(shared) > 1}
+
+
+def warn_name_collisions(paths):
+    """
+    Print a warning for every output name shared by more than one input - see get_name_collisions.
+    :param paths: list of paths to .cif files
+    :return: number of shared names
+    """
+    collisions = get_name_collisions(paths)
+    for name, shared in collisions.items():
+        print("{} - outputs are all saved as {}_*, only the last one converted is kept. Convert them to separate "
+              "output folders.".format(', '.join(shared), name), file=sys.stderr)
+    return len(collisions)
+
+
+def open_compressed(path):
+    """
+    Open a compressed file, or a file inside a .zip archive, as a binary stream of decompressed data.
+    :param path: path to compressed file
+    :return: binary file object, None if the file is not compressed
+    """
+    if ARCHIVE_SEPARATOR in path:
+        archive_path, member = path.split(ARCHIVE_SEPARATOR, 1)
+        # The member stays readable after the archive is closed.
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.open(member)
+    for extension, opener in COMPRESSED_EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return opener(path, 'rb')
+    return None
+
+
+def open_cif(path, threaded=True):
+    """
+    Open a .cif file for reading rows - plain, compressed or inside a .zip archive - the same way as open(path, "r").
+    :param path: path to .cif file
+    :param threaded: True to decompress in a background thread
+    :return: text file object
+    """
+    stream = open_compressed(path)
+    if stream is None:
+        return open(path, "r")
+    if threaded:
+        stream = io.BufferedReader(DecompressionThread(stream), buffer_size=BLOCK_SIZE)
+    return io.TextIOWrapper(stream)
+
+
+def is_rail_cif(path):
+    """
+    Check whether a .cif file is a rail (Network Rail/ScotRail) extract rather than an ATCO-CIF one. Rail extracts
+    start with an 'HD' header record.
+    :param path: path to .cif file, plain, compressed or inside a .zip archive
+    :return: True for rail .cif files
+    """
+    with open_cif(path, threaded=False) as f:
+        for row in f:
+            if row.strip():
+                return row.startswith('HD')
+    return False
+
+
+class DecompressionThread(io.RawIOBase):
+    """
+    Raw binary stream over a decompressing file object. A background thread reads decompressed blocks ahead into a
+    bounded queue; reads are served from the queue.
+    """
+
+    def __init__(self, stream, block_size=BLOCK_SIZE, queue_size=QUEUE_SIZE):
+        """
+        :param stream: decompressing binary file object - gzip, bz2 or zip member
+        :param block_size: size of decompressed blocks
+        :param queue_size: number of blocks decompressed ahead
+        """
+        io.RawIOBase.__init__(self)
+        self._stream = stream
+        self._blocks = queue.Queue(maxsize=queue_size)
+        self._block = memoryview(b'')
+        self._offset = 0
+        self._done = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._decompress, args=(block_size,), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, block_size):
+        try:
+            while not self._stop.is_set():
+                block = self._stream.read(block_size)
+                if not block:
+                    break
+                self._put(block)
+        except Exception as e:
+            self._put(e)
+            return
+        # An empty block marks the end of the stream.
+        self._put(b'')
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._offset >= len(self._block):
+            if self._done:
+                return 0
+            item = self._blocks.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._done = True
+                return 0
+            self._block = memoryview(item)
+            self._offset = 0
+        n = min(len(b), len(self._block) - self._offset)
+        b[:n] = self._block[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._stream.close()
+        io.RawIOBase.close(self)
@@ -0,0 +1,261 @@
+"""
+connection_scan.py
+
+Connection scan over converted timetables - earliest arrival and isochrone queries without an external routing
+service. Every pair of consecutive calls of a journey is an elementary connection: depart from a stop at a time,
+arrive at the next stop at a later time. Connections of a given day are stored in NumPy arrays sorted by departure
+time, with integer stop ids and times in minutes past midnight, and scanned once per query.
+
+Queries are run for a batch of origins at once - every scanned connection updates the arrival times of all origins
+in one vectorized step - so thousands of origins can be processed in a single run:
+
+    python cif_timetable_reader.py isochrone "timetables/*_timetable.csv" -o isochrones --origins origins.txt
+        --day tuesday --departure 08:00 --max-minutes 60
+
+Both ATCO-CIF timetables (CIF_timetable_converter.py) and rail timetables (ScotRail_CIF_timetable_converter.py) are
+supported, flat, normalized or stored in a timetable store. Rail journeys are taken at their public times - passing
+points and calls without public times are skipped, see get_public_minutes.
+Walking between stops is not modelled; a minimum transfer time can be set for changing between journeys.
+
+"""
+import numpy as np
+import pandas as pd
+
+from normalized_timetable import ORIGIN_RECORDS, get_table_prefix, is_normalized_table, load_normalized_timetable
+from timetable_store import is_store, load_store
+
+# Arrival time of stops which can't be reached.
+UNREACHED = np.iinfo(np.int32).max // 2
+
+# Columns holding arrival and departure times of a call.
+ATCO_TIME_COLUMNS = ('published_arrival_time', 'published_departure_time')
+RAIL_TIME_COLUMNS = ('public_arrival_time', 'public_departure_time')
+
+# Timetable columns needed to build connections.
+CONNECTION_COLUMNS = ['record_identity', 'location', 'scheduled_pass', 'activity'] + list(ATCO_TIME_COLUMNS) + \
+    list(RAIL_TIME_COLUMNS)
+
+# Rail activity of calls which are not advertised.
+NOT_ADVERTISED = 'N '
+
+
+def get_minutes(values):
+    """
+    Convert hh:mm:ss strings into minutes past midnight.
+    :param values: series of time strings
+    :return: float array, NaN for missing times
+    """
+    values = values.astype(str)
+    hours = pd.to_numeric(values.str[0:2], errors='coerce')
+    minutes = pd.to_numeric(values.str[3:5], errors='coerce')
+    return (hours * 60 + minutes).to_numpy(dtype=float)
+
+
+def get_time_strings(minutes):
+    """
+    Convert minutes past midnight into hh:mm:ss strings - hours go above 23 past midnight, as in GTFS.
+    :param minutes: array of minutes, NaN for missing times
+    :return: series of time strings, NaN for missing times
+    """
+    minutes = pd.Series(minutes, dtype=float)
+    known = minutes.dropna().astype(int)
+    return known.map(lambda value: '{:02d}:{:02d}:00'.format(value // 60, value % 60)).reindex(minutes.index)
+
+
+def get_public_minutes(df):
+    """
+    Public arrival and departure times of rail calls, by the rule of is_public_call of
+    ScotRail_CIF_timetable_converter.py: passing points and calls not advertised (activity N) have none, and a public
+    time of 00:00 (0000 in the .cif file) means no public time.
+    :param df: rail timetable dataframe - see load_timetable
+    :return: tuple of (arrival, departure) minutes past midnight, NaN for missing times
+    """
+    arrival, departure = get_minutes(df['public_arrival_time']), get_minutes(df['public_departure_time'])
+    public = np.ones(len(df), dtype=bool)
+    if 'scheduled_pass' in df.columns:
+        public &= df['scheduled_pass'].isna().to_numpy()
+    if 'activity' in df.columns:
+        # Activities are two character codes, trailing spaces stripped.
+        activity = df['activity'].fillna('').astype(str).str.ljust(12)
+        for i in range(0, 12, 2):
+            public &= (activity.str[i:i + 2] != NOT_ADVERTISED).to_numpy()
+    return np.where(public & (arrival != 0), arrival, np.nan), np.where(public & (departure != 0), departure, np.nan)
+
+
+def load_timetable(path, day=None, columns=CONNECTION_COLUMNS):
+    """
+    Load the columns needed to build connections (or any other columns) from a timetable. Columns missing from the
+    timetable are left out.
+    :param path: path to flat timetable .csv, stop_times table of a normalized timetable or timetable store
+    :param day: day of week to keep journeys of, all journeys when not provided
+    :param columns: columns to load
+    :return: timetable dataframe
+    """
+    day_column = ['operates_on_' + day.lower() + 's'] if day else []
+    columns = list(columns) + day_column
+    if is_store(path):
+        df = load_store(path)
+    elif is_normalized_table(path):
+        df = load_normalized_timetable(get_table_prefix(path), columns=columns,
+                                       dtype={column: str for column in columns})
+    else:
+        available = pd.read_csv(path, nrows=0).columns
+        df = pd.read_csv(path, usecols=[column for column in columns if column in available], dtype=str)
+    df = df[[column for column in columns if column in df.columns]]
+    if day:
+        df = df[pd.to_numeric(df[day_column[0]]) == 1]
+    return df
+
+
+class ConnectionTimetable(object):
+    """
+    Elementary connections of a timetable sorted by departure time. Stops are numbered 0..n-1 in self.stops; times are
+    minutes past midnight of the day of travel, above 1440 past midnight.
+    """
+    __slots__ = ('stops', 'stop_index', 'departure_stop', 'arrival_stop', 'departure_time', 'arrival_time', 'trip')
+
+    def __init__(self, stops, departure_stop, arrival_stop, departure_time, arrival_time, trip):
+        order = np.argsort(departure_time, kind='stable')
+        self.stops = np.asarray(stops, dtype=object)
+        self.stop_index = {stop: i for i, stop in enumerate(self.stops)}
+        self.departure_stop = np.asarray(departure_stop, dtype=np.int32)[order]
+        self.arrival_stop = np.asarray(arrival_stop, dtype=np.int32)[order]
+        self.departure_time = np.asarray(departure_time, dtype=np.int32)[order]
+        self.arrival_time = np.asarray(arrival_time, dtype=np.int32)[order]
+        self.trip = np.asarray(trip, dtype=np.int32)[order]
+
+    def __len__(self):
+        return len(self.departure_time)
+
+    @property
+    def trip_count(self):
+        return int(self.trip.max()) + 1 if len(self) else 0
+
+    def get_stop_ids(self, stops):
+        """
+        :param stops: list of stop codes
+        :return: integer array of stop ids, -1 for stops not in the timetable
+        """
+        return np.array([self.stop_index.get(str(stop).strip(), -1) for stop in stops], dtype=np.int32)
+
+    def earliest_arrival(self, origins, departure_time, max_minutes=None, transfer_time=0):
+        """
+        Earliest arrival time at every stop from each of a batch of origins.
+        :param origins: list of origin stop codes
+        :param departure_time: earliest departure from the origins, in minutes past midnight
+        :param max_minutes: only scan connections departing up to this many minutes after departure time
+        :param transfer_time: minimum minutes needed to change between journeys
+        :return: int32 array of shape (number of stops, number of origins) of arrival times in minutes past
+        midnight - UNREACHED for stops which can't be reached
+        """
+        origin_ids = self.get_stop_ids(origins)
+        n_origins = len(origin_ids)
+        arrival = np.full((len(self.stops), n_origins), UNREACHED, dtype=np.int32)
+        columns = np.flatnonzero(origin_ids >= 0)
+        # Leaving an origin needs no transfer time.
+        arrival[origin_ids[columns], columns] = departure_time - transfer_time
+        on_trip = np.zeros((self.trip_count, n_origins), dtype=bool)
+
+        start = np.searchsorted(self.departure_time, departure_time, side='left')
+        end = len(self) if max_minutes is None else \
+            np.searchsorted(self.departure_time, departure_time + max_minutes, side='right')
+        departure_stop = self.departure_stop
+        arrival_stop = self.arrival_stop
+        departure_times = self.departure_time
+        arrival_times = self.arrival_time
+        trips = self.trip
+        for c in range(start, end):
+            trip = trips[c]
+            boarded = on_trip[trip] | (arrival[departure_stop[c]] + transfer_time <= departure_times[c])
+            if not boarded.any():
+                continue
+            on_trip[trip] = boarded
+            stop_arrival = arrival[arrival_stop[c]]
+            np.minimum(stop_arrival, np.where(boarded, arrival_times[c], UNREACHED), out=stop_arrival)
+        return arrival
+
+    def isochrones(self, origins, departure_time, max_minutes, transfer_time=0, batch_size=256):
+        """
+        Stops reachable from each origin within a given travel time.
+        :param origins: list of origin stop codes
+        :param departure_time: earliest departure from the origins, in minutes past midnight
+        :param max_minutes: maximum travel time in minutes
+        :param transfer_time: minimum minutes needed to change between journeys
+        :param batch_size: number of origins scanned at once
+        :return: dataframe of origin, stop, arrival time and travel time in minutes
+        """
+        frames = []
+        for i in range(0, len(origins), batch_size):
+            batch = list(origins[i:i + batch_size])
+            arrival = self.earliest_arrival(batch, departure_time, max_minutes=max_minutes,
+                                            transfer_time=transfer_time)
+            # Origins themselves are reached at the departure time.
+            origin_ids = self.get_stop_ids(batch)
+            columns = np.flatnonzero(origin_ids >= 0)
+            arrival[origin_ids[columns], columns] = departure_time
+            stops, columns = np.nonzero(arrival <= departure_time + max_minutes)
+            frames.append(pd.DataFrame({
+                'origin': np.asarray(batch, dtype=object)[columns],
+                'stop': self.stops[stops],
+                'arrival_time': arrival[stops, columns],
+            }))
+        df = pd.concat(frames, ignore_index=True) if frames else \
+            pd.DataFrame({'origin': [], 'stop': [], 'arrival_time': np.array([], dtype=np.int32)})
+        df['travel_time'] = df['arrival_time'] - departure_time
+        df['arrival_time'] = get_time_strings(df['arrival_time'].to_numpy())
+        return df.sort_values(['origin', 'travel_time', 'stop'], kind='stable').reset_index(drop=True)
+
+
+def build_connections(df):
+    """
+    Build the connections of a timetable - one for every pair of consecutive calls of a journey.
+    :param df: timetable dataframe, stops of each journey in order - see load_timetable
+    :return: ConnectionTimetable
+    """
+    df = df.reset_index(drop=True)
+    journey = df['record_identity'].isin(ORIGIN_RECORDS).cumsum().to_numpy() - 1
+    if RAIL_TIME_COLUMNS[0] in df.columns:
+        # Passengers only use trains at their public times - passing points and calls without public times are
+        # left out.
+        arrival, departure = get_public_minutes(df)
+        calls = ~np.isnan(arrival) | ~np.isnan(departure)
+        df, journey, arrival, departure = df[calls].reset_index(drop=True), journey[calls], arrival[calls], \
+            departure[calls]
+    else:
+        arrival = get_minutes(df[ATCO_TIME_COLUMNS[0]])
+        departure = get_minutes(df[ATCO_TIME_COLUMNS[1]])
+    arrival = np.where(np.isnan(arrival), departure, arrival)
+    departure = np.where(np.isnan(departure), arrival, departure)
+
+    # Times of a journey only go forward - every time earlier than the one before is past midnight.
+    events = np.column_stack([arrival, departure]).ravel()
+    event_journey = np.repeat(journey, 2)
+    earlier = np.zeros(len(events), dtype=int)
+    earlier[1:] = (events[1:] < events[:-1]) & (event_journey[1:] == event_journey[:-1])
+    days = np.cumsum(earlier)
+    starts = np.flatnonzero(np.r_[True, event_journey[1:] != event_journey[:-1]]) if len(events) else np.array([], int)
+    days -= np.repeat(days[starts], np.diff(np.r_[starts, len(events)]))
+    events = events + days * 1440
+    arrival, departure = events[0::2], events[1::2]
+
+    stop_codes, stops = pd.factorize(df['location'].astype(str).str.strip())
+    # A connection leads from every call to the next call of the same journey.
+    valid = (journey[:-1] == journey[1:]) & ~np.isnan(departure[:-1]) & ~np.isnan(arrival[1:])
+    _, trip = np.unique(journey[:-1][valid], return_inverse=True)
+    return ConnectionTimetable(
+        stops=stops,
+        departure_stop=stop_codes[:-1][valid],
+        arrival_stop=stop_codes[1:][valid],
+        departure_time=departure[:-1][valid],
+        arrival_time=arrival[1:][valid],
+        trip=trip)
+
+
+def load_connections(path, day=None):
+    """
+    Load a timetable and build its connections.
+    :param path: path to flat timetable .csv, stop_times table of a normalized timetable or timetable store
+    :param day: day of week to keep journeys of, all journeys when not provided
+    :return: ConnectionTimetable
+    """
+    return build_connections(load_timetable(path, day=day))
@@ -0,0 +1,124 @@
+"""
+duplicate_journeys.py
+
+Parse-time detection of duplicated journeys. Every journey is reduced to a fingerprint - a digest of its header and
+stop sequence - as soon as it is read; a journey whose fingerprint was seen before is a duplicate and is written to a
+side stream .csv instead of the timetable, so the timetable never has to be deduplicated as a whole frame.
+
+Two journeys with the same fingerprint hold the same header and the same stops, so every one of their timetable rows
+is the same as well.
+
+"""
+import csv
+import hashlib
+import os
+
+
+# Size of fingerprints in bytes.
+FINGERPRINT_SIZE = 16
+
+
+def get_digest(data):
+    """
+    Stable 128-bit digest of some bytes - the same in every process, unlike hash().
+    :param data: bytes
+    :return: integer digest
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=FINGERPRINT_SIZE).digest(), 'big')
+
+
+def get_journey_fingerprint(header, stops):
+    """
+    Fingerprint of a journey - a digest of its header fields and stop sequence, so parsers in other processes and
+    later runs fingerprint the same journey alike.
+    :param header: dictionary of journey header fields
+    :param stops: list of stop dictionaries, in order
+    :return: integer fingerprint
+    """
+    return get_digest(repr((tuple(header.items()), tuple(tuple(stop.items()) for stop in stops))).encode())
+
+
+class DuplicateJourneys(object):
+    """
+    Fingerprints of the journeys seen so far and a side stream of duplicated journey rows. The .csv is only created
+    once the first duplicate is found.
+    """
+    __slots__ = ('path', 'columns', 'fingerprints', 'journeys', 'rows', '_file', '_writer')
+
+    def __init__(self, path, columns=None):
+        """
+        :param path: path to .csv of duplicated timetable rows
+        :param columns: optional column order of the .csv - the keys of the first rows written, in order, when not
+        provided
+        """
+        self.path = path
+        self.columns = columns
+        self.fingerprints = set()
+        self.journeys = 0
+        self.rows = 0
+        self._file = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_duplicate(self, fingerprint):
+        """
+        Check whether a journey was seen before, and remember it if it was not.
+        :param fingerprint: journey fingerprint - see get_journey_fingerprint
+        :return: True for duplicated journeys
+        """
+        if fingerprint in self.fingerprints:
+            return True
+        self.fingerprints.add(fingerprint)
+        return False
+
+    def write(self, rows):
+        """
+        Write the timetable rows of a duplicated journey to the side stream.
+        :param rows: list of row dictionaries
+        """
+        if not rows:
+            return
+        if self._writer is None:
+            fieldnames = list(self.columns or [])
+            if not fieldnames:
+                for row in rows:
+                    fieldnames.extend(key for key in row if key not in fieldnames)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'w', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=fieldnames, extrasaction='ignore')
+            self._writer.writeheader()
+        self._writer.writerows(rows)
+        self.journeys += 1
+        self.rows += len(rows)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class JourneyFingerprints(object):
+    """
+    Fingerprints of every journey in the order they were read, duplicates or not. Used in place of DuplicateJourneys
+    where a file is parsed in chunks and the journeys are deduplicated later, in file order.
+    """
+    __slots__ = ('fingerprints',)
+
+    def __init__(self):
+        self.fingerprints = []
+
+    def is_duplicate(self, fingerprint):
+        """
+        Record a journey fingerprint.
+        :return: always False - every journey is kept
+        """
+        self.fingerprints.append(fingerprint)
+        return False
+
+    def write(self, rows):
+        pass
@@ -0,0 +1,262 @@
+"""
+frequency_runner.py
+
+Parallel stop frequency runs across many timetables - one per mode of travel. Each timetable is loaded once, before
+the workers start, and shared with them read-only; every requested day and time window is then analyzed in
+parallel and all results are written in one batch at the end.
+
+With shared_memory=True (--shared-memory) the loaded timetables are copied into shared memory as typed column buffers
+and workers attach to them by name - see shared_timetable.py - so however the workers are started, there is a single
+copy of every timetable.
+
+Both ATCO-CIF timetables (CIF_timetable_converter.py) and rail timetables (ScotRail_CIF_timetable_converter.py) are
+supported. To run without editing the source use: python cif_timetable_reader.py frequency --help
+
+"""
+
+# GLOBAL PARAMETERS
+paths = {
+    # Path to folder with timetable data.
+    'timetable': 'timetables',
+    # Name of folder to store stop frequencies.
+    'output': 'stop_frequency'
+}
+
+# Days of operation - from monday to sunday.
+DAYS = ['tuesday']
+
+# Time windows - (start hour, start minute, end hour, end minute).
+WINDOWS = [(8, 0, 9, 0)]
+
+# Frequencies to calculate - 'stops' and/or 'routes'.
+GROUPINGS = ['stops', 'routes']
+
+# Number of windows analyzed in parallel.
+WORKERS = 4
+
+# Do not edit below this point!
+# ===================================================================================================
+import concurrent.futures
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+import ScotRail_TRACC_stop_frequency_counter as rail_counter
+import stop_frequency_counter as atco_counter
+from instrumentation import RunReport, set_memory_limit
+from normalized_timetable import get_table_prefix, is_normalized_table, is_rail_timetable
+from shared_timetable import SharedTimetable
+
+# Timetables loaded by load_timetables - mode: (is rail timetable, dataframe). Forked workers inherit them.
+_TIMETABLES = {}
+
+# Shared memory timetables attached by a worker - kept open while their dataframes are in use.
+_SHARED = []
+
+
+def load_timetables(timetables):
+    """
+    Load timetables with the loader matching their flavour.
+    :param timetables: dictionary of mode: path to timetable .csv or to the stop_times table of a normalized timetable
+    :return: dictionary of mode: (True if rail timetable, dataframe)
+    """
+    loaded = {}
+    for mode, csv in timetables.items():
+        if is_normalized_table(csv):
+            #   Read only the columns needed from the normalized tables.
+            prefix = get_table_prefix(csv)
+            if is_rail_timetable(prefix + '_journeys.csv'):
+                loaded[mode] = (True, rail_counter.load_normalized(prefix))
+            else:
+                loaded[mode] = (False, atco_counter.load_normalized(prefix))
+        elif is_rail_timetable(csv):
+            loaded[mode] = (True, rail_counter.load_timetable(csv))
+        else:
+            loaded[mode] = (False, atco_counter.load_timetable(csv))
+    return loaded
+
+
+def get_output_name(mode, day, window, grouping):
+    """
+    Name of the frequency .csv saved for a mode, day, time window and grouping.
+    """
+    start_hour, start_minute, end_hour, end_minute = window
+    return "{}_{}_{}_{}_to_{}_{}{}.csv".format(mode, day, start_hour, start_minute, end_hour, end_minute,
+                                               '_route_frequency' if grouping == 'routes' else '')
+
+
+def frequency_task(mode, day, window, groupings):
+    """
+    Analyze a single timetable loaded into _TIMETABLES on a given day and time window. All groupings are calculated
+    from one filtered timetable.
+    :param mode: key of the timetable in _TIMETABLES
+    :param day: day of week
+    :param window: tuple of (start hour, start minute, end hour, end minute)
+    :param groupings: list of 'stops' and/or 'routes'
+    :return: list of (output name, frequency dataframe)
+    """
+    start_hour, start_minute, end_hour, end_minute = window
+    is_rail, df_timetable = _TIMETABLES[mode]
+    results = []
+    if is_rail:
+        total = rail_counter.filter_timetable(df_timetable, day, start_hour, end_hour, start_minute=start_minute,
+                                              end_minute=end_minute)
+        for grouping in groupings:
+            frequency = rail_counter.summarize_frequency(total, day, group_by_routes=grouping == 'routes',
+                                                         get_services=grouping == 'stops')
+            results.append((get_output_name(mode, day, window, grouping), frequency))
+    else:
+        for grouping in groupings:
+            frequency = atco_counter.get_stop_frequency(df_timetable, day, start_hour, end_hour,
+                                                        group_by_routes=grouping == 'routes',
+                                                        start_minute=start_minute, end_minute=end_minute)
+            results.append((get_output_name(mode, day, window, grouping), frequency))
+    return results
+
+
+def _init_worker(timetables, memory_limit, shared=None):
+    """
+    Worker initializer. Where processes can't be forked, each worker loads its own copy of the timetables, unless
+    they are in shared memory.
+    :param shared: optional dictionary of mode: (True if rail timetable, spec of a SharedTimetable) to attach to
+    """
+    set_memory_limit(memory_limit)
+    if shared is not None:
+        for mode, (is_rail, spec) in shared.items():
+            table = SharedTimetable.attach(spec)
+            _SHARED.append(table)
+            _TIMETABLES[mode] = (is_rail, table.to_frame())
+    elif timetables is not None:
+        _TIMETABLES.update(load_timetables(timetables))
+
+
+def share_timetables():
+    """
+    Move the timetables loaded into _TIMETABLES into shared memory.
+    :return: dictionary of mode: (True if rail timetable, SharedTimetable)
+    """
+    shared = {}
+    try:
+        for mode, (is_rail, df) in list(_TIMETABLES.items()):
+            shared[mode] = (is_rail, SharedTimetable.from_frame(df))
+            del _TIMETABLES[mode]
+    except Exception:
+        for is_rail, table in shared.values():
+            table.close()
+            table.unlink()
+        raise
+    return shared
+
+
+def write_results(results, output_folder, formats=('csv',)):
+    """
+    Write frequency dataframes to output folder.
+    :param results: list of (output name, frequency dataframe)
+    :param formats: output formats - 'csv' and/or 'xlsx'
+    :return: list of saved paths
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    saved = []
+    for output, frequency in results:
+        if 'csv' in formats:
+            frequency.to_csv(os.path.join(output_folder, output), index=False)
+            saved.append(os.path.join(output_folder, output))
+        if 'xlsx' in formats:
+            frequency.to_excel(os.path.join(output_folder, output.replace('.csv', '.xlsx')), index=False)
+    return saved
+
+
+def run_frequencies(timetables, days, windows, output_folder, groupings=('stops',), workers=1, formats=('csv',),
+                    memory_limit=None, profile=False, trace_memory=False, shared_memory=False):
+    """
+    Calculate stop frequencies of every timetable for every day, time window and grouping, and save them to output
+    folder together with a .json run report.
+    :param timetables: dictionary of mode: path to timetable .csv
+    :param days: list of days of week
+    :param windows: list of (start hour, start minute, end hour, end minute)
+    :param output_folder: folder to save the results in
+    :param groupings: list of 'stops' and/or 'routes'
+    :param workers: number of windows analyzed in parallel
+    :param formats: output formats - 'csv' and/or 'xlsx'
+    :param memory_limit: memory limit per worker in bytes
+    :param profile: True to save a cProfile of the run with the run report
+    :param trace_memory: True to trace memory allocations with tracemalloc
+    :param shared_memory: True to hand the timetables to the workers in shared memory
+    :return: tuple of (list of saved paths, number of failed tasks)
+    """
+    tasks = [(mode, day, window, list(groupings)) for mode in timetables for day in days for window in windows]
+    results = []
+    failed = 0
+    with RunReport('frequency', output_folder, profile=profile, trace_memory=trace_memory) as report:
+        with report.stage('load'):
+            _TIMETABLES.update(load_timetables(timetables))
+        report.count('rows_read', sum(len(df) for is_rail, df in _TIMETABLES.values()))
+        progress = report.progress("Windows analyzed", total=len(tasks))
+
+        with report.stage('frequency'):
+            if workers <= 1 or len(tasks) <= 1:
+                set_memory_limit(memory_limit)
+                for task in tasks:
+                    try:
+                        results.extend(frequency_task(*task))
+                    except Exception as e:
+                        print("{} {} {} - failed: {!r}".format(*task[:3], e), file=sys.stderr)
+                        failed += 1
+                    progress.update()
+            else:
+                #   Forked workers share the loaded timetables copy-on-write, nothing is pickled or loaded again.
+                if 'fork' in multiprocessing.get_all_start_methods():
+                    context, initargs = multiprocessing.get_context('fork'), (None, memory_limit)
+                else:
+                    context, initargs = None, (timetables, memory_limit)
+                shared = {}
+                if shared_memory:
+                    #   Workers attach to a single copy in shared memory instead.
+                    shared = share_timetables()
+                    report.count('shared_bytes', sum(table.nbytes for is_rail, table in shared.values()))
+                    initargs = (None, memory_limit, {mode: (is_rail, table.spec)
+                                                     for mode, (is_rail, table) in shared.items()})
+                try:
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                                initializer=_init_worker,
+                                                                initargs=initargs) as executor:
+                        futures = {executor.submit(frequency_task, *task): task for task in tasks}
+                        for future in concurrent.futures.as_completed(futures):
+                            try:
+                                results.extend(future.result())
+                            except Exception as e:
+                                print("{} {} {} - failed: {!r}".format(*futures[future][:3], e), file=sys.stderr)
+                                failed += 1
+                            progress.update()
+                finally:
+                    for is_rail, table in shared.values():
+                        table.close()
+                        table.unlink()
+        progress.close()
+        _TIMETABLES.clear()
+
+        with report.stage('write'):
+            saved = write_results(sorted(results, key=lambda result: result[0]), output_folder, formats=formats)
+        report.count('rows_emitted', sum(len(frequency) for output, frequency in results))
+        report.count('failed', failed)
+    return saved, failed
+
+
+def main():
+    """
+    Given variables: DAYS / WINDOWS / GROUPINGS, this function will analyze all timetables in the timetable folder in
+    parallel and save a .csv with stop frequency for every day and time window.
+    :return:
+    """
+    START = time.time()
+    print("Frequency calculation commencing.")
+    timetables = {file.replace('_timetable.csv', '').replace('_stop_times.csv', ''):
+                      os.path.join(paths['timetable'], file)
+                  for file in sorted(os.listdir(paths['timetable']))
+                  if file.endswith('timetable.csv') or file.endswith('_stop_times.csv')}
+    run_frequencies(timetables, DAYS, WINDOWS, paths['output'], groupings=GROUPINGS, workers=WORKERS)
+    print("\nFinished.\nTotal runtime: {0:.7}".format(str(datetime.timedelta(seconds=time.time() - START))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+"""
+gtfs_writer.py
+
+Write .cif timetables as GTFS feeds - agency, stops, routes, trips, stop_times, calendar and calendar_dates tables,
+zipped into <name>_gtfs.zip. Both ATCO-CIF and rail .cif files are supported:
+- ATCO-CIF - QS journey headers, QO/QI/QT stops, QE date running exceptions, QL/QB locations (OSGB grid references
+are converted to WGS84 latitude/longitude) and QP operators,
+- rail .cif - BS/BX schedules, LO/LI/LT calls and TI TIPLOC inserts. Passing points are left out; STP overlays and
+cancellations remove their dates from the permanent schedule of the same train.
+
+The .cif file is read once. stop_times.txt is written journey by journey as the file is read, so only one journey
+worth of stops is held in memory at any time - the other tables hold one row per journey, route or stop.
+
+"""
+import csv
+import datetime
+import math
+import os
+import shutil
+import zipfile
+
+from atco_cif_parser import iter_atco_cif
+from compressed_input import get_member_name, open_cif
+from rail_cif_parser import iter_rail_cif, rail_time_seconds
+
+# GTFS requires an agency url and timezone - .cif files carry neither.
+AGENCY_URL = 'https://www.traveline.info'
+RAIL_AGENCY_URL = 'https://www.nationalrail.co.uk'
+AGENCY_TIMEZONE = 'Europe/London'
+
+# End date of journeys running until further notice.
+OPEN_END_DATE = '20991231'
+
+# GTFS route types of ATCO-CIF vehicle types, bus by default.
+ROUTE_TYPES = {
+    'BUS': 3,
+    'COACH': 3,
+    'TRAM': 0,
+    'METRO': 1,
+    'UNDERGROUND': 1,
+    'FERRY': 4,
+    'TRAIN': 2,
+    'RAIL': 2,
+}
+
+GTFS_COLUMNS = {
+    'agency': ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+    'stops': ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon'],
+    'routes': ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'],
+    'trips': ['route_id', 'service_id', 'trip_id', 'trip_short_name', 'direction_id', 'block_id'],
+    'stop_times': ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'pickup_type',
+                   'drop_off_type', 'timepoint'],
+    'calendar': ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                 'start_date', 'end_date'],
+    'calendar_dates': ['service_id', 'date', 'exception_type'],
+}
+
+# Airy 1830 ellipsoid and National Grid projection.
+_AIRY = (6377563.396, 6356256.909)
+_WGS84 = (6378137.000, 6356752.3142)
+_NATIONAL_GRID = {'F0': 0.9996012717, 'lat0': math.radians(49), 'lon0': math.radians(-2), 'N0': -100000, 'E0': 400000}
+# Helmert transformation OSGB36 -> WGS84 - translation in metres, scale in ppm, rotation in arc seconds.
+_HELMERT = {'tx': 446.448, 'ty': -125.157, 'tz': 542.060, 's': -20.4894, 'rx': 0.1502, 'ry': 0.2470, 'rz': 0.8421}
+
+
+def osgb_to_wgs84(easting, northing):
+    """
+    Convert an OSGB36 National Grid reference into WGS84 latitude and longitude, accurate to a few metres.
+    :param easting: easting in metres
+    :param northing: northing in metres
+    :return: tuple of (latitude, longitude) in degrees
+    """
+    a, b = _AIRY
+    F0, lat0, lon0, N0, E0 = (_NATIONAL_GRID[key] for key in ['F0', 'lat0', 'lon0', 'N0', 'E0'])
+    e2 = 1 - (b * b) / (a * a)
+    n = (a - b) / (a + b)
+
+    #   Inverse Transverse Mercator - grid reference to OSGB36 latitude/longitude.
+    lat, M = lat0, 0
+    while True:
+        lat = (northing - N0 - M) / (a * F0) + lat
+        Ma = (1 + n + (5 / 4) * n ** 2 + (5 / 4) * n ** 3) * (lat - lat0)
+        Mb = (3 * n + 3 * n ** 2 + (21 / 8) * n ** 3) * math.sin(lat - lat0) * math.cos(lat + lat0)
+        Mc = ((15 / 8) * n ** 2 + (15 / 8) * n ** 3) * math.sin(2 * (lat - lat0)) * math.cos(2 * (lat + lat0))
+        Md = (35 / 24) * n ** 3 * math.sin(3 * (lat - lat0)) * math.cos(3 * (lat + lat0))
+        M = b * F0 * (Ma - Mb + Mc - Md)
+        if abs(northing - N0 - M) < 0.00001:
+            break
+
+    sin_lat, cos_lat, tan_lat = math.sin(lat), math.cos(lat), math.tan(lat)
+    nu = a * F0 / math.sqrt(1 - e2 * sin_lat ** 2)
+    rho = a * F0 * (1 - e2) / (1 - e2 * sin_lat ** 2) ** 1.5
+    eta2 = nu / rho - 1
+    sec_lat = 1 / cos_lat
+    VII = tan_lat / (2 * rho * nu)
+    VIII = tan_lat / (24 * rho * nu ** 3) * (5 + 3 * tan_lat ** 2 + eta2 - 9 * tan_lat ** 2 * eta2)
+    IX = tan_lat / (720 * rho * nu ** 5) * (61 + 90 * tan_lat ** 2 + 45 * tan_lat ** 4)
+    X = sec_lat / nu
+    XI = sec_lat / (6 * nu ** 3) * (nu / rho + 2 * tan_lat ** 2)
+    XII = sec_lat / (120 * nu ** 5) * (5 + 28 * tan_lat ** 2 + 24 * tan_lat ** 4)
+    XIIA = sec_lat / (5040 * nu ** 7) * (61 + 662 * tan_lat ** 2 + 1320 * tan_lat ** 4 + 720 * tan_lat ** 6)
+    dE = easting - E0
+    lat = lat - VII * dE ** 2 + VIII * dE ** 4 - IX * dE ** 6
+    lon = lon0 + X * dE - XI * dE ** 3 + XII * dE ** 5 - XIIA * dE ** 7
+
+    #   Helmert transformation - OSGB36 cartesian coordinates to WGS84.
+    nu = a / math.sqrt(1 - e2 * math.sin(lat) ** 2)
+    x = nu * math.cos(lat) * math.cos(lon)
+    y = nu * math.cos(lat) * math.sin(lon)
+    z = (1 - e2) * nu * math.sin(lat)
+    s = _HELMERT['s'] / 1e6 + 1
+    rx, ry, rz = (math.radians(_HELMERT[key] / 3600) for key in ['rx', 'ry', 'rz'])
+    x, y, z = (_HELMERT['tx'] + x * s - y * rz + z * ry,
+               _HELMERT['ty'] + x * rz + y * s - z * rx,
+               _HELMERT['tz'] - x * ry + y * rx + z * s)
+
+    #   Cartesian coordinates to WGS84 latitude/longitude.
+    a, b = _WGS84
+    e2 = 1 - (b * b) / (a * a)
+    p = math.sqrt(x ** 2 + y ** 2)
+    lat = math.atan2(z, p * (1 - e2))
+    while True:
+        nu = a / math.sqrt(1 - e2 * math.sin(lat) ** 2)
+        previous, lat = lat, math.atan2(z + e2 * nu * math.sin(lat), p)
+        if abs(lat - previous) < 1e-12:
+            break
+    return round(math.degrees(lat), 6), round(math.degrees(math.atan2(y, x)), 6)
+
+
+def format_gtfs_time(seconds):
+    """
+    Format seconds past midnight of the service day as a GTFS time - hours may go past 24.
+    """
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def get_day_offsets(times):
+    """
+    Make times of a journey increase monotonically - a journey running past midnight continues into hours past 24.
+    :param times: list of seconds past midnight, None for a missing time
+    :return: list of seconds past midnight of the service day
+    """
+    offset = 0
+    previous = None
+    result = []
+    for seconds in times:
+        if seconds is None:
+            result.append(None)
+            continue
+        if previous is not None and seconds + offset < previous:
+            offset += 86400
+        previous = seconds + offset
+        result.append(previous)
+    return result
+
+
+def expand_dates(start, end):
+    """
+    List all dates of a period.
+    :param start: first date as YYYYMMDD
+    :param end: last date as YYYYMMDD
+    :return: list of YYYYMMDD dates
+    """
+    day = datetime.datetime.strptime(start, '%Y%m%d').date()
+    last = datetime.datetime.strptime(end, '%Y%m%d').date()
+    dates = []
+    while day <= last:
+        dates.append(day.strftime('%Y%m%d'))
+        day += datetime.timedelta(days=1)
+    return dates
+
+
+class GtfsFeed(object):
+    """
+    GTFS feed written to a folder. Stop times are written straight to stop_times.txt; agencies, stops, routes, trips
+    and services are kept until close(), which writes the remaining tables and zips the feed.
+    :param folder: folder to write the feed tables in
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.agencies = {}
+        self.stops = {}
+        self.routes = {}
+        self.trips = []
+        self.trip_ids = set()
+        self.stop_ids = set()
+        self.counters = {'trips': 0, 'stop_times': 0, 'untimed_stop_times': 0, 'untimed_trips': 0}
+        self._stop_times_file = open(os.path.join(folder, 'stop_times.txt'), 'w', newline='')
+        self._stop_times = csv.writer(self._stop_times_file)
+        self._stop_times.writerow(GTFS_COLUMNS['stop_times'])
+
+    def add_agency(self, agency_id, agency_name=None, agency_url=AGENCY_URL):
+        if agency_name or agency_id not in self.agencies:
+            self.agencies[agency_id] = [agency_id, agency_name or agency_id, agency_url, AGENCY_TIMEZONE]
+
+    def add_stop(self, stop_id, stop_name='', stop_code='', easting=None, northing=None):
+        """
+        Add a stop, converting its OSGB grid reference to WGS84 if there is one.
+        """
+        lat, lon = '', ''
+        if easting and northing:
+            lat, lon = osgb_to_wgs84(float(easting), float(northing))
+        self.stops[stop_id] = [stop_id, stop_code, stop_name, lat, lon]
+
+    def add_route(self, route_id, agency_id, route_short_name='', route_long_name='', route_type=3):
+        if route_id not in self.routes:
+            self.routes[route_id] = [route_id, agency_id, route_short_name, route_long_name, route_type]
+
+    def add_trip(self, route_id, trip_id, calendar, stop_times, trip_short_name='', direction_id='', block_id=''):
+        """
+        Add a trip and write its stop times.
+        :param calendar: tuple of (days of operation as a 7 character string of 0/1, start date, end date, tuple of
+        (date, exception type) pairs)
+        :param stop_times: list of (arrival seconds, departure seconds, stop id, pickup type, drop off type, timepoint)
+        - stop times without either time are left out
+        :return: unique trip id, None for trips left out for having less than two timed stops
+        """
+        timed = [stop_time for stop_time in stop_times if stop_time[0] is not None or stop_time[1] is not None]
+        self.counters['untimed_stop_times'] += len(stop_times) - len(timed)
+        if len(timed) < 2:
+            self.counters['untimed_trips'] += 1
+            return None
+        #   Trip ids have to be unique - the same journey may run with different calendars.
+        unique_trip_id, i = trip_id, 1
+        while unique_trip_id in self.trip_ids:
+            i += 1
+            unique_trip_id = '{}_{}'.format(trip_id, i)
+        self.trip_ids.add(unique_trip_id)
+
+        times = get_day_offsets([seconds for stop_time in timed for seconds in stop_time[0:2]])
+        for sequence, (stop_time, arrival, departure) in enumerate(zip(timed, times[0::2], times[1::2])):
+            arrival = arrival if arrival is not None else departure
+            departure = departure if departure is not None else arrival
+            self._stop_times.writerow([unique_trip_id, format_gtfs_time(arrival), format_gtfs_time(departure),
+                                       stop_time[2], sequence + 1] + list(stop_time[3:]))
+            self.stop_ids.add(stop_time[2])
+        self.trips.append([route_id, calendar, unique_trip_id, trip_short_name, direction_id, block_id])
+        self.counters['trips'] += 1
+        self.counters['stop_times'] += len(timed)
+        return unique_trip_id
+
+    def write_table(self, table, rows):
+        with open(os.path.join(self.folder, table + '.txt'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(GTFS_COLUMNS[table])
+            writer.writerows(rows)
+
+    def close(self, zip_feed=True):
+        """
+        Write all tables but stop_times, which is already written, and zip the feed.
+        :param zip_feed: True to zip the feed into <folder>.zip and remove the folder
+        :return: path to the feed
+        """
+        self._stop_times_file.close()
+
+        #   Journeys sharing days, dates and exceptions of operation share a service.
+        services = {}
+        for trip in self.trips:
+            trip[1] = services.setdefault(trip[1], 'S{}'.format(len(services) + 1))
+        calendar = []
+        calendar_dates = []
+        for (days, start_date, end_date, exceptions), service_id in services.items():
+            calendar.append([service_id] + list(days) + [start_date, end_date])
+            calendar_dates.extend([service_id, date, exception_type] for date, exception_type in exceptions)
+
+        #   Every stop served has to be listed, even without a location record.
+        for stop_id in self.stop_ids - set(self.stops):
+            self.stops[stop_id] = [stop_id, '', stop_id, '', '']
+        self.counters['stops_without_coordinates'] = sum(1 for stop in self.stops.values() if stop[3] == '')
+
+        self.write_table('agency', self.agencies.values())
+        self.write_table('stops', self.stops.values())
+        self.write_table('routes', self.routes.values())
+        self.write_table('trips', self.trips)
+        self.write_table('calendar', calendar)
+        self.write_table('calendar_dates', calendar_dates)
+        if not zip_feed:
+            return self.folder
+
+        path = self.folder.rstrip(os.sep) + '.zip'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+            for table in GTFS_COLUMNS:
+                z.write(os.path.join(self.folder, table + '.txt'), table + '.txt')
+        shutil.rmtree(self.folder)
+        return path
+
+
+def get_atco_stop_times(stops):
+    """
+    GTFS stop times of an ATCO-CIF journey.
+    :param stops: list of decoded QO/QI/QT records
+    :return: list of (arrival seconds, departure seconds, stop id, pickup type, drop off type, timepoint)
+    """
+    stop_times = []
+    for stop in stops:
+        arrival = stop.get('published_arrival_time')
+        departure = stop.get('published_departure_time')
+        # Activity: B - pick up and set down, P - pick up only, S - set down only, N - neither.
+        activity = stop.get('activity_flag') or {'QO': 'P', 'QT': 'S'}.get(stop['record_identity'], 'B')
+        stop_times.append((
+            arrival.hour * 3600 + arrival.minute * 60 if arrival else None,
+            departure.hour * 3600 + departure.minute * 60 if departure else None,
+            stop['location'],
+            0 if activity in ('B', 'P') else 1,
+            0 if activity in ('B', 'S') else 1,
+            1 if stop.get('timing_point_indicator') == 'T1' else 0,
+        ))
+    return stop_times
+
+
+def write_atco_gtfs(file, output_folder, name=None, zip_feed=True, tables=None):
+    """
+    Convert an ATCO-CIF .cif file into a GTFS feed in a single pass.
+    :param file: path to .cif file
+    :param output_folder: folder to save the feed in
+    :param name: name of the feed, the .cif file name by default
+    :param zip_feed: True to zip the feed into <name>_gtfs.zip
+    :param tables: optional dictionary to be filled with parser counts - see atco_cif_parser.iter_atco_cif
+    :return: tuple of (path to the feed, dictionary of counts)
+    """
+    name = name or os.path.splitext(get_member_name(file))[0]
+    feed = GtfsFeed(os.path.join(output_folder, name + '_gtfs'))
+    tables = tables if tables is not None else {}
+    with open_cif(file) as f:
+        for journey in iter_atco_cif(f, records=['QS', 'QE', 'QO', 'QI', 'QT', 'QL', 'QB', 'QP'], tables=tables):
+            header = journey['header']
+            if header.get('transaction_type') == 'D' or len(journey['stops']) < 2:
+                continue
+            feed.add_agency(header['operator'])
+            route_number = header['route_number_(identifier)']
+            route_id = '{}_{}'.format(header['operator'], route_number)
+            feed.add_route(route_id, header['operator'], route_short_name=route_number,
+                           route_type=ROUTE_TYPES.get(header['vehicle_type'].upper(), 3))
+            days = ''.join(header['operates_on_' + day + 's'] for day in
+                           ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'])
+            # Operation code 1 - runs on the exceptional dates, 0 - does not.
+            exceptions = tuple((date, 1 if exception['operation_code'] == '1' else 2)
+                               for exception in journey['exceptions']
+                               for date in expand_dates(exception['start_of_exceptional_period'],
+                                                        exception['end_of_exceptional_period']))
+            calendar = (days, header['first_date_of_operation'], header['last_date_of_operation'] or OPEN_END_DATE,
+                        exceptions)
+            feed.add_trip(route_id, header['unique_identifier'], calendar, get_atco_stop_times(journey['stops']),
+                          trip_short_name=header['unique_journey_identifier'],
+                          direction_id={'O': 0, 'I': 1}.get(header['route_direction'], ''),
+                          block_id=header.get('running_board', ''))
+
+    for location in tables.get('locations', []):
+        feed.add_stop(location['location'], stop_name=location.get('full_location', ''),
+                      stop_code=location.get('national_gazetteer_id', ''),
+                      easting=location.get('grid_reference_easting'), northing=location.get('grid_reference_northing'))
+    for operator in tables.get('QP', []):
+        feed.add_agency(operator['operator'], operator['operator_legal_name'] or operator['operator_short_form'])
+    return feed.close(zip_feed=zip_feed), feed.counters
+
+
+def get_rail_stop_times(stops):
+    """
+    GTFS stop times of a rail schedule. Passing points are left out; calls without public times are kept with their
+    working times, but closed to passengers.
+    :param stops: list of decoded LO/LI/LT records
+    :return: list of (arrival seconds, departure seconds, stop id, pickup type, drop off type, timepoint)
+    """
+    stop_times = []
+    for stop in stops:
+        if stop.get('scheduled_pass'):
+            continue
+        arrival = stop.get('public_arrival_time', '')
+        departure = stop.get('public_departure_time', '')
+        # Public time of 0000 means no public call.
+        public = (arrival or '0000') != '0000' or (departure or '0000') != '0000'
+        if public:
+            arrival, departure = rail_time_seconds(arrival), rail_time_seconds(departure)
+        else:
+            arrival = rail_time_seconds(stop.get('scheduled_arrival_time', ''))
+            departure = rail_time_seconds(stop.get('scheduled_departure_time', ''))
+        stop_times.append((
+            arrival,
+            departure,
+            # Location is a TIPLOC followed by a suffix telling apart repeated calls.
+            stop['location'][:7].rstrip(),
+            0 if public and stop['record_identity'] != 'LT' else 1,
+            0 if public and stop['record_identity'] != 'LO' else 1,
+            1,
+        ))
+    return stop_times
+
+
+def get_rail_date(value):
+    """
+    Convert a yymmdd rail .cif date into YYYYMMDD.
+    """
+    return '20' + value if value else ''
+
+
+def write_rail_gtfs(file, output_folder, name=None, zip_feed=True, tables=None):
+    """
+    Convert a rail .cif file into a GTFS feed in a single pass.
+    :param file: path to .cif file
+    :param output_folder: folder to save the feed in
+    :param name: name of the feed, the .cif file name by default
+    :param zip_feed: True to zip the feed into <name>_gtfs.zip
+    :param tables: optional dictionary to be filled with parser counts - see rail_cif_parser.iter_rail_cif
+    :return: tuple of (path to the feed, dictionary of counts)
+    """
+    name = name or os.path.splitext(get_member_name(file))[0]
+    feed = GtfsFeed(os.path.join(output_folder, name + '_gtfs'))
+    tables = tables if tables is not None else {}
+    # Permanent schedules and STP overlays/cancellations - (trip index, days, start, end) per train uid.
+    permanent = {}
+    overlays = {}
+    with open_cif(file) as f:
+        for journey in iter_rail_cif(f, records=['HD', 'TI', 'BS', 'BX', 'LO', 'LI', 'LT'], tables=tables):
+            header = journey['header']
+            if header.get('transaction_type') == 'D':
+                continue
+            days, start_date = header['days_run'], get_rail_date(header['date_runs_from'])
+            end_date = get_rail_date(header['date_runs_to']) or start_date
+            if header['stp_indicator'] in ('O', 'C'):
+                overlays.setdefault(header['train_uid'], []).append((days, start_date, end_date))
+            stop_times = get_rail_stop_times(journey['stops'])
+            if header['stp_indicator'] == 'C' or len(stop_times) < 2:
+                continue
+
+            agency_id = (journey['extra'] or {}).get('atoc_code') or 'ZZ'
+            feed.add_agency(agency_id, agency_url=RAIL_AGENCY_URL)
+            origin, destination = stop_times[0][2], stop_times[-1][2]
+            route_id = '{}_{}_{}'.format(agency_id, origin, destination)
+            feed.add_route(route_id, agency_id, route_long_name=(origin, destination), route_type=2)
+            trip_id = feed.add_trip(route_id, header['unique_identifier'] + '_' + header['stp_indicator'],
+                                    (days, start_date, end_date, ()), stop_times,
+                                    trip_short_name=header['train_identity'])
+            if trip_id is not None and header['stp_indicator'] in ('P', 'N'):
+                permanent.setdefault(header['train_uid'], []).append(len(feed.trips) - 1)
+
+    #   Dates on which an overlay or a cancellation runs are removed from the permanent schedule.
+    for train_uid, trip_indices in permanent.items():
+        for i in trip_indices:
+            days, start_date, end_date, exceptions = feed.trips[i][1]
+            removed = set()
+            for overlay_days, overlay_start, overlay_end in overlays.get(train_uid, []):
+                for date in expand_dates(max(start_date, overlay_start), min(end_date, overlay_end)):
+                    weekday = datetime.datetime.strptime(date, '%Y%m%d').weekday()
+                    if days[weekday] == '1' and overlay_days[weekday] == '1':
+                        removed.add((date, 2))
+            feed.trips[i][1] = (days, start_date, end_date, tuple(sorted(removed)))
+
+    #   Name stops and routes after TIPLOC descriptions.
+    tiplocs = {tiploc['tiploc_code']: tiploc for tiploc in tables['tiplocs']}
+    for tiploc_code, tiploc in tiplocs.items():
+        feed.add_stop(tiploc_code, stop_name=tiploc['tps_description'], stop_code=tiploc['crs_code'])
+    for route in feed.routes.values():
+        route[3] = ' - '.join(tiplocs.get(tiploc_code, {}).get('tps_description') or tiploc_code
+                              for tiploc_code in route[3])
+    return feed.close(zip_feed=zip_feed), feed.counters
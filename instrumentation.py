@@ -0,0 +1,226 @@
+"""
+instrumentation.py
+
+Lightweight run instrumentation shared by the converters and frequency counters:
+- stage timers,
+- counters (records read/skipped, journeys, rows emitted...),
+- throttled progress reporting - at most one line every few seconds instead of one line per journey,
+- optional cProfile and tracemalloc hooks,
+- a .json run report saved next to the outputs.
+
+A run report is made active with `with RunReport(...) as report:`; code deeper down the call stack picks it up
+with get_report(), so functions don't need an extra argument. When no report is active, get_report() returns a
+report which does nothing.
+
+"""
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import time
+
+_active_reports = []
+
+
+class Progress(object):
+    """
+    Throttled progress reporter - prints at most once every `interval` seconds.
+    """
+    __slots__ = ('label', 'total', 'interval', 'stream', 'count', 'start', 'last')
+
+    def __init__(self, label, total=None, interval=5.0, stream=None):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.count = 0
+        self.start = self.last = time.time()
+
+    def update(self, n=1):
+        self.count += n
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def report(self, now=None):
+        if self.stream is None:
+            return
+        elapsed = (now or time.time()) - self.start
+        rate = self.count / elapsed if elapsed else 0
+        if self.total:
+            message = "{}: {}/{} ({:.0%}), {:.0f}/s".format(self.label, self.count, self.total,
+                                                           self.count / self.total, rate)
+        else:
+            message = "{}: {}, {:.0f}/s".format(self.label, self.count, rate)
+        print(message, file=self.stream)
+        self.stream.flush()
+
+    def close(self):
+        self.report()
+
+
+class RunReport(object):
+    """
+    Collects stage timings, counters and optional profiles of a single run and writes them to a .json file.
+    :param name: name of the run, e.g. the .cif file name
+    :param output_folder: folder to save the report in, None to keep it in memory only
+    :param profile: True to run cProfile over the whole run
+    :param trace_memory: True to trace Python memory allocations with tracemalloc
+    :param progress_interval: seconds between progress lines
+    :param stream: stream for progress lines, sys.stdout by default
+    """
+
+    def __init__(self, name, output_folder=None, profile=False, trace_memory=False, progress_interval=5.0,
+                 stream=None):
+        self.name = name
+        self.output_folder = output_folder
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.progress_interval = progress_interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.stages = {}
+        self.counters = {}
+        self.info = {}
+        self.start = None
+        self.end = None
+        self._profiler = None
+
+    def __enter__(self):
+        self.start = time.time()
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        _active_reports.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_reports.remove(self)
+        self.end = time.time()
+        if exc_type is not None:
+            self.info['error'] = repr(exc_value)
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self.trace_memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            self.info['traced_memory_peak_mb'] = round(peak / 1024 ** 2, 2)
+            tracemalloc.stop()
+        if self.output_folder is not None:
+            self.save()
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the run. Repeated stages add up.
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """
+        Add time spent in a stage that was measured elsewhere, e.g. in a worker process.
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, label, total=None):
+        return Progress(label, total=total, interval=self.progress_interval, stream=self.stream)
+
+    def to_dict(self):
+        end = self.end or time.time()
+        d = {
+            'name': self.name,
+            'started': datetime.datetime.fromtimestamp(self.start).isoformat() if self.start else None,
+            'runtime_s': round(end - self.start, 4) if self.start else None,
+            'stages_s': {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+            'peak_rss_mb': get_peak_rss(),
+        }
+        d.update(self.info)
+        if self._profiler is not None:
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+            d['profile'] = stream.getvalue().splitlines()
+        return d
+
+    def save(self):
+        """
+        Save the report as <name>_run_report.json in the output folder, and the raw cProfile stats as
+        <name>_profile.prof if profiling was on.
+        :return: path to saved report
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        path = os.path.join(self.output_folder, '{}_run_report.json'.format(self.name))
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        if self._profiler is not None:
+            self._profiler.dump_stats(os.path.join(self.output_folder, '{}_profile.prof'.format(self.name)))
+        return path
+
+
+class _NullReport(RunReport):
+    """
+    Report used when none is active - keeps counters in memory, never prints or saves anything.
+    """
+
+    def __init__(self):
+        RunReport.__init__(self, 'null', stream=None)
+        self.stream = None
+
+    def progress(self, label, total=None):
+        return Progress(label, total=total, interval=float('inf'), stream=None)
+
+
+def get_report():
+    """
+    Get the innermost active run report, or a report which does nothing if none is active.
+    """
+    if _active_reports:
+        return _active_reports[-1]
+    return _NullReport()
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of the current process in MB, None where not available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def set_memory_limit(limit):
+    """
+    Cap the address space of the current process, so a runaway worker fails with MemoryError instead of taking
+    the whole node down.
+    :param limit: number of bytes, None for no limit
+    """
+    if not limit:
+        return
+    try:
+        import resource
+    except ImportError:
+        print("Memory limit is not supported on this platform - ignoring.", file=sys.stderr)
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
@@ -0,0 +1,168 @@
+"""
+interchange.py
+
+Interchange opportunities across modes. Arrivals and departures of all converted timetables - ferry, coach, metro,
+tram, bus and rail - are merged per stop, and for every arrival the departures of each other mode within the transfer
+window are counted:
+
+    python cif_timetable_reader.py interchange "timetables/*_timetable.csv" -o interchange --day tuesday
+        --min-transfer 2 --max-transfer 15
+    python cif_timetable_reader.py interchange "timetables/*_timetable.csv" -o interchange --day tuesday
+        --locations "timetables/*_locations.csv" --radius 250
+
+Departures are held in a single array sorted by stop, mode and time, so the departures within the window of every
+arrival are found with two binary searches (numpy.searchsorted) per mode, without joining arrivals to departures.
+
+Stops are matched by their code. With --locations and --radius, ATCO-CIF stops within the radius of each other
+(by grid reference) are merged into one interchange, e.g. a bus stop outside a metro station. Rail .cif files
+carry no coordinates, so rail stations only interchange at matching codes. Rail passing points and other calls
+without public times are not arrivals or departures.
+
+"""
+import numpy as np
+import pandas as pd
+
+from connection_scan import get_minutes, get_public_minutes, load_timetable
+
+# Timetable columns needed to find arrivals and departures.
+EVENT_COLUMNS = ['location', 'vehicle_type', 'activity_flag', 'published_arrival_time', 'published_departure_time',
+                 'public_arrival_time', 'public_departure_time', 'scheduled_pass', 'activity']
+
+# ATCO-CIF activity flags of stops passengers can get off and get on at. Rail calls are only used by passengers at
+# their public times - see connection_scan.get_public_minutes.
+SET_DOWN = ['B', 'S']
+PICK_UP = ['B', 'P']
+
+# Mode of rail timetables.
+RAIL_MODE = 'Rail'
+
+# Width of the time range of one stop and mode in the sorted departure keys - departures of the next day included.
+SPAN = 4 * 1440
+
+
+def get_events(df):
+    """
+    Arrivals and departures of a timetable.
+    :param df: timetable dataframe - see load_events
+    :return: tuple of (arrivals, departures) dataframes of location, mode and time (minutes past midnight)
+    """
+    if 'public_arrival_time' in df.columns:
+        arrival, departure = get_public_minutes(df)
+        mode = np.full(len(df), RAIL_MODE, dtype=object)
+        set_down = pick_up = np.ones(len(df), dtype=bool)
+    else:
+        arrival, departure = get_minutes(df['published_arrival_time']), get_minutes(df['published_departure_time'])
+        mode = df['vehicle_type'].fillna('Unknown').astype(str).str.strip().to_numpy() \
+            if 'vehicle_type' in df.columns else np.full(len(df), 'Unknown', dtype=object)
+        flag = df['activity_flag'].fillna('B').astype(str).str.strip().replace('', 'B') \
+            if 'activity_flag' in df.columns else pd.Series('B', index=df.index)
+        set_down, pick_up = flag.isin(SET_DOWN).to_numpy(), flag.isin(PICK_UP).to_numpy()
+    location = df['location'].astype(str).str.strip().to_numpy()
+    arrivals = ~np.isnan(arrival) & set_down
+    departures = ~np.isnan(departure) & pick_up
+    return pd.DataFrame({'location': location[arrivals], 'mode': mode[arrivals], 'time': arrival[arrivals]}), \
+        pd.DataFrame({'location': location[departures], 'mode': mode[departures], 'time': departure[departures]})
+
+
+def load_events(paths, day):
+    """
+    Load arrivals and departures of all timetables on a day of operation.
+    :param paths: list of paths to flat timetable .csv, stop_times tables of normalized timetables or timetable stores
+    :param day: day of week
+    :return: tuple of (arrivals, departures) dataframes
+    """
+    events = [get_events(load_timetable(path, day=day, columns=EVENT_COLUMNS)) for path in paths]
+    return pd.concat([arrivals for arrivals, _ in events], ignore_index=True), \
+        pd.concat([departures for _, departures in events], ignore_index=True)
+
+
+def group_nearby_stops(locations, radius):
+    """
+    Merge stops within a radius of each other into interchanges - stops are linked to every stop closer than the
+    radius, and linked stops form one interchange.
+    :param locations: dataframe of location, grid_reference_easting and grid_reference_northing, e.g. the
+    <name>_locations.csv tables saved by CIF_timetable_converter.py
+    :param radius: radius in metres
+    :return: dictionary of location: interchange name - the first location of the interchange
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+
+    locations = locations.assign(location=locations['location'].astype(str).str.strip(),
+                                 easting=pd.to_numeric(locations['grid_reference_easting'], errors='coerce'),
+                                 northing=pd.to_numeric(locations['grid_reference_northing'], errors='coerce')) \
+        .dropna(subset=['easting', 'northing']).drop_duplicates('location').sort_values('location')
+    points = locations[['easting', 'northing']].to_numpy()
+    pairs = cKDTree(points).query_pairs(radius, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(points), len(points)))
+    _, labels = connected_components(graph, directed=False)
+    names = locations['location'].to_numpy()
+    first = pd.Series(names).groupby(labels).first()
+    return dict(zip(names, first[labels].to_numpy()))
+
+
+def get_interchanges(arrivals, departures, min_transfer=0, max_transfer=15, groups=None, same_mode=False,
+                     window=None):
+    """
+    Count the departures on each mode within the transfer window of every arrival, by stop and pair of modes.
+    :param arrivals: arrivals dataframe of location, mode and time - see get_events
+    :param departures: departures dataframe of location, mode and time
+    :param min_transfer: minimum minutes between arrival and departure
+    :param max_transfer: maximum minutes between arrival and departure
+    :param groups: optional dictionary of location: interchange - see group_nearby_stops
+    :param same_mode: True to also count connections between journeys of the same mode
+    :param window: optional (start, end) minutes past midnight to only count arrivals within
+    :return: dataframe of interchange, arriving_mode, departing_mode, arrivals, connected_arrivals, connections
+    (departures within the window of all arrivals) and mean_wait (minutes to the first connection)
+    """
+    if groups:
+        arrivals = arrivals.assign(location=arrivals['location'].map(groups).fillna(arrivals['location']))
+        departures = departures.assign(location=departures['location'].map(groups).fillna(departures['location']))
+    if window:
+        arrivals = arrivals[(arrivals['time'] >= window[0]) & (arrivals['time'] <= window[1])]
+    stop_codes, stops = pd.factorize(pd.concat([arrivals['location'], departures['location']], ignore_index=True))
+    mode_codes, modes = pd.factorize(pd.concat([arrivals['mode'], departures['mode']], ignore_index=True))
+    n_modes = len(modes)
+    arrival_stop, departure_stop = stop_codes[:len(arrivals)], stop_codes[len(arrivals):]
+    arrival_mode, departure_mode = mode_codes[:len(arrivals)], mode_codes[len(arrivals):]
+    arrival_time = arrivals['time'].to_numpy(dtype=np.int64)
+
+    # Departures sorted by stop, mode and time - those of the next day follow, for arrivals late in the evening.
+    base = (departure_stop.astype(np.int64) * n_modes + departure_mode) * SPAN
+    departure_time = departures['time'].to_numpy(dtype=np.int64)
+    keys = np.sort(np.r_[base + departure_time, base + departure_time + 1440])
+    served = np.unique(departure_stop.astype(np.int64) * n_modes + departure_mode)
+
+    frames = []
+    for mode in range(n_modes):
+        # Only arrivals at stops with departures on the mode.
+        rows = np.isin(arrival_stop.astype(np.int64) * n_modes + mode, served)
+        if not same_mode:
+            rows &= arrival_mode != mode
+        if not rows.any():
+            continue
+        start = (arrival_stop[rows].astype(np.int64) * n_modes + mode) * SPAN + arrival_time[rows]
+        first = np.searchsorted(keys, start + min_transfer, side='left')
+        last = np.searchsorted(keys, start + max_transfer, side='right')
+        connections = last - first
+        wait = np.where(connections > 0, keys[np.minimum(first, len(keys) - 1)] - start, np.nan)
+        frames.append(pd.DataFrame({
+            'interchange': stops[arrival_stop[rows]],
+            'arriving_mode': modes[arrival_mode[rows]],
+            'departing_mode': modes[mode],
+            'connections': connections,
+            'connected': connections > 0,
+            'wait': wait,
+        }))
+    columns = ['interchange', 'arriving_mode', 'departing_mode', 'arrivals', 'connected_arrivals', 'connections',
+               'mean_wait']
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    result = pd.concat(frames, ignore_index=True) \
+        .groupby(['interchange', 'arriving_mode', 'departing_mode'], as_index=False) \
+        .agg(arrivals=('connected', 'size'), connected_arrivals=('connected', 'sum'),
+             connections=('connections', 'sum'), mean_wait=('wait', 'mean'))
+    result['mean_wait'] = result['mean_wait'].round(2)
+    return result[columns].sort_values(['connected_arrivals', 'interchange'], ascending=[False, True]) \
+        .reset_index(drop=True)
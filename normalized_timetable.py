@@ -0,0 +1,182 @@
+"""
+normalized_timetable.py
+
+Normalized timetable export. Instead of one flat .csv repeating all journey header fields on every stop, a timetable
+is saved as separate tables linked by journey_id, similar to GTFS:
+- journeys - one row per journey: identifiers, route, direction, operator, vehicle type...
+- stop_times - one row per stop of a journey, in order of stop_sequence,
+- stops - stop locations,
+- calendar - days and dates of operation of each journey,
+- calendar_dates - date running exceptions of each journey (ATCO-CIF only).
+
+load_normalized_timetable joins the tables back into a flat timetable, reading only the columns asked for, so the
+frequency counters and other tools never have to parse the columns they don't use.
+
+"""
+import os
+
+import pandas as pd
+
+TABLES = ['journeys', 'stop_times', 'stops', 'calendar', 'calendar_dates']
+
+DAY_COLUMNS = [
+    'operates_on_mondays',
+    'operates_on_tuesdays',
+    'operates_on_wednesdays',
+    'operates_on_thursdays',
+    'operates_on_fridays',
+    'operates_on_saturdays',
+    'operates_on_sundays',
+]
+
+# Columns of timetables created with CIF_timetable_converter.py kept in calendar and stop_times tables - all other
+# columns go to the journeys table.
+ATCO_CALENDAR_COLUMNS = DAY_COLUMNS + ['first_date_of_operation', 'last_date_of_operation', 'school_term_time',
+                                       'bank_holidays']
+ATCO_STOP_TIME_COLUMNS = [
+    'record_identity',
+    'location',
+    'published_arrival_time',
+    'published_departure_time',
+    'next_stop_id',
+    'next_stop_arrival_time',
+    'activity_flag',
+    'bay_number',
+    'fare_stage_indicator',
+    'timing_point_indicator',
+]
+
+# Columns of timetables created with ScotRail_CIF_timetable_converter.py kept in calendar and stop_times tables.
+RAIL_CALENDAR_COLUMNS = DAY_COLUMNS + ['date_runs_from', 'date_runs_to', 'bank_holiday_running']
+RAIL_STOP_TIME_COLUMNS = [
+    'record_identity',
+    'location',
+    'scheduled_arrival_time',
+    'scheduled_departure_time',
+    'public_arrival_time',
+    'public_departure_time',
+    'scheduled_pass',
+    'next_stop_id',
+    'next_stop_arrival_time',
+    'platform',
+    'line',
+    'path',
+    'engineering_allowance',
+    'pathing_allowance',
+    'activity',
+    'performance_allowance',
+]
+
+# Records starting a journey.
+ORIGIN_RECORDS = ['QO', 'LO']
+
+
+def normalize_timetable(df, stop_time_columns, calendar_columns):
+    """
+    Split a flat timetable into journeys, stop_times and calendar tables. Journeys are told apart by their origin
+    record, so journeys sharing a unique identifier stay separate.
+    :param df: flat timetable dataframe, stops of each journey in order
+    :param stop_time_columns: columns describing a single stop
+    :param calendar_columns: columns describing days and dates of operation
+    :return: dictionary of table name: dataframe
+    """
+    df = df.reset_index(drop=True)
+    starts = df['record_identity'].isin(ORIGIN_RECORDS)
+    journey_id = starts.cumsum() - 1
+    journey_columns = [column for column in df.columns
+                       if column not in stop_time_columns and column not in calendar_columns]
+
+    stop_times = df[stop_time_columns].copy()
+    stop_times.insert(0, 'stop_sequence', journey_id.groupby(journey_id).cumcount() + 1)
+    stop_times.insert(0, 'journey_id', journey_id)
+
+    journeys = df.loc[starts, journey_columns]
+    journeys.insert(0, 'journey_id', journey_id[starts])
+    calendar = df.loc[starts, calendar_columns]
+    calendar.insert(0, 'journey_id', journey_id[starts])
+    return {'journeys': journeys, 'stop_times': stop_times, 'calendar': calendar}
+
+
+def get_calendar_dates(exceptions, journeys):
+    """
+    Link date running exceptions read with atco_cif_parser to journeys of a normalized timetable.
+    :param exceptions: list of exception dictionaries with a journey 'unique_identifier'
+    :param journeys: journeys table
+    :return: calendar_dates table
+    """
+    columns = ['journey_id', 'start_of_exceptional_period', 'end_of_exceptional_period', 'operation_code']
+    if not exceptions:
+        return pd.DataFrame(columns=columns)
+    return journeys[['journey_id', 'unique_identifier']] \
+        .merge(pd.DataFrame(exceptions).astype({'unique_identifier': str}), on='unique_identifier') \
+        [columns]
+
+
+def write_normalized_timetable(tables, output_folder, name):
+    """
+    Save the tables of a normalized timetable as <name>_<table>.csv.
+    :param tables: dictionary of table name: dataframe
+    :param output_folder: folder to save the tables in
+    :param name: name of the timetable
+    :return: list of saved paths
+    """
+    saved = []
+    for table in TABLES:
+        if tables.get(table) is None:
+            continue
+        path = os.path.join(output_folder, '{}_{}.csv'.format(name, table))
+        tables[table].to_csv(path, index=False)
+        saved.append(path)
+    return saved
+
+
+def get_table_prefix(csv):
+    """
+    Path prefix shared by all tables of a normalized timetable, given the path to any one of them.
+    :param csv: path to one of the tables, e.g. timetables/Coach_1_stop_times.csv
+    :return: prefix, e.g. timetables/Coach_1
+    """
+    for table in TABLES:
+        if csv.endswith('_{}.csv'.format(table)):
+            return csv[:-len('_{}.csv'.format(table))]
+    raise ValueError("{} is not a table of a normalized timetable.".format(csv))
+
+
+def is_normalized_table(csv):
+    """
+    Check whether a .csv is a table of a normalized timetable.
+    """
+    return any(csv.endswith('_{}.csv'.format(table)) for table in TABLES)
+
+
+def is_rail_timetable(csv):
+    """
+    Check whether a timetable .csv was created with ScotRail_CIF_timetable_converter.py.
+    :param csv: path to timetable .csv
+    :return: True for rail timetables
+    """
+    with open(csv, "r") as f:
+        return 'train_uid' in f.readline().strip().split(',')
+
+
+def load_normalized_timetable(prefix, columns=None, dtype=None):
+    """
+    Join the stop_times, journeys and calendar tables of a normalized timetable into a flat timetable, one row per
+    stop. Only the tables holding requested columns are read, and only the requested columns of them.
+    :param prefix: path prefix of the tables - see get_table_prefix
+    :param columns: columns to load, all when not provided
+    :param dtype: optional dictionary of column dtypes
+    :return: timetable dataframe
+    """
+    dtype = dtype or {}
+    df = None
+    for table in ['stop_times', 'journeys', 'calendar']:
+        path = '{}_{}.csv'.format(prefix, table)
+        available = pd.read_csv(path, nrows=0).columns.tolist()
+        usecols = [column for column in available if column != 'journey_id' and (columns is None or column in columns)]
+        if df is not None and not usecols:
+            continue
+        frame = pd.read_csv(path, usecols=['journey_id'] + usecols,
+                            dtype={column: value for column, value in dtype.items() if column in usecols})
+        df = frame if df is None else df.merge(frame, how='left', on='journey_id')
+    return df
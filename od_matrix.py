@@ -0,0 +1,217 @@
+"""
+od_matrix.py
+
+Origin-destination service matrices. next_stop_id only links a stop to the one after it; the OD matrix counts the
+journeys running directly - without a change - from every stop to every later stop of the journey, by day of
+operation and time band of the departure from the origin:
+
+    python cif_timetable_reader.py od "timetables/*_timetable.csv" -o od --day tuesday --window 07:00-10:00 16:00-19:00
+
+All timetables of a day are merged and stops numbered 0..n-1. Each journey is walked once: its calls are grouped
+with journeys of the same length, every later call of each call is paired with it in one vectorized step and the
+pairs are summed into a SciPy sparse matrix per time band. Matrices are saved with scipy.sparse.save_npz next to a
+stop index, which any later analysis loads with ODMatrix.load:
+
+    od/od_tuesday_7_0_to_10_0.npz
+    od/od_tuesday_stops.csv
+
+A service counts once per journey, however many times the journey calls at the origin within the band. Passengers
+board at calls they can be picked up at and alight at calls they can be set down at (ATCO-CIF activity flags); rail
+passengers only at public times - passing points, calls not advertised and public times of 0000 are left out, see
+connection_scan.get_public_minutes.
+
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from connection_scan import get_minutes, get_public_minutes, load_timetable
+from interchange import PICK_UP, SET_DOWN
+from normalized_timetable import ORIGIN_RECORDS
+
+# Timetable columns needed to find the calls of each journey.
+OD_COLUMNS = ['record_identity', 'location', 'scheduled_pass', 'activity', 'activity_flag', 'published_arrival_time',
+              'published_departure_time', 'public_arrival_time', 'public_departure_time']
+
+# Maximum number of stop pairs held in memory at once.
+BATCH_PAIRS = 2000000
+
+
+def get_calls(df, first_journey=0):
+    """
+    Calls of a timetable, in journey order.
+    :param df: timetable dataframe, stops of each journey in order - see load_timetable
+    :param first_journey: id of the first journey, so journeys of several timetables can be told apart
+    :return: dataframe of journey, location, departure (minutes past midnight, NaN without departure), pick_up and
+    set_down
+    """
+    df = df.reset_index(drop=True)
+    journey = df['record_identity'].isin(ORIGIN_RECORDS).cumsum().to_numpy() - 1 + first_journey
+    if 'public_arrival_time' in df.columns:
+        # Passing points and calls without public times are no use to passengers.
+        arrival, departure = get_public_minutes(df)
+        set_down, pick_up = ~np.isnan(arrival), ~np.isnan(departure)
+    else:
+        arrival, departure = get_minutes(df['published_arrival_time']), get_minutes(df['published_departure_time'])
+        flag = df['activity_flag'].fillna('B').astype(str).str.strip().replace('', 'B') \
+            if 'activity_flag' in df.columns else pd.Series('B', index=df.index)
+        set_down = flag.isin(SET_DOWN).to_numpy() & ~np.isnan(arrival)
+        pick_up = flag.isin(PICK_UP).to_numpy() & ~np.isnan(departure)
+    return pd.DataFrame({
+        'journey': journey,
+        'location': df['location'].astype(str).str.strip().to_numpy(),
+        'departure': departure,
+        'pick_up': pick_up,
+        'set_down': set_down,
+    })
+
+
+def load_calls(paths, day):
+    """
+    Load the calls of all timetables on a day of operation.
+    :param paths: list of paths to flat timetable .csv, stop_times tables of normalized timetables or timetable stores
+    :param day: day of week
+    :return: calls dataframe - see get_calls
+    """
+    frames = []
+    first_journey = 0
+    for path in paths:
+        calls = get_calls(load_timetable(path, day=day, columns=OD_COLUMNS), first_journey=first_journey)
+        if len(calls):
+            first_journey = int(calls['journey'].max()) + 1
+        frames.append(calls)
+    if not frames:
+        return get_calls(pd.DataFrame(columns=OD_COLUMNS))
+    return pd.concat(frames, ignore_index=True)
+
+
+class ODMatrix(object):
+    """
+    Direct services between every pair of stops - self.matrix[i, j] is the number of journeys from self.stops[i] to
+    self.stops[j].
+    """
+    __slots__ = ('stops', 'stop_index', 'matrix')
+
+    def __init__(self, stops, matrix):
+        self.stops = np.asarray(stops, dtype=object)
+        self.stop_index = {stop: i for i, stop in enumerate(self.stops)}
+        self.matrix = sparse.csr_matrix(matrix)
+        self.matrix.sum_duplicates()
+
+    def __len__(self):
+        return self.matrix.nnz
+
+    @classmethod
+    def load(cls, path, stops_path):
+        """
+        Load a matrix saved with save.
+        :param path: path to .npz matrix
+        :param stops_path: path to .csv stop index
+        :return: ODMatrix
+        """
+        stops = pd.read_csv(stops_path, dtype={'location': str}).sort_values('stop_id')
+        return cls(stops['location'].to_numpy(), sparse.load_npz(path))
+
+    def save(self, path, stops_path=None):
+        """
+        Save the matrix as a compressed .npz file and the stop index - stop_id, location - as a .csv.
+        :param path: path to .npz matrix
+        :param stops_path: optional path to .csv stop index, not saved when not provided
+        :return: list of saved paths
+        """
+        sparse.save_npz(path, self.matrix, compressed=True)
+        saved = [path]
+        if stops_path:
+            pd.DataFrame({'stop_id': np.arange(len(self.stops)), 'location': self.stops}).to_csv(stops_path,
+                                                                                                 index=False)
+            saved.append(stops_path)
+        return saved
+
+    def count(self, origin, destination):
+        """
+        Number of direct services from one stop to another - a dictionary lookup of both stops and a binary search
+        within the row of the origin.
+        :param origin: origin stop code
+        :param destination: destination stop code
+        :return: number of journeys, 0 for stops not in the matrix
+        """
+        i, j = self.stop_index.get(str(origin).strip()), self.stop_index.get(str(destination).strip())
+        if i is None or j is None:
+            return 0
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+        position = start + np.searchsorted(self.matrix.indices[start:end], j)
+        if position < end and self.matrix.indices[position] == j:
+            return int(self.matrix.data[position])
+        return 0
+
+    def to_frame(self):
+        """
+        :return: dataframe of origin, destination and services of every pair of stops with a direct service - most
+        served first
+        """
+        matrix = self.matrix.tocoo()
+        df = pd.DataFrame({'origin': self.stops[matrix.row], 'destination': self.stops[matrix.col],
+                           'services': matrix.data})
+        return df.sort_values(['services', 'origin', 'destination'], ascending=[False, True, True]) \
+            .reset_index(drop=True)
+
+
+def first_pairs(keys):
+    """
+    Mark the first occurrence of every stop pair of each journey, so a journey calling at a stop twice counts once.
+    :param keys: 2D array of stop pair keys, one journey per row - -1 for pairs left out
+    :return: boolean array, True for pairs counted
+    """
+    first = keys >= 0
+    for row in range(len(keys)):
+        kept = np.flatnonzero(first[row])
+        _, positions = np.unique(keys[row, kept], return_index=True)
+        first[row, kept] = False
+        first[row, kept[positions]] = True
+    return first
+
+
+def build_od_matrices(calls, windows=None):
+    """
+    Count the direct services between every pair of stops, for the whole day or every time band.
+    :param calls: calls dataframe - see get_calls
+    :param windows: optional list of (start, end) minutes past midnight - both included - of departures from the
+    origin
+    :return: list of ODMatrix, one per window (one for the whole day when no windows are given)
+    """
+    windows = windows or [None]
+    stop_codes, stops = pd.factorize(calls['location'])
+    n_stops = len(stops)
+    departure = calls['departure'].to_numpy(dtype=float)
+    pick_up = calls['pick_up'].to_numpy(dtype=bool)
+    set_down = calls['set_down'].to_numpy(dtype=bool)
+    in_window = [np.ones(len(calls), dtype=bool) if window is None else
+                 (departure >= window[0]) & (departure <= window[1]) for window in windows]
+
+    journey = calls['journey'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, journey[1:] != journey[:-1]]) if len(calls) else np.array([], dtype=int)
+    lengths = np.diff(np.r_[starts, len(calls)])
+    matrices = [sparse.csr_matrix((n_stops, n_stops), dtype=np.int32) for _ in windows]
+    for length in np.unique(lengths[lengths > 1]):
+        origin_position, destination_position = np.triu_indices(length, 1)
+        group = starts[lengths == length]
+        batch = max(1, BATCH_PAIRS // len(origin_position))
+        for i in range(0, len(group), batch):
+            positions = group[i:i + batch, None] + np.arange(length)
+            # Journeys calling at a stop more than once need their pairs deduplicated.
+            sorted_stops = np.sort(stop_codes[positions], axis=1)
+            repeated = (sorted_stops[:, 1:] == sorted_stops[:, :-1]).any(axis=1)
+            origins = positions[:, origin_position]
+            destinations = positions[:, destination_position]
+            origin_stops, destination_stops = stop_codes[origins], stop_codes[destinations]
+            served = pick_up[origins] & set_down[destinations] & (origin_stops != destination_stops)
+            for w in range(len(windows)):
+                counted = served & in_window[w][origins]
+                if repeated.any():
+                    keys = np.where(counted[repeated], origin_stops[repeated].astype(np.int64) * n_stops +
+                                    destination_stops[repeated], -1)
+                    counted[repeated] = first_pairs(keys)
+                rows, columns = origin_stops[counted], destination_stops[counted]
+                matrices[w] = matrices[w] + sparse.coo_matrix(
+                    (np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(n_stops, n_stops)).tocsr()
+    return [ODMatrix(stops.to_numpy(dtype=object), matrix) for matrix in matrices]
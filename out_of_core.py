@@ -0,0 +1,77 @@
+"""
+out_of_core.py
+
+Helpers for analysing timetable .csv files larger than memory. A timetable is read in chunks of rows, only the
+columns an analysis needs are parsed, each chunk is filtered straight after reading and reduced to a partial
+aggregate, and partial aggregates are merged as they pile up - so memory stays bounded by the chunk size and
+the number of groups, not by the size of the timetable.
+
+"""
+import pandas as pd
+
+# Rough pandas footprint of a single parsed row of the few columns a frequency analysis reads.
+BYTES_PER_ROW = 512
+
+
+def get_chunksize(memory_limit, share=0.25, minimum=10000):
+    """
+    Number of rows to read at once so a chunk takes about `share` of the memory limit.
+    :param memory_limit: memory limit in bytes, None for the default chunk size
+    :param share: share of the memory limit a chunk may take
+    :param minimum: smallest chunk size
+    :return: number of rows
+    """
+    if not memory_limit:
+        return 500000
+    return max(minimum, int(memory_limit * share / BYTES_PER_ROW))
+
+
+def read_filtered_chunks(csv, usecols, dtype, mask, chunksize=500000):
+    """
+    Read a .csv in chunks and yield only the rows matching a filter.
+    :param csv: path to .csv file
+    :param usecols: columns to parse - all other columns are skipped by the parser
+    :param dtype: dictionary of column dtypes
+    :param mask: function returning a boolean series for a chunk
+    :param chunksize: number of rows per chunk
+    :return: generator of filtered dataframes
+    """
+    with pd.read_csv(csv, usecols=usecols, dtype=dtype, chunksize=chunksize) as reader:
+        for chunk in reader:
+            filtered = chunk.loc[mask(chunk)]
+            if not filtered.empty:
+                yield filtered
+
+
+class PartialSums(object):
+    """
+    Running group-by sum built from partial sums of consecutive chunks. Partials are merged every `merge_every`
+    additions, so at most that many partial results are held at once.
+    """
+    __slots__ = ('group_by_cols', 'value_col', 'merge_every', 'partials')
+
+    def __init__(self, group_by_cols, value_col, merge_every=16):
+        self.group_by_cols = group_by_cols
+        self.value_col = value_col
+        self.merge_every = merge_every
+        self.partials = []
+
+    def add(self, df):
+        if df.empty:
+            return
+        self.partials.append(df.groupby(self.group_by_cols)[self.value_col].sum())
+        if len(self.partials) >= self.merge_every:
+            self.partials = [self._merge()]
+
+    def _merge(self):
+        return pd.concat(self.partials).groupby(level=list(range(len(self.group_by_cols)))).sum()
+
+    def result(self):
+        """
+        :return: dataframe of group_by_cols + value_col sorted by the group keys, like groupby().sum().reset_index()
+        """
+        if not self.partials:
+            empty = {col: pd.Series(dtype=str) for col in self.group_by_cols}
+            empty[self.value_col] = pd.Series(dtype='int64')
+            return pd.DataFrame(empty)
+        return self._merge().reset_index()
@@ -0,0 +1,137 @@
+"""
+partitioned_writer.py
+
+Split a timetable into one output file per vehicle type, operator or route in a single grouped pass, instead of
+masking and copying the whole timetable once per value. Partitions are written by background threads, so the caller
+can carry on - e.g. with normalized or database output - while the files are being written to disk.
+
+"""
+import concurrent.futures
+import os
+import re
+
+# Columns a timetable can be partitioned by, under their short names.
+PARTITION_COLUMNS = {
+    'vehicle_type': 'vehicle_type',
+    'operator': 'operator',
+    'route': 'route_number_(identifier)',
+}
+
+
+def get_partition_name(value):
+    """
+    File name safe version of a partition value, e.g. 'X 5/A' -> 'X_5_A'. Blank values are kept as they are, as
+    the timetables of blank vehicle types always were.
+    """
+    value = str(value)
+    if not value.strip():
+        return value
+    return re.sub(r'[^\w\-]+', '_', value)
+
+
+class PartitionNames(object):
+    """
+    File names of the partitions of one timetable. Values only told apart by characters that are not file name safe
+    - e.g. 'X 5' and 'X/5' - would share a file; every later value clashing with a name already taken is given a
+    numbered suffix instead, in order of first appearance: 'X_5', 'X_5_2'.
+    """
+    __slots__ = ('names', 'taken')
+
+    def __init__(self):
+        self.names = {}
+        self.taken = set()
+
+    def get(self, value):
+        """
+        :param value: partition value
+        :return: file name safe name, unique to the value
+        """
+        key = None if value != value else value
+        name = self.names.get(key)
+        if name is None:
+            name = get_partition_name(value)
+            if name in self.taken:
+                suffix = 2
+                while '{}_{}'.format(name, suffix) in self.taken:
+                    suffix += 1
+                print('Partition {!r} shares the file name {} with another partition, saving it as {}_{}.'.format(
+                    value, name, name, suffix))
+                name = '{}_{}'.format(name, suffix)
+            self.names[key] = name
+            self.taken.add(name)
+        return name
+
+
+class PartitionedWriter(object):
+    """
+    Writes partitions of timetables as <name>_<value>_timetable.csv (and .xlsx) in background threads. Use as a
+    context manager, or call close() to wait for all writes to finish.
+    """
+    __slots__ = ('output_folder', 'name', 'formats', 'partition_names', '_executor', '_futures')
+
+    def __init__(self, output_folder, name, formats=('csv',), workers=2):
+        """
+        :param output_folder: folder to save the partitions in
+        :param name: name of the timetable, used as a prefix of every partition file
+        :param formats: output formats - 'csv' and/or 'xlsx'
+        :param workers: number of partitions written at once
+        """
+        self.output_folder = output_folder
+        self.name = name
+        self.formats = formats
+        self.partition_names = PartitionNames()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True)
+
+    def get_path(self, value):
+        """
+        Path to the .csv of a partition.
+        """
+        return os.path.join(self.output_folder, '{}_{}_timetable.csv'.format(self.name, self.partition_names.get(value)))
+
+    def write_frame(self, df, partition_by='vehicle_type'):
+        """
+        Route the rows of a timetable to one output per value of a column, in order of first appearance. Rows are
+        grouped in a single pass and each partition is queued for writing straight away.
+        :param df: timetable dataframe
+        :param partition_by: column to partition by - see PARTITION_COLUMNS
+        """
+        partition_by = PARTITION_COLUMNS.get(partition_by, partition_by)
+        for value, partition in df.groupby(partition_by, sort=False, dropna=False):
+            path = self.get_path(value)
+            print('Saving {} timetable:\n{}'.format(value, path))
+            self._futures.append(self._executor.submit(self._write, value, partition, path))
+
+    def _write(self, value, partition, path):
+        """
+        Write a single partition.
+        :return: list of saved .csv paths
+        """
+        saved = []
+        if 'csv' in self.formats:
+            partition.to_csv(path, index=False)
+            saved.append(path)
+        if 'xlsx' in self.formats:
+            try:
+                partition.to_excel(path.replace('.csv', '.xlsx'), index=False)
+            except:
+                print("Error writing {} timetable to excel.".format(value))
+        return saved
+
+    def close(self):
+        """
+        Wait for all queued partitions to be written.
+        :return: list of saved .csv paths, in the order the partitions were queued
+        """
+        self._executor.shutdown(wait=True)
+        saved = []
+        for future in self._futures:
+            saved.extend(future.result())
+        self._futures = []
+        return saved
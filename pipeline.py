@@ -0,0 +1,285 @@
+"""
+pipeline.py
+
+Pipelined conversion of many .cif files into .csv timetables. Instead of read -> parse -> write one file after
+another, the three stages run at the same time and are connected by a bounded queue:
+- a reader thread reads the files and splits them into chunks of whole journeys (at QS/BS journey headers),
+- parser workers turn the chunks into timetable frames, several chunks - of one file or of the next ones - at once,
+- a writer thread deduplicates journeys and appends the frames to the timetable .csv files, in file order.
+
+When the queue is full the reader waits, so at most a few chunks are held in memory whatever the size of the files.
+Total wall time approaches that of the slowest stage instead of the sum of all of them; the run report shows time
+spent reading, parsing, writing and waiting for parsed chunks.
+
+Timetables are the same as those of CIF_timetable_converter.py and ScotRail_CIF_timetable_converter.py with
+--format csv.
+To run without editing the source use: python cif_timetable_reader.py convert --pipeline --help
+
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import CIF_timetable_converter as atco_converter
+import ScotRail_CIF_timetable_converter as rail_converter
+from compressed_input import is_rail_cif, open_cif
+from duplicate_journeys import DuplicateJourneys
+from instrumentation import RunReport
+from partitioned_writer import PARTITION_COLUMNS, PartitionNames
+from record_validation import Quarantine
+
+# Number of .cif rows parsed at once - chunks are extended to the next journey header.
+CHUNK_ROWS = 200000
+
+# Number of chunks read ahead of the writer.
+QUEUE_SIZE = 8
+
+# Converter and journey header record of each .cif flavour.
+FLAVOURS = {
+    'atco': (atco_converter, 'QS'),
+    'rail': (rail_converter, 'BS'),
+}
+
+
+def iter_chunks(f, boundary, chunk_rows=CHUNK_ROWS):
+    """
+    Split a .cif file into chunks of whole journeys.
+    :param f: .cif file (or any iterable of rows)
+    :param boundary: record identity starting a journey - 'QS' or 'BS'
+    :param chunk_rows: minimum number of rows in a chunk, except the last one
+    :return: generator of lists of rows
+    """
+    rows = []
+    for row in f:
+        if len(rows) >= chunk_rows and row.startswith(boundary):
+            yield rows
+            rows = []
+        rows.append(row)
+    if rows:
+        yield rows
+
+
+def parse_chunk(flavour, rows):
+    """
+    Parse a chunk with the converter of its flavour. Runs in a parser worker.
+    :return: tuple of (timetable dataframe, journey index of every row, list of journey fingerprints, tables
+    dictionary, seconds spent parsing)
+    """
+    start = time.perf_counter()
+    result = FLAVOURS[flavour][0].parse_chunk(rows)
+    return result + (time.perf_counter() - start,)
+
+
+class TimetableSink(object):
+    """
+    Appends parsed chunks of a single .cif file to its timetable .csv files, in file order. ATCO-CIF timetables are
+    split by vehicle type (or operator, route), same as in CIF_timetable_converter.py.
+    """
+    __slots__ = ('name', 'output_folder', 'flavour', 'partition_by', 'partition_names', 'duplicates', 'quarantine',
+                 'tables', 'saved', 'rows', 'decoded', '_files')
+
+    def __init__(self, file, output_folder, flavour, partition_by='vehicle_type'):
+        """
+        :param file: path to .cif file
+        :param output_folder: folder to save the results in
+        :param flavour: 'atco' or 'rail'
+        :param partition_by: split ATCO-CIF timetables by 'vehicle_type', 'operator' or 'route'
+        """
+        self.name = FLAVOURS[flavour][0].get_output_name(file)
+        self.output_folder = output_folder
+        self.flavour = flavour
+        self.partition_by = PARTITION_COLUMNS.get(partition_by, partition_by)
+        self.partition_names = PartitionNames()
+        # Duplicated rows are written in the column order of the converter.
+        self.duplicates = DuplicateJourneys(os.path.join(output_folder, 'duplicates', self.name + '_duplicates.csv'),
+                                            columns=FLAVOURS[flavour][0].DUPLICATE_COLUMNS)
+        self.quarantine = Quarantine(os.path.join(output_folder, 'quarantine', self.name + '_quarantine.csv'))
+        self.tables = {'notes': [], 'exceptions': [], 'locations': []} if flavour == 'atco' else {}
+        self.saved = []
+        self.rows = 0
+        self.decoded = 0
+        self._files = {}
+
+    def write(self, df, journey_ids, fingerprints, tables):
+        """
+        Deduplicate journeys of a parsed chunk against all journeys seen so far and append the chunk to the
+        timetables.
+        """
+        self.decoded += tables.get('decoded', 0)
+        self.quarantine.write(tables.get('quarantine') or [], journeys=tables.get('quarantined', 0))
+        for table, records in self.tables.items():
+            records.extend(tables.get(table) or [])
+        if not len(df):
+            return
+        if journey_ids is not None:
+            duplicated = np.array([self.duplicates.is_duplicate(fingerprint) for fingerprint in fingerprints],
+                                  dtype=bool)
+            if duplicated.any():
+                for journey in np.flatnonzero(duplicated):
+                    rows = df[journey_ids == journey]
+                    self.duplicates.write(rows.astype(object).where(rows.notna(), None).to_dict('records'))
+                df = df[~duplicated[journey_ids]]
+
+        if self.flavour == 'atco':
+            df = atco_converter.prepare_timetable(df)
+            partitions = [(os.path.join(self.output_folder, '{}_{}_timetable.csv'.format(
+                self.name, self.partition_names.get(value))), value, partition)
+                          for value, partition in df.groupby(self.partition_by, sort=False, dropna=False)]
+        else:
+            df = rail_converter.prepare_timetable(df)
+            partitions = [(os.path.join(self.output_folder, '{}_timetable.csv'.format(self.name)), self.name, df)]
+        for path, value, partition in partitions:
+            f = self._files.get(path)
+            if f is None:
+                print('Saving {} timetable:\n{}'.format(value, path))
+                f = self._files[path] = open(path, 'w', newline='')
+                self.saved.append(path)
+            partition.to_csv(f, index=False, header=f.tell() == 0)
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Close the timetables and save journey notes, date running exceptions and stop locations.
+        :return: list of saved timetable paths
+        """
+        self.abort()
+        for table, records in self.tables.items():
+            if records:
+                pd.DataFrame(records).to_csv(os.path.join(self.output_folder, '{}_{}.csv'.format(self.name, table)),
+                                             index=False)
+        return self.saved
+
+    def abort(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self.duplicates.close()
+        self.quarantine.close()
+
+
+def read_files(files, executor, chunks, chunk_rows, report):
+    """
+    Reader thread - split every file into chunks, hand them to the parser workers and queue the pending results in
+    file order. An (file, flavour, None) item marks the end of a file, (file, None, exception) a file that could not
+    be read and a None item the end of the run.
+    """
+    for file in files:
+        try:
+            flavour = 'rail' if is_rail_cif(file) else 'atco'
+            with open_cif(file) as f:
+                file_chunks = iter_chunks(f, FLAVOURS[flavour][1], chunk_rows)
+                while True:
+                    with report.stage('read'):
+                        rows = next(file_chunks, None)
+                    if rows is None:
+                        break
+                    # Blocks while the queue is full.
+                    chunks.put((file, flavour, executor.submit(parse_chunk, flavour, rows)))
+        except Exception as e:
+            chunks.put((file, None, e))
+            continue
+        chunks.put((file, flavour, None))
+    chunks.put(None)
+
+
+def write_chunks(chunks, output_folder, partition_by, report, saved, failed):
+    """
+    Writer thread - wait for parsed chunks in file order and append them to the timetables. A failed file is
+    reported and does not stop the rest of the run.
+    """
+    sinks = {}
+    progress = report.progress("Chunks written")
+    while True:
+        item = chunks.get()
+        if item is None:
+            break
+        file, flavour, result = item
+        if file in failed:
+            continue
+        try:
+            if isinstance(result, Exception):
+                raise result
+            if file not in sinks:
+                print("\nAnalyzing: {}".format(file))
+                sinks[file] = TimetableSink(file, output_folder, flavour, partition_by=partition_by)
+            sink = sinks[file]
+            if result is None:
+                with report.stage('write'):
+                    saved.extend(sink.close())
+                del sinks[file]
+                report.count('records_decoded', sink.decoded)
+                report.count('duplicated_journeys', sink.duplicates.journeys)
+                report.count('duplicated_rows', sink.duplicates.rows)
+                report.count('quarantined_journeys', sink.quarantine.journeys)
+                report.count('quarantined_records', sink.quarantine.records)
+                report.count('rows_emitted', sink.rows)
+                continue
+            with report.stage('wait'):
+                df, journey_ids, fingerprints, tables, seconds = result.result()
+            report.add_time('parse', seconds)
+            with report.stage('write'):
+                sink.write(df, journey_ids, fingerprints, tables)
+            report.count('chunks')
+            progress.update()
+        except Exception as e:
+            print("{} - failed: {!r}".format(file, e), file=sys.stderr)
+            failed.append(file)
+            if file in sinks:
+                sinks.pop(file).abort()
+    progress.close()
+
+
+def get_executor(workers):
+    """
+    Pool of parser workers. Processes are forked where possible, and started before any thread is, as forking a
+    process running threads is not safe. Elsewhere the chunks are parsed in threads.
+    """
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                          mp_context=multiprocessing.get_context('fork'))
+        executor.submit(int).result()
+        return executor
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1))
+
+
+def run_pipeline(files, output_folder, workers=2, queue_size=QUEUE_SIZE, chunk_rows=CHUNK_ROWS,
+                 partition_by='vehicle_type', profile=False, trace_memory=False):
+    """
+    Convert .cif files into .csv timetables with reading, parsing and writing overlapped, and save a .json run
+    report of the whole run in the output folder.
+    :param files: list of ATCO-CIF and/or rail .cif files
+    :param output_folder: folder to save the results in
+    :param workers: number of parser workers
+    :param queue_size: number of chunks read ahead of the writer
+    :param chunk_rows: number of .cif rows parsed at once
+    :param partition_by: split ATCO-CIF timetables by 'vehicle_type', 'operator' or 'route'
+    :param profile: True to save a cProfile of the run with the run report
+    :param trace_memory: True to trace memory allocations with tracemalloc
+    :return: tuple of (list of saved timetable paths, number of failed files)
+    """
+    os.makedirs(os.path.join(output_folder, 'duplicates'), exist_ok=True)
+    chunks = queue.Queue(maxsize=queue_size)
+    saved = []
+    failed = []
+    with RunReport('pipeline', output_folder, profile=profile, trace_memory=trace_memory) as report:
+        executor = get_executor(workers)
+        try:
+            reader = threading.Thread(target=read_files, args=(files, executor, chunks, chunk_rows, report))
+            writer = threading.Thread(target=write_chunks,
+                                      args=(chunks, output_folder, partition_by, report, saved, failed))
+            reader.start()
+            writer.start()
+            reader.join()
+            writer.join()
+        finally:
+            executor.shutdown()
+        report.count('files', len(files))
+        report.count('failed', len(failed))
+    return saved, len(failed)
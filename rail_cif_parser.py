@@ -0,0 +1,229 @@
+"""
+rail_cif_parser.py
+
+Streaming parser for rail (Network Rail/ScotRail) .cif timetable extracts. The file is read once, row by row, and
+schedules are yielded one at a time, so a whole national extract can be processed with bounded memory:
+- HD - file header,
+- BS - basic schedule - starts a new journey,
+- BX - basic schedule extra details,
+- LO/LI/LT - origin, intermediate and terminating locations of a journey,
+- TI - TIPLOC insert - location names and codes,
+- ZZ - end of file.
+
+Records are decoded with the same compiled layouts as atco_cif_parser.py. Times are kept as they appear in the
+file (hhmm, with a trailing 'H' for half a minute in working times); use rail_time_seconds to convert them.
+
+"""
+from atco_cif_parser import compile_specification, decode_record
+
+# This dictionary contains information on how to parse different records - the one rail record layout, shared by
+# ScotRail_CIF_timetable_converter.py, gtfs_writer.py and benchmark.py.
+RAIL_CIF_SPECIFICATION = {
+    'HD': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'file_identity': (20, 3),
+        'date_of_extract': (6, 23),
+        'time_of_extract': (4, 29),
+        'current_file_reference': (7, 33),
+        'last_file_reference': (7, 40),
+        'update_indicator': (1, 47),
+        'version': (1, 48),
+        'extract_start_date': (6, 49),
+        'extract_end_date': (6, 55),
+        'spare': (20, 61)},
+    'TI': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'tiploc_code': (7, 3),
+        'capitals': (2, 10),
+        'nalco': (6, 12),
+        'nlc_check_character': (1, 18),
+        'tps_description': (26, 19),
+        'stanox': (5, 45),
+        'po_mcp_code': (4, 50),
+        'crs_code': (3, 54),
+        'description': (16, 57)},
+    'BS': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'transaction_type': (1, 3),
+        'train_uid': (6, 4),
+        'date_runs_from': (6, 10),
+        'date_runs_to': (6, 16),
+        'days_run': (7, 22),
+        'bank_holiday_running': (1, 29),
+        'train_status': (1, 30),
+        'train_category': (2, 31),
+        'train_identity': (4, 33),
+        'headcode': (4, 37),
+        'course_indicator': (1, 41),
+        'profit_centre_code': (8, 42),
+        'business_sector': (1, 50),
+        'power_type': (3, 51),
+        'timing_load': (4, 54),
+        'speed': (3, 58),
+        'operating_chars': (6, 61),
+        'train_class': (1, 67),
+        'sleepers': (1, 68),
+        'reservations': (1, 69),
+        'connect_indicator': (1, 70),
+        'catering_code': (4, 71),
+        'service_branding': (4, 75),
+        'spare': (1, 79),
+        'stp_indicator': (1, 80)},
+    'BX': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'traction_class': (4, 3),
+        'uic_code': (5, 7),
+        'atoc_code': (2, 12),
+        'applicable_timetable_code': (1, 14),
+        'retail_service_id': (8, 15),
+        'data_source': (1, 23)},
+    'LO': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (8, 3),
+        'scheduled_departure_time': (5, 11),
+        'public_departure_time': (4, 16),
+        'platform': (3, 20),
+        'line': (3, 23),
+        'engineering_allowance': (2, 26),
+        'pathing_allowance': (2, 28),
+        'activity': (12, 30),
+        'performance_allowance': (2, 42),
+        'spare': (37, 44)},
+    'LI': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (8, 3),
+        'scheduled_arrival_time': (5, 11),
+        'scheduled_departure_time': (5, 16),
+        'scheduled_pass': (5, 21),
+        'public_arrival_time': (4, 26),
+        'public_departure_time': (4, 30),
+        'platform': (3, 34),
+        'line': (3, 37),
+        'path': (3, 40),
+        'activity': (12, 43),
+        'engineering_allowance': (2, 55),
+        'pathing_allowance': (2, 57),
+        'performance_allowance': (2, 59),
+        'spare': (20, 61)},
+    'LT': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1),
+        'location': (8, 3),
+        'scheduled_arrival_time': (5, 11),
+        'public_arrival_time': (4, 16),
+        'platform': (3, 20),
+        'path': (3, 23),
+        'activity': (12, 26),
+        'spare': (43, 38)},
+    'ZZ': {
+        #   'data_type': (chunk size, starting point [1-indexed])
+        'record_identity': (2, 1)},
+}
+
+# Records making up a single journey and the key under which they are collected in a journey dictionary.
+JOURNEY_RECORDS = {
+    'BX': 'extra',
+    'LO': 'stops',
+    'LI': 'stops',
+    'LT': 'stops',
+}
+
+
+def get_unique_identifier(header):
+    """
+    Identifier of a schedule, same as in ScotRail_CIF_timetable_converter.py.
+    :param header: decoded BS record
+    :return: train uid, status, category, identity and class joined with underscores
+    """
+    return '_'.join(str(header.get(key, '')) for key in
+                    ['train_uid', 'train_status', 'train_category', 'train_identity', 'train_class'])
+
+
+def rail_time_seconds(value):
+    """
+    Convert a rail .cif time into seconds past midnight.
+    :param value: hhmm string, with an optional trailing 'H' for half a minute
+    :return: seconds past midnight, None for a blank value
+    """
+    if not value or not value[:4].isdigit():
+        return None
+    seconds = int(value[0:2]) * 3600 + int(value[2:4]) * 60
+    if value[4:5] == 'H':
+        seconds += 30
+    return seconds
+
+
+def iter_rail_cif(f, records=None, tables=None):
+    """
+    Read a rail .cif file once and yield its schedules one at a time. TIPLOC inserts and the file header are
+    collected in the tables dictionary, if one is provided.
+
+    Each journey is a dictionary holding:
+    * header - decoded BS record with an additional 'unique_identifier'
+    * extra - decoded BX record, None if there is none
+    * stops - list of decoded LO/LI/LT records
+
+    :param f: .cif file (or any iterable of rows) to be processed
+    :param records: iterable of record identities to decode, all records in the specification when not provided -
+    everything else is skipped without being decoded
+    :param tables: optional dictionary to be filled with 'header' (decoded HD record), 'tiplocs' (decoded TI records),
+    'decoded' - a count of decoded rows and 'skipped' - a count of rows skipped per record identity
+    :return: generator of journey dictionaries
+    """
+    records = set(records) if records is not None else set(RAIL_CIF_SPECIFICATION.keys())
+    unknown = records - set(RAIL_CIF_SPECIFICATION.keys())
+    if unknown:
+        raise ValueError("{} - record types not found in rail CIF specification.".format(sorted(unknown)))
+    if records & set(JOURNEY_RECORDS.keys()):
+        records.add('BS')
+    layouts = {record_identity: compile_specification(record_identity, specification=RAIL_CIF_SPECIFICATION)
+               for record_identity in records}
+    if tables is None:
+        tables = {}
+    tables.setdefault('skipped', {})
+    tables.setdefault('decoded', 0)
+    tables.setdefault('tiplocs', [])
+    skipped = tables['skipped']
+
+    journey = None
+    decoded = 0
+    try:
+        for row in f:
+            record_identity = row[0:2]
+            layout = layouts.get(record_identity)
+            if layout is None:
+                skipped[record_identity] = skipped.get(record_identity, 0) + 1
+                continue
+            d = decode_record(row, layout)
+            decoded += 1
+
+            if record_identity in JOURNEY_RECORDS:
+                if journey is None:
+                    skipped[record_identity] = skipped.get(record_identity, 0) + 1
+                elif record_identity == 'BX':
+                    journey['extra'] = d
+                else:
+                    journey['stops'].append(d)
+                continue
+            # Any other record closes the current journey.
+            if journey is not None:
+                yield journey
+                journey = None
+            if record_identity == 'BS':
+                d['unique_identifier'] = get_unique_identifier(d)
+                journey = {'header': d, 'extra': None, 'stops': []}
+            elif record_identity == 'TI':
+                tables['tiplocs'].append(d)
+            elif record_identity == 'HD':
+                tables['header'] = d
+
+        if journey is not None:
+            yield journey
+    finally:
+        tables['decoded'] = decoded
@@ -0,0 +1,143 @@
+"""
+record_validation.py
+
+Validation of decoded .cif records. Problems found in a record are kept as bit flags - one bit per kind of problem -
+together with the names of the fields at fault. Clean records carry no flags and cost nothing extra; a journey with
+a bad record is left out of the timetable and its bad records are written to a quarantine .csv next to the
+duplicates, so one corrupt line neither aborts a conversion nor leaves raw strings in typed columns:
+
+    quarantine/<name>_quarantine.csv
+
+Each quarantined record holds the journey it belongs to, its record identity, flags, the names of its problems and
+bad fields and the raw record itself.
+
+"""
+import csv
+import datetime
+import functools
+import os
+
+# Bit flags of problems found in a record.
+UNKNOWN_RECORD = 1
+BAD_TIME = 2
+BAD_DATE = 4
+BAD_DAYS = 8
+NO_STOPS = 16
+
+# Names of the problems, in bit order.
+PROBLEMS = [
+    (UNKNOWN_RECORD, 'unknown_record'),
+    (BAD_TIME, 'bad_time'),
+    (BAD_DATE, 'bad_date'),
+    (BAD_DAYS, 'bad_days'),
+    (NO_STOPS, 'no_stops'),
+]
+
+# Columns of the quarantine .csv.
+QUARANTINE_COLUMNS = ['unique_identifier', 'record_identity', 'flags', 'problems', 'fields', 'record']
+
+
+def describe_flags(flags):
+    """
+    :param flags: bit flags of problems
+    :return: names of the problems joined with '|', e.g. 'bad_time|bad_date'
+    """
+    return '|'.join(name for flag, name in PROBLEMS if flags & flag)
+
+
+@functools.lru_cache(maxsize=4096)
+def is_date(value, date_format='%Y%m%d'):
+    """
+    Check whether a string is a valid date - there are only a few distinct dates in a .cif file, so each is only
+    parsed once.
+    :param value: date string
+    :param date_format: strptime format, yyyymmdd for ATCO-CIF and yymmdd for rail .cif files
+    :return: True for valid dates
+    """
+    try:
+        return datetime.datetime.strptime(value, date_format).strftime(date_format) == value
+    except ValueError:
+        return False
+
+
+def is_day_flags(value):
+    """
+    :param value: string of day of week flags, e.g. '1111100'
+    :return: True if every flag is 0 or 1
+    """
+    return value.strip('01') == ''
+
+
+def get_quarantine_record(signature, flags, fields=(), unique_identifier=None):
+    """
+    Describe a bad record for the quarantine .csv.
+    :param signature: raw record from .cif file
+    :param flags: bit flags of problems found
+    :param fields: names of the bad fields
+    :param unique_identifier: unique identifier of the journey the record belongs to
+    :return: dictionary of QUARANTINE_COLUMNS
+    """
+    return {
+        'unique_identifier': unique_identifier,
+        'record_identity': signature[0:2],
+        'flags': flags,
+        'problems': describe_flags(flags),
+        'fields': '|'.join(fields),
+        'record': signature.rstrip('\r\n'),
+    }
+
+
+class Quarantine(object):
+    """
+    Side stream of bad records. The .csv is only created once the first bad record is found; without a path the
+    records are kept in memory instead, e.g. when a chunk of a file is parsed in a worker.
+    """
+    __slots__ = ('path', 'journeys', 'records', 'problems', 'rows', '_file', '_writer')
+
+    def __init__(self, path=None):
+        """
+        :param path: path to quarantine .csv, None to keep the records in self.rows
+        """
+        self.path = path
+        self.journeys = 0
+        self.records = 0
+        # Count of records per problem.
+        self.problems = {}
+        self.rows = []
+        self._file = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, records, journeys=1):
+        """
+        Quarantine the bad records of a journey.
+        :param records: list of dictionaries returned by get_quarantine_record
+        :param journeys: number of journeys left out of the timetable because of the records
+        """
+        if not records:
+            return
+        for record in records:
+            for flag, name in PROBLEMS:
+                if record['flags'] & flag:
+                    self.problems[name] = self.problems.get(name, 0) + 1
+        self.journeys += journeys
+        self.records += len(records)
+        if self.path is None:
+            self.rows.extend(records)
+            return
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'w', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=QUARANTINE_COLUMNS, extrasaction='ignore')
+            self._writer.writeheader()
+        self._writer.writerows(records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,257 @@
+"""
+route_patterns.py
+
+Route pattern export. Most journeys of a route call at the same stops in the same order and only start at different
+times, yet a flat timetable repeats every stop of every journey. Here journeys are grouped by their stop sequence:
+- patterns - one row per stop of each distinct stop sequence (stops, bays, activities...),
+- pattern_timings - one row per stop of each distinct set of running times of a pattern, as minutes after the
+  start of the journey,
+- pattern_departures - one row per journey: its pattern, timing, start time and all journey and calendar fields.
+
+Timetables are saved with --format patterns, e.g.:
+
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --format patterns
+
+No information is lost - expand_patterns rebuilds the flat timetable. Per pattern analytics work on a small matrix
+of start times and offsets per timing instead of the whole timetable:
+
+    tables = load_patterns('timetables/Coach_1')
+    frequency = get_stop_frequency(tables, 'tuesday', 8, 9)
+    run_times = get_run_times(tables)
+
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from connection_scan import get_minutes, get_time_strings
+from normalized_timetable import DAY_COLUMNS, normalize_timetable
+
+PATTERN_TABLES = ['patterns', 'pattern_timings', 'pattern_departures']
+
+# Stop time columns saved as offsets from the start of the journey.
+TIME_COLUMNS = [
+    'published_arrival_time',
+    'published_departure_time',
+    'scheduled_arrival_time',
+    'scheduled_departure_time',
+    'public_arrival_time',
+    'public_departure_time',
+    'scheduled_pass',
+]
+
+# Stop time columns which follow from the next stop of the journey and are not saved.
+NEXT_STOP_COLUMNS = ['next_stop_id', 'next_stop_arrival_time']
+
+# Arrival time columns the next stop arrival times are taken from, ATCO-CIF first.
+ARRIVAL_COLUMNS = ['published_arrival_time', 'scheduled_arrival_time']
+
+
+def get_offset_column(column):
+    return column + '_offset'
+
+
+def get_journey_keys(keys, journey_id):
+    """
+    Number the distinct sequences of row keys of every journey.
+    :param keys: integer key of every row
+    :param journey_id: journey of every row, journeys in order
+    :return: integer key of every journey
+    """
+    sequences = pd.Series(keys).groupby(journey_id, sort=False).agg(tuple)
+    return pd.factorize(sequences)[0]
+
+
+def extract_patterns(df, stop_time_columns, calendar_columns):
+    """
+    Group the journeys of a flat timetable by their stop sequence and running times.
+    :param df: flat timetable dataframe, stops of each journey in order
+    :param stop_time_columns: columns describing a single stop - see normalized_timetable
+    :param calendar_columns: columns describing days and dates of operation
+    :return: dictionary of table name: dataframe
+    """
+    tables = normalize_timetable(df, stop_time_columns, calendar_columns)
+    stop_times = tables['stop_times']
+    time_columns = [column for column in TIME_COLUMNS if column in stop_times.columns]
+    key_columns = [column for column in stop_time_columns
+                   if column not in time_columns and column not in NEXT_STOP_COLUMNS]
+    journey_id = stop_times['journey_id'].to_numpy()
+
+    # Journeys start at the first time of their first stop; times past midnight wrap around.
+    minutes = np.column_stack([get_minutes(stop_times[column]) for column in time_columns])
+    flat = minutes.ravel()
+    known = ~np.isnan(flat)
+    start = pd.Series(flat[known]).groupby(np.repeat(journey_id, len(time_columns))[known]).first() \
+        .reindex(tables['journeys']['journey_id']).to_numpy()
+    offsets = (minutes - start[journey_id][:, None]) % 1440
+
+    # Journeys calling at the same stops share a pattern, journeys with the same offsets also share a timing.
+    stop_keys = stop_times.groupby(key_columns, sort=False, dropna=False).ngroup().to_numpy()
+    offset_keys = pd.DataFrame(np.nan_to_num(offsets, nan=-1)).groupby(list(range(len(time_columns))), sort=False) \
+        .ngroup().to_numpy()
+    pattern_id = get_journey_keys(stop_keys, journey_id)
+    timing_id = pd.factorize(pd.Series(list(zip(pattern_id, get_journey_keys(offset_keys, journey_id)))))[0]
+
+    first_journeys = np.unique(pattern_id, return_index=True)[1]
+    rows = np.isin(journey_id, first_journeys)
+    patterns = stop_times.loc[rows, ['stop_sequence'] + key_columns]
+    patterns.insert(0, 'pattern_id', pattern_id[journey_id[rows]])
+
+    first_journeys = np.unique(timing_id, return_index=True)[1]
+    rows = np.isin(journey_id, first_journeys)
+    timings = pd.DataFrame({'timing_id': timing_id[journey_id[rows]], 'pattern_id': pattern_id[journey_id[rows]],
+                            'stop_sequence': stop_times.loc[rows, 'stop_sequence'].to_numpy()})
+    for i, column in enumerate(time_columns):
+        timings[get_offset_column(column)] = pd.array(offsets[rows, i], dtype='Int64')
+
+    departures = tables['journeys'].merge(tables['calendar'], on='journey_id')
+    departures.insert(1, 'pattern_id', pattern_id)
+    departures.insert(2, 'timing_id', timing_id)
+    departures.insert(3, 'start_time', get_time_strings(start).to_numpy())
+    return {'patterns': patterns.reset_index(drop=True), 'pattern_timings': timings,
+            'pattern_departures': departures.reset_index(drop=True)}
+
+
+def write_patterns(tables, output_folder, name):
+    """
+    Save the tables of a pattern timetable as <name>_<table>.csv.
+    :param tables: dictionary of table name: dataframe
+    :param output_folder: folder to save the tables in
+    :param name: name of the timetable
+    :return: list of saved paths
+    """
+    saved = []
+    for table in PATTERN_TABLES:
+        path = os.path.join(output_folder, '{}_{}.csv'.format(name, table))
+        tables[table].to_csv(path, index=False)
+        saved.append(path)
+    return saved
+
+
+def load_patterns(prefix):
+    """
+    Load the tables of a pattern timetable.
+    :param prefix: path prefix of the tables, e.g. timetables/Coach_1
+    :return: dictionary of table name: dataframe
+    """
+    return {table: pd.read_csv('{}_{}.csv'.format(prefix, table), dtype=str if table == 'patterns' else None,
+                               keep_default_na=table != 'patterns')
+            for table in PATTERN_TABLES}
+
+
+def get_timing_matrix(tables, day=None):
+    """
+    Start times and offsets of every timing.
+    :param tables: dictionary of table name: dataframe
+    :param day: day of week to keep journeys of, all journeys when not provided
+    :return: generator of (timing_id, start minutes array, offsets dataframe) tuples - offsets of one stop per row
+    """
+    departures = tables['pattern_departures']
+    if day:
+        departures = departures[departures['operates_on_' + day.lower() + 's'] == 1]
+    starts = pd.Series(get_minutes(departures['start_time'])).groupby(departures['timing_id'].to_numpy())
+    starts = {timing_id: values.to_numpy() for timing_id, values in starts}
+    for timing_id, offsets in tables['pattern_timings'].groupby('timing_id', sort=False):
+        if timing_id in starts:
+            yield timing_id, starts[timing_id], offsets
+
+
+def get_pattern_frequency(tables, day, start_hour, end_hour, group_by_departure=True, start_minute=0, end_minute=0):
+    """
+    Number of journeys calling at every stop of every pattern in a given time period - one matrix of start times
+    by offsets per timing.
+    :param tables: dictionary of table name: dataframe
+    :param day: day of week
+    :param start_hour: starting hour
+    :param end_hour: ending hour
+    :param group_by_departure: True if you want to analyze frequency by departure, not arrival time
+    :param start_minute: starting minute
+    :param end_minute: ending minute
+    :return: dataframe of pattern_id, stop_sequence, location and frequency
+    """
+    timings = tables['pattern_timings']
+    kind = 'departure' if group_by_departure else 'arrival'
+    column = next(get_offset_column(column) for column in TIME_COLUMNS
+                  if kind in column and get_offset_column(column) in timings.columns)
+    start = start_hour * 60 + start_minute
+    end = end_hour * 60 + end_minute
+    counts = []
+    for timing_id, starts, offsets in get_timing_matrix(tables, day):
+        times = (starts[:, None] + offsets[column].to_numpy(dtype=float)[None, :]) % 1440
+        counts.append(pd.DataFrame({
+            'pattern_id': offsets['pattern_id'].to_numpy(),
+            'stop_sequence': offsets['stop_sequence'].to_numpy(),
+            'frequency': ((times >= start) & (times <= end)).sum(axis=0),
+        }))
+    if not counts:
+        return pd.DataFrame(columns=['pattern_id', 'stop_sequence', 'location', 'frequency'])
+    frequency = pd.concat(counts).groupby(['pattern_id', 'stop_sequence'], as_index=False)['frequency'].sum()
+    patterns = tables['patterns'][['pattern_id', 'stop_sequence', 'location']] \
+        .astype({'pattern_id': int, 'stop_sequence': int})
+    return patterns.merge(frequency, on=['pattern_id', 'stop_sequence'])
+
+
+def get_stop_frequency(tables, day, start_hour, end_hour, group_by_departure=True, start_minute=0, end_minute=0):
+    """
+    Number of journeys calling at every stop in a given time period, summed over patterns.
+    :return: dataframe of location and frequency
+    """
+    frequency = get_pattern_frequency(tables, day, start_hour, end_hour, group_by_departure=group_by_departure,
+                                      start_minute=start_minute, end_minute=end_minute)
+    frequency = frequency[frequency['frequency'] > 0].groupby('location', as_index=False)['frequency'].sum()
+    return frequency.sort_values(by='frequency', ascending=False).reset_index(drop=True)
+
+
+def get_run_times(tables, day=None):
+    """
+    Running time of every timing of every pattern, from the first to the last time of the journey.
+    :param tables: dictionary of table name: dataframe
+    :param day: day of week to count journeys of, all journeys when not provided
+    :return: dataframe of pattern_id, timing_id, origin, destination, stops, run_time (minutes), journeys, first and
+    last start times
+    """
+    patterns = tables['patterns'].astype({'pattern_id': int})
+    ends = patterns.groupby('pattern_id')['location'].agg(['first', 'last', 'size']) \
+        .rename(columns={'first': 'origin', 'last': 'destination', 'size': 'stops'})
+    rows = []
+    for timing_id, starts, offsets in get_timing_matrix(tables, day):
+        offsets = offsets[[column for column in offsets.columns if column.endswith('_offset')]].to_numpy(dtype=float)
+        rows.append({'timing_id': timing_id, 'run_time': np.nanmax(offsets),
+                     'journeys': len(starts), 'first_start': starts.min(), 'last_start': starts.max()})
+    run_times = pd.DataFrame(rows, columns=['timing_id', 'run_time', 'journeys', 'first_start', 'last_start'])
+    run_times = tables['pattern_timings'][['timing_id', 'pattern_id']].drop_duplicates().merge(run_times, on='timing_id')
+    run_times = run_times.merge(ends, left_on='pattern_id', right_index=True)
+    for column in ['first_start', 'last_start']:
+        run_times[column] = get_time_strings(run_times[column].to_numpy()).to_numpy()
+    return run_times[['pattern_id', 'timing_id', 'origin', 'destination', 'stops', 'run_time', 'journeys',
+                      'first_start', 'last_start']].sort_values(['pattern_id', 'timing_id']).reset_index(drop=True)
+
+
+def expand_patterns(tables):
+    """
+    Rebuild the flat timetable of a pattern timetable, one row per stop of every journey.
+    :param tables: dictionary of table name: dataframe
+    :return: timetable dataframe
+    """
+    departures = tables['pattern_departures']
+    timings = tables['pattern_timings']
+    df = departures[['journey_id', 'timing_id', 'start_time']] \
+        .merge(timings, on='timing_id') \
+        .merge(tables['patterns'].astype({'pattern_id': int, 'stop_sequence': int}), on=['pattern_id', 'stop_sequence'])
+    df = df.sort_values(['journey_id', 'stop_sequence'], kind='stable').reset_index(drop=True)
+
+    start = get_minutes(df['start_time'])
+    for column in TIME_COLUMNS:
+        if get_offset_column(column) in df.columns:
+            minutes = (start + df.pop(get_offset_column(column)).to_numpy(dtype=float)) % 1440
+            df[column] = get_time_strings(minutes)
+    arrival = next(column for column in ARRIVAL_COLUMNS if column in df.columns)
+    last = df['journey_id'].ne(df['journey_id'].shift(-1))
+    df['next_stop_id'] = df['location'].shift(-1).mask(last)
+    df['next_stop_arrival_time'] = df[arrival].shift(-1).mask(last)
+
+    journey_columns = [column for column in departures.columns
+                       if column not in ['pattern_id', 'timing_id', 'start_time'] + DAY_COLUMNS]
+    df = df.drop(columns=['timing_id', 'start_time', 'pattern_id'])
+    return df.merge(departures[journey_columns + DAY_COLUMNS], on='journey_id')
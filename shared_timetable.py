@@ -0,0 +1,129 @@
+"""
+shared_timetable.py
+
+Timetables held in shared memory. A loaded timetable is copied once into shared memory as typed column buffers -
+numbers as they are, text and time columns as integer category codes - and worker processes attach to it by name
+and get dataframes of zero-copy views. Frequency jobs over the same timetable can then fan out across cores with a
+single copy of the data, whichever way the workers are started:
+
+    python cif_timetable_reader.py frequency "timetables/*_timetable.csv" -o stop_frequency --day tuesday friday
+        --window 07:00-10:00 16:00-19:00 --workers 4 --shared-memory
+
+Object columns of forked workers are not shared for long - Python touches every object it reads, and the pages
+holding them are copied into each worker. Category codes are plain integers and stay shared.
+
+Time columns (datetime.time objects, see load_timetable of the frequency counters) become ordered categories of
+every minute of the day plus any other time found, so comparing them with datetime.time objects works as before.
+
+"""
+import datetime
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Every minute of the day - time windows are compared against these.
+MINUTES = [datetime.time(hour=minute // 60, minute=minute % 60) for minute in range(1440)]
+
+
+def is_time_column(values):
+    """
+    :param values: object series
+    :return: True if all values are datetime.time objects or missing
+    """
+    known = values.dropna()
+    return len(known) > 0 and all(isinstance(value, datetime.time) for value in known)
+
+
+def encode_column(values):
+    """
+    Turn a column into a typed array.
+    :param values: series
+    :return: tuple of (numpy array, categories or None, True if the categories are ordered)
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), list(values.cat.categories), values.cat.ordered
+    if values.dtype != object and not pd.api.types.is_string_dtype(values.dtype):
+        return values.to_numpy(), None, False
+    if values.dtype == object and is_time_column(values):
+        categories = sorted(set(MINUTES).union(values.dropna().unique()))
+        codes = pd.Categorical(values, categories=categories, ordered=True).codes
+        return codes, categories, True
+    categorical = pd.Categorical(values)
+    return categorical.codes, list(categorical.categories), False
+
+
+class SharedTimetable(object):
+    """
+    Columns of a timetable in shared memory. The spec - names of the shared memory blocks, dtypes, shapes and
+    categories - is small and picklable, and is all a worker needs to attach.
+    """
+    __slots__ = ('spec', 'blocks')
+
+    def __init__(self, spec, blocks):
+        self.spec = spec
+        self.blocks = blocks
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Copy a dataframe into shared memory.
+        :param df: timetable dataframe
+        :return: SharedTimetable owning the shared memory - unlink it once workers are done
+        """
+        spec, blocks = [], []
+        try:
+            for column in df.columns:
+                array, categories, ordered = encode_column(df[column])
+                array = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+                spec.append((column, block.name, array.dtype.str, array.shape, categories, ordered))
+        except Exception:
+            for block in blocks:
+                block.close()
+                block.unlink()
+            raise
+        return cls(spec, blocks)
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Attach to a timetable copied into shared memory by another process.
+        :param spec: spec of the SharedTimetable
+        :return: SharedTimetable
+        """
+        return cls(spec, [shared_memory.SharedMemory(name=name) for _, name, _, _, _, _ in spec])
+
+    @property
+    def nbytes(self):
+        return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, _, dtype, shape, _, _ in self.spec)
+
+    def to_frame(self):
+        """
+        Dataframe of read-only views of the shared columns - nothing is copied but the categories.
+        :return: timetable dataframe
+        """
+        columns = {}
+        for (column, _, dtype, shape, categories, ordered), block in zip(self.spec, self.blocks):
+            array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            array.flags.writeable = False
+            if categories is not None:
+                array = pd.Categorical.from_codes(array, categories=categories, ordered=ordered, validate=False)
+            columns[column] = array
+        return pd.DataFrame(columns, copy=False)
+
+    def close(self):
+        """
+        Detach from the shared memory. Dataframes returned by to_frame must not be used afterwards.
+        """
+        for block in self.blocks:
+            block.close()
+
+    def unlink(self):
+        """
+        Free the shared memory - once, by the process which created it.
+        """
+        for block in self.blocks:
+            block.unlink()
@@ -1,12 +1,14 @@
 """
-CIF_timetable_converter.py
+stop_frequency_counter.py
+
+Analyze stop frequencies of timetables created with CIF_timetable_converter.py. To run without editing
+the source use: python cif_timetable_reader.py frequency --help
 """
 
 # GLOBAL PARAMETERS
 paths = {
     # Path to folder with timetable data.
-    'timetable':
-        '..\\TRACC Data\PT Timetable Data',
+    'timetable': 'timetables',
     # Name of folder in timetable data to store stop frequencies.
     'output': 'stop_frequency'
 }
@@ -29,12 +31,21 @@ MODES = {
     'tram': 'Tram_5_timetable.csv',
 }
 
+# Number of timetable rows read at once. Set to None to load each timetable whole.
+CHUNKSIZE = None
+
 # Do not edit below this point!
 # ===================================================================================================
 import os
 import time
 import pandas as pd
 import datetime
+from out_of_core import PartialSums, read_filtered_chunks
+from normalized_timetable import DAY_COLUMNS, load_normalized_timetable
+
+# Timetable columns used by get_stop_frequency.
+FREQUENCY_COLUMNS = ['location', 'route_number_(identifier)', 'route_direction', 'published_arrival_time',
+                     'published_departure_time'] + DAY_COLUMNS
 
 def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_routes=False, group_by_departure=True,
                        start_minute=0, end_minute=0):
@@ -72,7 +83,7 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_routes=
     total = df_timetable.loc[
         (df_timetable[timestamp_column] >= start)
         & (df_timetable[timestamp_column] <= end)
-        & (df_timetable[day] == 1)] \
+        & (df_timetable[day] == 1), output_columns] \
         .groupby(group_by_cols) \
         .sum() \
         .reset_index() \
@@ -84,7 +95,7 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_routes=
         & (df_timetable[timestamp_column] <= end)
         & (df_timetable[day] == 1)
         #         Add condition for taking only records heading in inbound direction.
-        & (df_timetable['route_direction'] == 'I')] \
+        & (df_timetable['route_direction'] == 'I'), output_columns] \
         .groupby(group_by_cols) \
         .sum() \
         .reset_index() \
@@ -96,7 +107,7 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_routes=
         & (df_timetable[timestamp_column] <= end)
         & (df_timetable[day] == 1)
         #         Add condition for taking only records heading in outbound direction.
-        & (df_timetable['route_direction'] == 'O')] \
+        & (df_timetable['route_direction'] == 'O'), output_columns] \
         .groupby(group_by_cols) \
         .sum() \
         .reset_index() \
@@ -117,6 +128,105 @@ def get_stop_frequency(df_timetable, day, start_hour, end_hour, group_by_routes=
     return frequency
 
 
+def get_stop_frequency_out_of_core(csv, day, start_hour, end_hour, group_by_routes=False, group_by_departure=True,
+                                   start_minute=0, end_minute=0, chunksize=500000):
+    """
+    Same as get_stop_frequency, but reads the timetable .csv in chunks instead of loading it whole. Only the columns
+    needed are parsed, every chunk is filtered to the day and timeframe straight away and reduced to partial sums,
+    which are merged at the end - memory stays bounded by the chunk size whatever the size of the timetable.
+    :param csv: path to timetable .csv created with CIF_timetable_converter.py
+    :param chunksize: number of rows read at once
+    :return: dataframe with stops and frequencies in a given time period, identical to get_stop_frequency.
+    """
+    # Times are saved as zero-padded hh:mm:ss, so comparing strings is the same as comparing datetime.time objects.
+    start = datetime.time(hour=start_hour, minute=start_minute).strftime('%H:%M:%S')
+    end = datetime.time(hour=end_hour, minute=end_minute).strftime('%H:%M:%S')
+    day = 'operates_on_' + day.lower() + 's'
+
+    if group_by_routes:
+        group_by_cols = ['location', 'route_number_(identifier)']
+    else:
+        group_by_cols = ['location']
+
+    if group_by_departure:
+        timestamp_column = 'published_departure_time'
+    else:
+        timestamp_column = 'published_arrival_time'
+
+    def in_timeframe(chunk):
+        return (chunk[timestamp_column] >= start) & (chunk[timestamp_column] <= end) & (chunk[day] == 1)
+
+    total = PartialSums(group_by_cols, day)
+    inbound = PartialSums(group_by_cols, day)
+    outbound = PartialSums(group_by_cols, day)
+    for chunk in read_filtered_chunks(csv, usecols=group_by_cols + [timestamp_column, day, 'route_direction'],
+                                      dtype={'location': str, 'route_number_(identifier)': str,
+                                             timestamp_column: str, 'route_direction': str},
+                                      mask=in_timeframe, chunksize=chunksize):
+        total.add(chunk)
+        inbound.add(chunk[chunk['route_direction'] == 'I'])
+        outbound.add(chunk[chunk['route_direction'] == 'O'])
+
+    # Merge all dataframes.
+    frequency = total.result() \
+        .merge(inbound.result(), how='left', on=group_by_cols) \
+        .merge(outbound.result(), how='left', on=group_by_cols) \
+        .rename(columns={
+        day + '_x': 'frequency',
+        day + '_y': 'inbound_frequency',
+        day: 'outbound_frequency'}) \
+        .sort_values(by='frequency', ascending=False)
+    #   Add prefix for easier joining with shapefiles.
+    frequency['location'] = frequency['location'].apply(lambda x: 'QLN' + str(x).strip())
+
+    return frequency
+
+
+def load_timetable(csv):
+    """
+    Load a timetable created with CIF_timetable_converter.py and cast proper dtypes.
+    :param csv: path to timetable .csv
+    :return: timetable dataframe
+    """
+    # Cast column dtypes.
+    df_timetable = pd.read_csv(csv, dtype={
+        'unique_identifier': str,
+        'route_number_(identifier)': str,
+        'location': str
+    })
+
+    #   Cast time columns to datetime.time objects.
+    time_cols = ['published_arrival_time', 'published_departure_time', 'next_stop_arrival_time']
+    for col in time_cols:
+        df_timetable[col] = pd.to_datetime(df_timetable[col], format='%H:%M:%S').dt.time
+    return df_timetable
+
+
+def load_normalized(prefix):
+    """
+    Load a timetable saved with CIF_timetable_converter.py in normalized format - only the columns get_stop_frequency
+    needs are read and joined.
+    :param prefix: path prefix of the timetable tables, e.g. timetables/Coach_1
+    :return: timetable dataframe
+    """
+    df_timetable = load_normalized_timetable(prefix, columns=FREQUENCY_COLUMNS, dtype={
+        'route_number_(identifier)': str,
+        'location': str
+    })
+
+    #   Cast time columns to datetime.time objects.
+    for col in ['published_arrival_time', 'published_departure_time']:
+        df_timetable[col] = pd.to_datetime(df_timetable[col], format='%H:%M:%S').dt.time
+    return df_timetable
+
+
+def get_output_name(mode, day, start_hour, end_hour):
+    """
+    Name of the frequency .csv saved for a mode, day and timeframe.
+    """
+    return "{}_{}_{}_to_{}.csv".format(mode, day, str(start_hour), str(end_hour))
+
+
 def main():
     """
     Given variables: DAY / START_HOUR / END_HOUR, this function will analyze timetables listed in MODES dictionary, perform
@@ -127,31 +237,27 @@ def main():
     START = time.time()
 
     print("Frequency calculation commencing.")
+    os.makedirs(os.path.join(paths['timetable'], paths['output']), exist_ok=True)
     #     Loop through all MODES of travels and their associated timetables.
     for i, mode in enumerate(MODES.keys()):
         print("{}/{} - Analyzing {} timetable from {}.".format(i + 1, len(MODES.keys()), mode, MODES[mode]))
-        # Cast column dtypes.
-        df_timetable = pd.read_csv(os.path.join(paths['timetable'], MODES[mode]), dtype={
-            'unique_identifier': str,
-            'route_number_(identifier)': str,
-            'location': str
-        })
-
-        #   Cast time columns to datetime.time objects.
-        time_cols = ['published_arrival_time', 'published_departure_time', 'next_stop_arrival_time']
-        for col in time_cols:
-            df_timetable[col] = pd.to_datetime(df_timetable[col]).dt.time
-
         #   Calculate frequency.
         print('\tDay: {}\n\tTimeframe: {}-{}\n\tCalculating frequency...'.format(DAY, START_HOUR, END_HOUR))
-        frequency = get_stop_frequency(df_timetable, DAY, START_HOUR, END_HOUR, group_by_departure=True)
+        if CHUNKSIZE:
+            frequency = get_stop_frequency_out_of_core(os.path.join(paths['timetable'], MODES[mode]), DAY, START_HOUR,
+                                                       END_HOUR, group_by_departure=True, start_minute=START_MINUTES,
+                                                       end_minute=END_MINUTES, chunksize=CHUNKSIZE)
+        else:
+            df_timetable = load_timetable(os.path.join(paths['timetable'], MODES[mode]))
+            frequency = get_stop_frequency(df_timetable, DAY, START_HOUR, END_HOUR, group_by_departure=True,
+                                           start_minute=START_MINUTES, end_minute=END_MINUTES)
 
         #   Save to .csv
         print('\tSaving.')
-        output = "{}_{}_{}_to_{}.csv".format(mode, DAY, str(START_HOUR), str(END_HOUR))
+        output = get_output_name(mode, DAY, START_HOUR, END_HOUR)
         frequency.to_csv(os.path.join(paths['timetable'], paths['output'], output), index=False)
 
     print("\nFinished.\nTotal runtime: {0:.7}".format(str(time.time() - START)))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
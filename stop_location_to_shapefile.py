@@ -1,12 +1,15 @@
 """
 stop_location_to_shapefile.py
 
+Create shapefiles with stop locations listed inside .cif files. To run without editing
+the source use: python cif_timetable_reader.py stops --help
 """
 import os
 import pandas as pd
 import geopandas
 import sys
 import time
+from compressed_input import get_member_name, list_cif_files, open_cif
 
 # GLOBALS
 paths = {
@@ -109,23 +112,32 @@ def make_gdf_with_locations(raw_stop_locations):
     return gdf
 
 
+def convert_file(file, output_folder):
+    """
+    Create a shapefile with all stop locations listed inside a .cif file.
+    :param file: path to .cif file
+    :param output_folder: folder to save the shapefile in
+    :return: path to saved shapefile
+    """
+    print("\nAnalyzing: {}".format(file))
+    with open_cif(file) as f:
+        raw_stop_locations = extract_raw_stop_location(f)
+    gdf = make_gdf_with_locations(raw_stop_locations)
+
+    output_filename = os.path.splitext(get_member_name(file))[0] + '.shp'
+    print('Saving: {}'.format(output_filename))
+    os.makedirs(output_folder, exist_ok=True)
+    gdf.to_file(os.path.join(output_folder, output_filename))
+    return os.path.join(output_folder, output_filename)
+
+
 def main():
     START = time.time()
     print("CIF stop location extraction commencing.\nAnalyzing files in: {}".format(paths['source']))
-    filepaths = [os.path.join(paths['source'], file) for file in os.listdir(paths['source']) if file.endswith('.cif')]
+    filepaths = list_cif_files(paths['source'])
     print(".cif file list:\n", *filepaths, sep="\n")
-    #   Check directory tree.
-    if not os.path.exists(paths['output']):
-        os.mkdir(paths['output'])
     for file in filepaths:
-        print("\nAnalyzing: {}".format(file))
-        f = open(file, "r")
-        output_filename = file.split('\\')[-1].replace('.cif', '.shp')
-        raw_stop_locations = extract_raw_stop_location(f)
-        gdf = make_gdf_with_locations(raw_stop_locations)
-
-        print('Saving: {}'.format(output_filename))
-        gdf.to_file(os.path.join(paths['output'], output_filename))
+        convert_file(file, paths['output'])
 
     print("\nFinished.\nTotal runtime: {0:.7}".format(str(time.time() - START)))
 
@@ -0,0 +1,253 @@
+"""
+timetable_diff.py
+
+Differences between two .cif extracts - e.g. last week's and this week's drop - without converting and comparing
+whole timetables. Every journey is fingerprinted while it is parsed (a digest of its header fields and its stop and
+time sequence, see duplicate_journeys.py), and the extracts are compared as sets of fingerprints:
+- journeys with a fingerprint found in both extracts are unchanged,
+- the remaining journeys are paired by unique identifier - pairs are changed journeys, the rest added or removed.
+
+Only changed journeys are parsed again, to list their field level changes - header fields, and stop fields of
+journeys calling at the same stops or the stop sequence of rerouted ones. Time taken grows with the size of the
+extracts, not with the square of the number of journeys.
+
+    python cif_timetable_reader.py diff "old/*.cif" "new/*.cif" -o timetable_diff
+
+Saved tables: added_journeys.csv, removed_journeys.csv, changed_journeys.csv and journey_changes.csv.
+
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from compressed_input import is_rail_cif, open_cif
+from duplicate_journeys import get_digest
+from instrumentation import RunReport
+from normalized_timetable import ATCO_STOP_TIME_COLUMNS, ORIGIN_RECORDS, RAIL_STOP_TIME_COLUMNS
+from pipeline import CHUNK_ROWS, FLAVOURS, iter_chunks, parse_chunk
+
+# Journey fields listed for added, removed and changed journeys, where present.
+SUMMARY_COLUMNS = ['unique_identifier', 'operator', 'train_uid', 'route_number_(identifier)', 'route_direction',
+                   'vehicle_type', 'stp_indicator']
+
+# First departure time column of each flavour.
+DEPARTURE_COLUMNS = {'atco': 'published_departure_time', 'rail': 'scheduled_departure_time'}
+
+# Stop time columns of each flavour - all other columns are journey fields.
+STOP_COLUMNS = {'atco': ATCO_STOP_TIME_COLUMNS, 'rail': RAIL_STOP_TIME_COLUMNS}
+
+# Time columns - journeys with changes to these only are retimed.
+TIME_COLUMNS = ['published_arrival_time', 'published_departure_time', 'scheduled_arrival_time',
+                'scheduled_departure_time', 'public_arrival_time', 'public_departure_time', 'scheduled_pass',
+                'next_stop_arrival_time']
+
+
+def iter_journey_chunks(files, chunk_rows=CHUNK_ROWS, report=None):
+    """
+    Parse .cif files chunk by chunk.
+    :param files: list of paths to .cif files
+    :param chunk_rows: number of .cif rows parsed at once
+    :param report: optional run report to count parsed chunks in
+    :return: generator of (file, flavour, timetable dataframe, journey index of every row, journey fingerprints,
+    index of the first journey of the chunk within the file) tuples
+    """
+    for file in files:
+        flavour = 'rail' if is_rail_cif(file) else 'atco'
+        first_journey = 0
+        with open_cif(file) as f:
+            for rows in iter_chunks(f, FLAVOURS[flavour][1], chunk_rows):
+                df, journey_ids, fingerprints, _, _ = parse_chunk(flavour, rows)
+                if flavour == 'rail' and len(df):
+                    df = FLAVOURS[flavour][0].prepare_timetable(df)
+                df = df.reset_index(drop=True)
+                if journey_ids is None or len(fingerprints) != (journey_ids.max() + 1 if len(journey_ids) else 0):
+                    # Fingerprint the rows of the journeys where parser fingerprints can't be matched to them.
+                    journey_ids = df['record_identity'].isin(ORIGIN_RECORDS).cumsum().to_numpy() - 1
+                    row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+                    fingerprints = [get_digest(np.asarray(hashes, dtype=np.uint64).tobytes()) for hashes in
+                                    pd.Series(row_hashes).groupby(journey_ids).agg(tuple)]
+                if report is not None:
+                    report.count('chunks')
+                yield file, flavour, df, journey_ids, fingerprints, first_journey
+                first_journey += len(fingerprints)
+
+
+def fingerprint_extract(files, chunk_rows=CHUNK_ROWS, report=None):
+    """
+    Fingerprint every journey of an extract.
+    :param files: list of paths to .cif files
+    :param chunk_rows: number of .cif rows parsed at once
+    :param report: optional run report
+    :return: dataframe of one row per journey - flavour, file, journey (index within the file), fingerprint,
+    summary fields, origin, destination and departure time
+    """
+    frames = []
+    for file, flavour, df, journey_ids, fingerprints, first_journey in iter_journey_chunks(files, chunk_rows, report):
+        if not len(fingerprints):
+            continue
+        starts = np.flatnonzero(np.r_[True, journey_ids[1:] != journey_ids[:-1]])
+        ends = np.r_[starts[1:], len(df)] - 1
+        first = df.iloc[starts]
+        journeys = pd.DataFrame({
+            'flavour': flavour,
+            'file': os.path.basename(file),
+            'path': file,
+            'journey': first_journey + journey_ids[starts],
+            'fingerprint': np.asarray(fingerprints, dtype=object)[journey_ids[starts]],
+        })
+        for column in SUMMARY_COLUMNS:
+            if column in df.columns:
+                journeys[column] = first[column].to_numpy()
+        journeys['origin'] = first['location'].to_numpy()
+        journeys['destination'] = df['location'].to_numpy()[ends]
+        journeys['departure_time'] = first[DEPARTURE_COLUMNS[flavour]].to_numpy()
+        frames.append(journeys)
+    if not frames:
+        return pd.DataFrame(columns=['flavour', 'file', 'path', 'journey', 'fingerprint', 'unique_identifier'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def match_journeys(old, new):
+    """
+    Match the journeys of two extracts. Journeys with the same fingerprint are unchanged - as many times as the
+    fingerprint is found in both. The rest are paired by flavour and unique identifier, in order.
+    :param old: journeys of the old extract - see fingerprint_extract
+    :param new: journeys of the new extract
+    :return: tuple of (number of unchanged journeys, added journeys, removed journeys, changed journey pairs)
+    """
+    old = old.assign(occurrence=old.groupby('fingerprint', sort=False).cumcount())
+    new = new.assign(occurrence=new.groupby('fingerprint', sort=False).cumcount())
+    same = old[['fingerprint', 'occurrence']].merge(new[['fingerprint', 'occurrence']], how='inner')
+    unchanged = pd.MultiIndex.from_frame(same)
+    old = old[~pd.MultiIndex.from_frame(old[['fingerprint', 'occurrence']]).isin(unchanged)]
+    new = new[~pd.MultiIndex.from_frame(new[['fingerprint', 'occurrence']]).isin(unchanged)]
+
+    key = ['flavour', 'unique_identifier', 'occurrence']
+    old = old.assign(occurrence=old.groupby(['flavour', 'unique_identifier'], sort=False, dropna=False).cumcount())
+    new = new.assign(occurrence=new.groupby(['flavour', 'unique_identifier'], sort=False, dropna=False).cumcount())
+    pairs = old.merge(new, on=key, how='outer', suffixes=('_old', '_new'), indicator=True)
+    pairs = pairs[key + [column for column in pairs.columns if column not in key]]
+    added = new.merge(pairs.loc[pairs['_merge'] == 'right_only', key], on=key).drop(columns='occurrence')
+    removed = old.merge(pairs.loc[pairs['_merge'] == 'left_only', key], on=key).drop(columns='occurrence')
+    changed = pairs[pairs['_merge'] == 'both'].drop(columns=['_merge', 'occurrence']).reset_index(drop=True)
+    changed = changed.astype({'journey_old': int, 'journey_new': int})
+    return len(same), added, removed, changed
+
+
+def load_journey_rows(journeys, chunk_rows=CHUNK_ROWS):
+    """
+    Parse the files of some journeys again and keep their timetable rows.
+    :param journeys: dataframe of path and journey (index within the file)
+    :param chunk_rows: number of .cif rows parsed at once
+    :return: dictionary of (path, journey): timetable dataframe
+    """
+    wanted = journeys.groupby('path')['journey'].apply(set).to_dict()
+    rows = {}
+    for file, _, df, journey_ids, _, first_journey in iter_journey_chunks(sorted(wanted), chunk_rows):
+        index = first_journey + journey_ids
+        keep = np.isin(index, list(wanted[file]))
+        for journey, journey_rows in df[keep].groupby(index[keep], sort=False):
+            rows[(file, journey)] = journey_rows.reset_index(drop=True)
+    return rows
+
+
+def get_field_changes(old_rows, new_rows, stop_columns):
+    """
+    Field level changes between two versions of a journey.
+    :param old_rows: timetable rows of the old journey
+    :param new_rows: timetable rows of the new journey
+    :param stop_columns: stop time columns - all other columns are journey fields
+    :return: dataframe of stop_sequence (empty for journey fields), location, field, old_value and new_value
+    """
+    old_rows = old_rows.astype(object).where(old_rows.notna(), '').astype(str)
+    new_rows = new_rows.astype(object).where(new_rows.notna(), '').astype(str)
+    changes = []
+    for field in [column for column in old_rows.columns if column not in stop_columns and column in new_rows.columns]:
+        if old_rows[field].iloc[0] != new_rows[field].iloc[0]:
+            changes.append({'stop_sequence': '', 'location': '', 'field': field,
+                            'old_value': old_rows[field].iloc[0], 'new_value': new_rows[field].iloc[0]})
+    if old_rows['location'].tolist() != new_rows['location'].tolist():
+        changes.append({'stop_sequence': '', 'location': '', 'field': 'stops',
+                        'old_value': ' '.join(old_rows['location']), 'new_value': ' '.join(new_rows['location'])})
+    else:
+        for field in [column for column in stop_columns if column in old_rows.columns and column in new_rows.columns]:
+            differs = np.flatnonzero(old_rows[field].to_numpy() != new_rows[field].to_numpy())
+            changes.extend({'stop_sequence': i + 1, 'location': old_rows['location'].iloc[i], 'field': field,
+                            'old_value': old_rows[field].iloc[i], 'new_value': new_rows[field].iloc[i]}
+                           for i in differs)
+    return pd.DataFrame(changes, columns=['stop_sequence', 'location', 'field', 'old_value', 'new_value'])
+
+
+def get_change_type(changes):
+    """
+    'rerouted' for journeys calling at other stops, 'retimed' for journeys with only times changed, 'modified'
+    otherwise.
+    """
+    fields = set(changes['field'])
+    if 'stops' in fields:
+        return 'rerouted'
+    if fields and fields <= set(TIME_COLUMNS):
+        return 'retimed'
+    return 'modified'
+
+
+def diff_extracts(old_files, new_files, output_folder, chunk_rows=CHUNK_ROWS, profile=False, trace_memory=False):
+    """
+    Compare two .cif extracts and save the added, removed and changed journeys in the output folder.
+    :param old_files: list of paths to .cif files of the old extract
+    :param new_files: list of paths to .cif files of the new extract
+    :param output_folder: folder to save the results in
+    :param chunk_rows: number of .cif rows parsed at once
+    :param profile: True to save a cProfile of the run with the run report
+    :param trace_memory: True to trace memory allocations with tracemalloc
+    :return: list of saved paths
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    saved = []
+    with RunReport('timetable_diff', output_folder, profile=profile, trace_memory=trace_memory) as report:
+        with report.stage('fingerprint'):
+            old = fingerprint_extract(old_files, chunk_rows, report)
+            new = fingerprint_extract(new_files, chunk_rows, report)
+        with report.stage('match'):
+            unchanged, added, removed, changed = match_journeys(old, new)
+        report.count('old_journeys', len(old))
+        report.count('new_journeys', len(new))
+        report.count('unchanged', unchanged)
+        report.count('added', len(added))
+        report.count('removed', len(removed))
+        report.count('changed', len(changed))
+
+        with report.stage('changes'):
+            rows = load_journey_rows(pd.concat([
+                changed[['path_old', 'journey_old']].set_axis(['path', 'journey'], axis=1),
+                changed[['path_new', 'journey_new']].set_axis(['path', 'journey'], axis=1)]))
+            changes = []
+            change_types = []
+            for pair in changed.itertuples(index=False):
+                journey_changes = get_field_changes(rows[(pair.path_old, pair.journey_old)],
+                                                    rows[(pair.path_new, pair.journey_new)],
+                                                    STOP_COLUMNS[pair.flavour])
+                change_types.append(get_change_type(journey_changes))
+                journey_changes.insert(0, 'flavour', pair.flavour)
+                journey_changes.insert(1, 'unique_identifier', pair.unique_identifier)
+                changes.append(journey_changes)
+            changed.insert(changed.columns.get_loc('unique_identifier') + 1, 'change', change_types)
+
+        with report.stage('write'):
+            tables = [
+                ('added_journeys', added),
+                ('removed_journeys', removed),
+                ('changed_journeys', changed),
+                ('journey_changes', pd.concat(changes, ignore_index=True) if changes else
+                 pd.DataFrame(columns=['flavour', 'unique_identifier', 'stop_sequence', 'location', 'field',
+                                       'old_value', 'new_value'])),
+            ]
+            for table, df in tables:
+                path = os.path.join(output_folder, table + '.csv')
+                df.drop(columns=[column for column in df.columns if column.startswith(('fingerprint', 'path'))]) \
+                    .to_csv(path, index=False)
+                saved.append(path)
+    print("{} journeys unchanged, {} added, {} removed, {} changed.".format(unchanged, len(added), len(removed),
+                                                                            len(changed)))
+    return saved
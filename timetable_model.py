@@ -0,0 +1,167 @@
+"""
+timetable_model.py
+
+Compact in-memory model of the journeys read from an ATCO-CIF .cif file - an alternative to holding every stop as a
+dictionary with a copy of its journey header:
+- location, operator and other short codes are interned and stored as integer ids,
+- journey headers are stored once per journey and referenced by journey id,
+- stop times are stored as minutes past midnight in typed arrays.
+
+Header data is only broadcast to stops when the flat timetable is exported with TimetableModel.to_frame().
+
+"""
+import array
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from atco_cif_parser import ATCO_CIF_SPECIFICATION, check_duplicate_stops
+
+# Stop time columns, stored as minutes past midnight.
+TIME_COLUMNS = ['published_arrival_time', 'published_departure_time']
+
+# Other stop columns, stored as ids of interned strings - every field of journey origin, intermediate and
+# destination records.
+CODE_COLUMNS = []
+for _record_identity in ['QO', 'QI', 'QT']:
+    for _key in ATCO_CIF_SPECIFICATION[_record_identity]:
+        if _key not in TIME_COLUMNS and _key not in CODE_COLUMNS:
+            CODE_COLUMNS.append(_key)
+
+# Marks a stop without a given time.
+NO_TIME = -1
+
+# Minutes past midnight -> datetime.time lookup, shifted by one so that NO_TIME maps to None.
+_TIME_VALUES = np.array([None] + [datetime.time(hour=minute // 60, minute=minute % 60) for minute in range(1440)],
+                        dtype=object)
+
+
+def encode_time(value):
+    """
+    Convert a datetime.time object into minutes past midnight.
+    :param value: datetime.time object or None
+    :return: minutes past midnight, NO_TIME for None
+    """
+    if value is None:
+        return NO_TIME
+    return value.hour * 60 + value.minute
+
+
+class StringPool(object):
+    """
+    Interned strings - every distinct value is stored once and referred to by its integer id. Id 0 is None.
+    """
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = {None: 0}
+        self.values = [None]
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, value):
+        """
+        :return: id of the value, added to the pool if not there yet
+        """
+        try:
+            return self.ids[value]
+        except KeyError:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+            return self.ids[value]
+
+    def decode(self, ids):
+        """
+        :param ids: numpy array of ids
+        :return: numpy object array of strings
+        """
+        return np.array(self.values, dtype=object)[ids]
+
+
+class TimetableModel(object):
+    """
+    Journeys of a .cif file stored column-wise. Journeys are numbered in the order they were added; every stop holds
+    the id of its journey.
+    """
+    __slots__ = ('strings', 'header_columns', 'headers', 'journey_operators', 'journey_duplicates', 'stop_journeys',
+                 'stop_times', 'stop_codes')
+
+    def __init__(self):
+        self.strings = StringPool()
+        # Journey header fields, except record identity and operator.
+        self.header_columns = None
+        # One tuple of header values per journey.
+        self.headers = []
+        self.journey_operators = array.array('i')
+        self.journey_duplicates = array.array('b')
+        self.stop_journeys = array.array('i')
+        self.stop_times = {column: array.array('h') for column in TIME_COLUMNS}
+        self.stop_codes = {column: array.array('i') for column in CODE_COLUMNS}
+
+    def __len__(self):
+        return len(self.stop_journeys)
+
+    @property
+    def journey_count(self):
+        return len(self.headers)
+
+    def add_journey(self, journey):
+        """
+        Add a journey read with atco_cif_parser.iter_atco_cif.
+        :param journey: journey dictionary
+        :return: journey id
+        """
+        header = journey['header']
+        if self.header_columns is None:
+            self.header_columns = [key for key in header if key not in ('record_identity', 'operator')]
+        journey_id = len(self.headers)
+        self.headers.append(tuple(header.get(key) for key in self.header_columns))
+        self.journey_operators.append(self.strings.intern(header.get('operator')))
+        self.journey_duplicates.append(check_duplicate_stops(journey['stops']))
+
+        intern = self.strings.intern
+        for stop in journey['stops']:
+            self.stop_journeys.append(journey_id)
+            for column, values in self.stop_times.items():
+                values.append(encode_time(stop.get(column)))
+            for column, values in self.stop_codes.items():
+                values.append(intern(stop.get(column)))
+        return journey_id
+
+    def to_frame(self):
+        """
+        Export the flat timetable - one row per stop holding the id and arrival time of the next stop as well as all
+        journey header data, same as atco_cif_parser.flatten_journey.
+        :return: timetable dataframe
+        """
+        journeys = as_numpy(self.stop_journeys)
+        data = {}
+        for column, values in self.stop_codes.items():
+            data[column] = self.strings.decode(as_numpy(values))
+        for column, values in self.stop_times.items():
+            data[column] = _TIME_VALUES[as_numpy(values) + 1]
+
+        # Next stop of the same journey - the last stop of a journey has none.
+        has_next = np.zeros(len(self), dtype=bool)
+        has_next[:-1] = journeys[:-1] == journeys[1:]
+        next_stop = np.flatnonzero(has_next) + 1
+        for column, source in [('next_stop_id', 'location'), ('next_stop_arrival_time', 'published_arrival_time')]:
+            values = np.full(len(self), None, dtype=object)
+            values[has_next] = data[source][next_stop]
+            data[column] = values
+
+        #   Broadcast journey data to stops.
+        data['has_duplicated_stops'] = as_numpy(self.journey_duplicates)[journeys]
+        data['operator'] = self.strings.decode(as_numpy(self.journey_operators)[journeys])
+        for i, column in enumerate(self.header_columns or []):
+            data[column] = np.array([header[i] for header in self.headers], dtype=object)[journeys]
+        return pd.DataFrame(data)
+
+
+def as_numpy(values):
+    """
+    View a typed array as a numpy array without copying it.
+    """
+    return np.frombuffer(values, dtype=values.typecode)
@@ -0,0 +1,357 @@
+"""
+timetable_store.py
+
+Embedded database store for converted timetables. Instead of re-reading a .csv for every analysis, a timetable is
+bulk-loaded once into a local SQLite (or, if installed, DuckDB) file with indexes on location, route, unique
+identifier, departure time and day flags. Stop frequencies and headways then run as indexed SQL queries, and the
+store can be opened read-only by any number of analysts at the same time.
+
+Both ATCO-CIF timetables (CIF_timetable_converter.py) and rail timetables (ScotRail_CIF_timetable_converter.py) are
+supported - rail timetables are told apart by their 'train_uid' column. Times are stored as zero-padded hh:mm:ss
+text, same as in the .csv timetables, so comparing them as strings is the same as comparing times.
+
+    python cif_timetable_reader.py convert "CIF_data/*.cif" -o timetables --format sqlite
+    python cif_timetable_reader.py frequency "timetables/*.sqlite" -o stop_frequency --by-routes
+    python cif_timetable_reader.py headway "timetables/*.sqlite" -o headways --window 07:00-10:00
+
+"""
+import datetime
+import os
+import sqlite3
+
+import pandas as pd
+
+from normalized_timetable import DAY_COLUMNS
+from tiploc_reference import get_join_keys
+
+# Name of the table holding the timetable.
+TIMETABLE_TABLE = 'timetable'
+
+# Store file extensions - SQLite by default, DuckDB when the path ends with .duckdb.
+STORE_EXTENSIONS = ('.sqlite', '.duckdb')
+
+# Indexed columns - day flags are indexed together with the departure time, as every query filters on both.
+ATCO_INDEXES = [
+    ['location'],
+    ['route_number_(identifier)'],
+    ['unique_identifier'],
+    ['vehicle_type'],
+]
+ATCO_TIME_COLUMNS = {'arrival': 'published_arrival_time', 'departure': 'published_departure_time'}
+RAIL_INDEXES = [
+    ['location'],
+    ['unique_identifier'],
+    ['train_uid'],
+]
+RAIL_TIME_COLUMNS = {'arrival': 'public_arrival_time', 'departure': 'public_departure_time'}
+
+# Rows inserted at once.
+BATCH_SIZE = 50000
+
+
+def is_store(path):
+    """
+    Check whether a path is a timetable store.
+    """
+    return path.endswith(STORE_EXTENSIONS)
+
+
+def connect(path, read_only=False):
+    """
+    Open a timetable store. SQLite stores are opened in WAL mode, so readers never block each other or the writer.
+    :param path: path to .sqlite or .duckdb file
+    :param read_only: True to open an existing store read-only - any number of processes can do so at once
+    :return: database connection
+    """
+    if path.endswith('.duckdb'):
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("duckdb is required for .duckdb stores - pip install duckdb, or use a .sqlite store.")
+        return duckdb.connect(path, read_only=read_only)
+
+    if read_only:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(path)), uri=True,
+                                     check_same_thread=False)
+    else:
+        connection = sqlite3.connect(path, timeout=60)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def quote(name):
+    """
+    Quote a column or table name for use in SQL - timetable columns hold characters like brackets.
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def get_sql_type(series):
+    """
+    SQL column type of a dataframe column.
+    """
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(series):
+        return 'REAL'
+    return 'TEXT'
+
+
+def prepare_frame(df):
+    """
+    Convert a timetable into values every database accepts: datetime.time objects become hh:mm:ss strings, dates
+    become yyyy-mm-dd strings and missing values and empty strings become None, same as when a .csv timetable is
+    read back.
+    :param df: timetable dataframe
+    :return: dataframe with plain values
+    """
+    data = {}
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.dt.strftime('%Y-%m-%d')
+        elif series.dtype == object:
+            series = series.map(lambda value: value.strftime('%H:%M:%S') if isinstance(value, datetime.time)
+                                else None if value == '' else value)
+        data[column] = series
+    frame = pd.DataFrame(data, index=df.index)
+    return frame.astype(object).where(frame.notna(), None)
+
+
+def write_timetable(df, path, table=TIMETABLE_TABLE, batch_size=BATCH_SIZE):
+    """
+    Bulk-load a timetable into a store, replacing any table of the same name, and index it.
+    :param df: timetable dataframe created with CIF_timetable_converter.py or ScotRail_CIF_timetable_converter.py
+    :param path: path to .sqlite or .duckdb file
+    :param table: name of the table
+    :param batch_size: number of rows inserted at once
+    :return: path to the store
+    """
+    #   Rail timetables hold day flags as '0'/'1' strings.
+    df = df.astype({column: 'int64' for column in DAY_COLUMNS if column in df.columns})
+    frame = prepare_frame(df)
+    columns = ', '.join('{} {}'.format(quote(column), get_sql_type(df[column])) for column in df.columns)
+    connection = connect(path)
+    try:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(quote(table)))
+        connection.execute('CREATE TABLE {} ({})'.format(quote(table), columns))
+        if path.endswith('.duckdb'):
+            #   DuckDB reads the dataframe directly, row by row inserts would be slow.
+            connection.register('timetable_frame', frame)
+            connection.execute('INSERT INTO {} SELECT * FROM timetable_frame'.format(quote(table)))
+            connection.unregister('timetable_frame')
+        else:
+            insert = 'INSERT INTO {} VALUES ({})'.format(quote(table), ', '.join(['?'] * len(df.columns)))
+            rows = frame.itertuples(index=False, name=None)
+            with connection:
+                while True:
+                    batch = [row for _, row in zip(range(batch_size), rows)]
+                    if not batch:
+                        break
+                    connection.executemany(insert, batch)
+        create_indexes(connection, table, df.columns)
+    finally:
+        connection.close()
+    return path
+
+
+def create_indexes(connection, table, columns):
+    """
+    Index a timetable table on location, route, unique identifier, and on every day flag with the departure and
+    arrival times.
+    :param connection: store connection
+    :param table: name of the table
+    :param columns: columns of the table
+    """
+    is_rail = 'train_uid' in columns
+    indexes = list(RAIL_INDEXES if is_rail else ATCO_INDEXES)
+    time_columns = RAIL_TIME_COLUMNS if is_rail else ATCO_TIME_COLUMNS
+    for day in DAY_COLUMNS:
+        for time_column in time_columns.values():
+            indexes.append([day, time_column])
+    for index in indexes:
+        if not all(column in columns for column in index):
+            continue
+        name = '{}_{}'.format(table, '_'.join(index)).replace('(', '').replace(')', '')
+        connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            quote(name), quote(table), ', '.join(quote(column) for column in index)))
+    if isinstance(connection, sqlite3.Connection):
+        connection.execute('ANALYZE')
+        connection.commit()
+
+
+def get_columns(connection, table=TIMETABLE_TABLE):
+    """
+    :return: list of column names of a stored timetable
+    """
+    return [column[0] for column in connection.execute('SELECT * FROM {} LIMIT 0'.format(quote(table))).description]
+
+
+def is_rail_store(connection, table=TIMETABLE_TABLE):
+    """
+    Check whether a stored timetable was created with ScotRail_CIF_timetable_converter.py.
+    """
+    return 'train_uid' in get_columns(connection, table)
+
+
+def read_sql(connection, query, parameters=()):
+    """
+    Run a query and return the result as a dataframe.
+    """
+    cursor = connection.execute(query, parameters)
+    columns = [column[0] for column in cursor.description]
+    return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+
+def get_window(day, start_hour, end_hour, start_minute=0, end_minute=0):
+    """
+    Day flag column and the start and end of a time window as hh:mm:ss strings.
+    :return: tuple of (day column, start, end)
+    """
+    start = datetime.time(hour=start_hour, minute=start_minute).strftime('%H:%M:%S')
+    end = datetime.time(hour=end_hour, minute=end_minute).strftime('%H:%M:%S')
+    return 'operates_on_' + day.lower() + 's', start, end
+
+
+def get_stop_frequency(connection, day, start_hour, end_hour, group_by_routes=False, group_by_departure=True,
+                       start_minute=0, end_minute=0, table=TIMETABLE_TABLE):
+    """
+    Same as stop_frequency_counter.get_stop_frequency, run as a single indexed query on a stored ATCO-CIF timetable.
+    :param connection: store connection
+    :param day: day of week
+    :param start_hour: starting hour
+    :param end_hour: ending hour
+    :param group_by_routes: True if you want to get frequencies of particular routes on a stop
+    :param group_by_departure: True if you want to analyze frequency by departure, not arrival time
+    :param start_minute: starting minute
+    :param end_minute: ending minute
+    :param table: name of the timetable table
+    :return: dataframe with stops and frequencies in a given time period.
+    """
+    day, start, end = get_window(day, start_hour, end_hour, start_minute, end_minute)
+    group_by_cols = ['location', 'route_number_(identifier)'] if group_by_routes else ['location']
+    timestamp_column = ATCO_TIME_COLUMNS['departure' if group_by_departure else 'arrival']
+    group_by = ', '.join(quote(column) for column in group_by_cols)
+
+    frequency = read_sql(connection, """
+        SELECT {group_by},
+            SUM({day}) AS frequency,
+            SUM(CASE WHEN route_direction = 'I' THEN {day} END) AS inbound_frequency,
+            SUM(CASE WHEN route_direction = 'O' THEN {day} END) AS outbound_frequency
+        FROM {table}
+        WHERE {day} = 1 AND {time} >= ? AND {time} <= ?
+        GROUP BY {group_by}
+        ORDER BY frequency DESC, {group_by}
+        """.format(group_by=group_by, day=quote(day), time=quote(timestamp_column), table=quote(table)),
+                         (start, end))
+    #   Add prefix for easier joining with shapefiles.
+    frequency['location'] = frequency['location'].apply(lambda x: 'QLN' + str(x).strip())
+    return frequency
+
+
+def get_rail_stop_frequency(connection, day, start_hour, end_hour, group_by_routes=False, get_services=False,
+                            start_minute=0, end_minute=0, table=TIMETABLE_TABLE):
+    """
+    Same as ScotRail_TRACC_stop_frequency_counter.get_stop_frequency, run as indexed queries on a stored rail
+    timetable. Public calls arriving or departing within the time period are counted once.
+    :param connection: store connection
+    :param day: day of week
+    :param group_by_routes: True if you want to get frequencies of particular routes on a stop
+    :param get_services: True to list the services calling at each stop
+    :param table: name of the timetable table
+    :return: dataframe with stops and frequencies in a given time period.
+    """
+    day, start, end = get_window(day, start_hour, end_hour, start_minute, end_minute)
+    group_by_cols = ['location', 'unique_identifier'] if group_by_routes else ['location']
+    group_by = ', '.join(quote(column) for column in group_by_cols)
+    calls = """
+        SELECT DISTINCT location, unique_identifier, scheduled_arrival_time, scheduled_departure_time,
+            public_arrival_time, public_departure_time
+        FROM {table}
+        WHERE {day} = 1 AND scheduled_pass IS NULL
+            AND ((public_arrival_time >= ? AND public_arrival_time <= ?)
+                OR (public_departure_time >= ? AND public_departure_time <= ?))
+        """.format(table=quote(table), day=quote(day))
+
+    frequency = read_sql(connection, """
+        SELECT {group_by}, COUNT(*) AS total_frequency
+        FROM ({calls})
+        GROUP BY {group_by}
+        ORDER BY total_frequency DESC, {group_by}
+        """.format(group_by=group_by, calls=calls), (start, end, start, end))
+
+    if get_services:
+        #   Analyze services on each location.
+        routes = read_sql(connection, """
+            SELECT DISTINCT location, unique_identifier FROM ({calls}) ORDER BY location, unique_identifier
+            """.format(calls=calls), (start, end, start, end))
+        services = routes.groupby('location', sort=False)['unique_identifier'].apply(list) \
+            .rename('total_routes').reset_index()
+        frequency = frequency.merge(services, how='left', on='location')
+
+    #       Add prefix for easier joining with shapefiles - ATCO codes of locations mapped at conversion time.
+    atco_codes = None
+    if 'atco_code' in get_columns(connection, table):
+        codes = read_sql(connection, 'SELECT DISTINCT location, atco_code FROM {}'.format(quote(table)))
+        atco_codes = frequency['location'].map(codes.drop_duplicates('location').set_index('location')['atco_code'])
+    frequency['location'] = get_join_keys(frequency['location'], atco_codes)
+    return frequency
+
+
+def get_headways(connection, day, start_hour, end_hour, group_by_routes=False, start_minute=0, end_minute=0,
+                 table=TIMETABLE_TABLE):
+    """
+    Headways between consecutive departures from each stop within a time period, in minutes. Works on both ATCO-CIF
+    and rail timetables.
+    :param connection: store connection
+    :param day: day of week
+    :param start_hour: starting hour
+    :param end_hour: ending hour
+    :param group_by_routes: True to calculate headways of particular routes on a stop
+    :param start_minute: starting minute
+    :param end_minute: ending minute
+    :param table: name of the timetable table
+    :return: dataframe with number of departures and mean, minimum and maximum headway of every stop
+    """
+    day, start, end = get_window(day, start_hour, end_hour, start_minute, end_minute)
+    is_rail = is_rail_store(connection, table)
+    route_column = 'unique_identifier' if is_rail else 'route_number_(identifier)'
+    departure = quote((RAIL_TIME_COLUMNS if is_rail else ATCO_TIME_COLUMNS)['departure'])
+    group_by_cols = ['location', route_column] if group_by_routes else ['location']
+    group_by = ', '.join(quote(column) for column in group_by_cols)
+    minutes = 'CAST(substr({0}, 1, 2) AS INTEGER) * 60 + CAST(substr({0}, 4, 2) AS INTEGER)'.format(departure)
+    passing = 'AND scheduled_pass IS NULL' if is_rail else ''
+
+    return read_sql(connection, """
+        SELECT {group_by},
+            COUNT(*) AS departures,
+            AVG(headway) AS mean_headway,
+            MIN(headway) AS min_headway,
+            MAX(headway) AS max_headway
+        FROM (
+            SELECT {group_by},
+                {minutes} - LAG({minutes}) OVER (PARTITION BY {group_by} ORDER BY {departure}) AS headway
+            FROM {table}
+            WHERE {day} = 1 AND {departure} >= ? AND {departure} <= ? {passing}
+        ) AS departures
+        GROUP BY {group_by}
+        ORDER BY departures DESC, {group_by}
+        """.format(group_by=group_by, minutes=minutes, departure=departure, table=quote(table), day=quote(day),
+                   passing=passing), (start, end))
+
+
+def load_store(path, columns=None, table=TIMETABLE_TABLE):
+    """
+    Read a stored timetable back into a dataframe.
+    :param path: path to .sqlite or .duckdb file
+    :param columns: columns to read, all when not provided
+    :param table: name of the timetable table
+    :return: timetable dataframe
+    """
+    connection = connect(path, read_only=True)
+    try:
+        selected = ', '.join(quote(column) for column in columns) if columns else '*'
+        return read_sql(connection, 'SELECT {} FROM {}'.format(selected, quote(table)))
+    finally:
+        connection.close()
@@ -0,0 +1,177 @@
+"""
+tiploc_reference.py
+
+TIPLOC to stop reference mapping for rail timetables. Rail .cif files locate calls by TIPLOC, while ATCO-CIF
+timetables and stop shapefiles use NaPTAN (ATCO) stop codes. A local correspondence table - e.g. RailReferences.csv
+of the NaPTAN download, with AtcoCode, TiplocCode, CrsCode and StationName columns - is read once and cached next
+to it as a compact .npz lookup index, which later runs load instead of the .csv:
+
+    python cif_timetable_reader.py convert "CIF_data/*.CIF" -o timetables --tiploc-reference RailReferences.csv
+
+Locations are mapped at conversion time - atco_code and crs_code columns are added to the rail timetable - and
+TIPLOCs missing from the reference are saved to <name>_unmatched_tiplocs.csv with their number of calls and passes.
+Frequency counters then join on 'QLN' + ATCO code, and fall back on 'QLN9100' + TIPLOC for unmatched locations and
+timetables converted without a reference.
+
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+# Columns of the lookup index and the names they go by in correspondence tables.
+REFERENCE_COLUMNS = {
+    'tiploc': ['TiplocCode', 'tiploc_code', 'tiploc'],
+    'atco_code': ['AtcoCode', 'atco_code', 'naptan_code'],
+    'crs_code': ['CrsCode', 'crs_code', 'crs'],
+    'name': ['StationName', 'station_name', 'name'],
+}
+
+# Columns added to rail timetables by map_timetable - they describe a single stop.
+MAPPED_COLUMNS = ['atco_code', 'crs_code']
+
+# Lookup indexes loaded so far - path: (modification time, TiplocReference).
+_CACHE = {}
+
+
+class TiplocReference(object):
+    """
+    Lookup index of a correspondence table - TIPLOCs sorted, with the ATCO code, CRS code and name of each.
+    """
+    __slots__ = ('tiplocs', 'atco_codes', 'crs_codes', 'names')
+
+    def __init__(self, tiplocs, atco_codes, crs_codes, names):
+        self.tiplocs = tiplocs
+        self.atco_codes = atco_codes
+        self.crs_codes = crs_codes
+        self.names = names
+
+    def __len__(self):
+        return len(self.tiplocs)
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Build the lookup index of a correspondence table. The first entry of a TIPLOC listed more than once is kept.
+        :param df: correspondence dataframe - see REFERENCE_COLUMNS
+        :return: TiplocReference
+        """
+        columns = {}
+        for column, names in REFERENCE_COLUMNS.items():
+            name = next((name for name in names if name in df.columns), None)
+            if name is None and column == 'tiploc':
+                raise ValueError("Correspondence table has no TIPLOC column - expected one of {}.".format(names))
+            columns[column] = df[name].fillna('').astype(str).str.strip() if name else pd.Series('', index=df.index)
+        table = pd.DataFrame(columns)
+        table = table[table['tiploc'] != ''].drop_duplicates('tiploc').sort_values('tiploc')
+        return cls(*[table[column].to_numpy(dtype=str) for column in REFERENCE_COLUMNS])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a lookup index saved with save.
+        """
+        with np.load(path, allow_pickle=False) as index:
+            return cls(*[index[column] for column in REFERENCE_COLUMNS])
+
+    def save(self, path):
+        """
+        Save the lookup index as an uncompressed .npz file.
+        """
+        np.savez(path, tiploc=self.tiplocs, atco_code=self.atco_codes, crs_code=self.crs_codes, name=self.names)
+
+    def lookup(self, tiplocs):
+        """
+        Find TIPLOCs in the index.
+        :param tiplocs: array of stripped TIPLOC strings
+        :return: integer array of positions in the index, -1 for TIPLOCs not found
+        """
+        tiplocs = np.asarray(tiplocs, dtype=str)
+        if not len(self):
+            return np.full(len(tiplocs), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.tiplocs, tiplocs), len(self) - 1)
+        return np.where(self.tiplocs[positions] == tiplocs, positions, -1)
+
+    def map_locations(self, locations):
+        """
+        Map timetable locations to ATCO and CRS codes. Every distinct location is only looked up once.
+        :param locations: series of TIPLOCs
+        :return: tuple of (ATCO codes, CRS codes) object arrays - None for locations not found
+        """
+        codes, uniques = pd.factorize(locations.astype(str).str.strip())
+        positions = self.lookup(uniques.to_numpy(dtype=str))
+        found = positions >= 0
+        mapped = []
+        for values in [self.atco_codes, self.crs_codes]:
+            unique_values = np.full(len(uniques), None, dtype=object)
+            unique_values[found] = values[positions[found]]
+            unique_values[unique_values == ''] = None
+            mapped.append(np.where(codes >= 0, unique_values[codes], None))
+        return tuple(mapped)
+
+
+def get_index_path(path):
+    """
+    Path of the cached lookup index of a correspondence table.
+    """
+    return os.path.splitext(path)[0] + '_index.npz'
+
+
+def load_reference(path):
+    """
+    Load a correspondence table once. The lookup index is kept in memory and cached as .npz next to the table; the
+    cache is rebuilt whenever the table is newer.
+    :param path: path to correspondence .csv
+    :return: TiplocReference
+    """
+    modified = os.path.getmtime(path)
+    cached = _CACHE.get(path)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+    index_path = get_index_path(path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= modified:
+        reference = TiplocReference.load(index_path)
+    else:
+        available = pd.read_csv(path, nrows=0).columns
+        usecols = [name for names in REFERENCE_COLUMNS.values() for name in names if name in available]
+        reference = TiplocReference.from_frame(pd.read_csv(path, usecols=usecols, dtype=str))
+        try:
+            reference.save(index_path)
+        except OSError as e:
+            print("{} - lookup index not cached: {!r}".format(path, e))
+    _CACHE[path] = (modified, reference)
+    return reference
+
+
+def map_timetable(df, reference):
+    """
+    Add the ATCO and CRS codes of every location to a rail timetable, right after the location column.
+    :param df: rail timetable dataframe
+    :param reference: TiplocReference
+    :return: tuple of (timetable dataframe, unmatched dataframe of location, calls and passes - most called first)
+    """
+    atco_codes, crs_codes = reference.map_locations(df['location'])
+    df = df.copy()
+    position = df.columns.get_loc('location') + 1
+    for i, (column, values) in enumerate(zip(MAPPED_COLUMNS, [atco_codes, crs_codes])):
+        df.insert(position + i, column, values)
+    unmatched = df.loc[pd.isna(atco_codes), ['location']].assign(
+        calls=df['scheduled_pass'].isna().astype(int) if 'scheduled_pass' in df.columns else 1)
+    unmatched = unmatched.groupby('location', as_index=False).agg(calls=('calls', 'sum'), rows=('calls', 'size'))
+    unmatched['passes'] = unmatched.pop('rows') - unmatched['calls']
+    return df, unmatched.sort_values(['calls', 'location'], ascending=[False, True]).reset_index(drop=True)
+
+
+def get_join_keys(locations, atco_codes=None):
+    """
+    Keys for joining rail frequencies with stop shapefiles - 'QLN' + ATCO code of mapped locations, 'QLN9100' +
+    TIPLOC otherwise.
+    :param locations: series of TIPLOCs
+    :param atco_codes: optional series of ATCO codes, aligned with locations
+    :return: series of join keys
+    """
+    keys = 'QLN9100' + locations.astype(str).str.strip()
+    if atco_codes is None:
+        return keys
+    atco_codes = atco_codes.astype(object).where(atco_codes.notna(), '').astype(str).str.strip()
+    return keys.where(atco_codes == '', 'QLN' + atco_codes)
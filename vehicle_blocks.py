@@ -0,0 +1,181 @@
+"""
+vehicle_blocks.py
+
+Vehicle blocks of ATCO-CIF timetables created with CIF_timetable_converter.py. Journeys of an operator worked by the
+same running board on a given day form a block - the day's work of one vehicle. Journeys are indexed by operator,
+running board and departure time once, then chained, layovers and peak vehicle requirements are found in
+vectorized passes over the sorted index:
+
+    python cif_timetable_reader.py blocks "timetables/*_timetable.csv" -o blocks --day tuesday saturday
+
+Three tables are saved per timetable and day:
+- <name>_<day>_blocks.csv - every journey with its block, position in the block and layover before the next journey,
+- <name>_<day>_block_summary.csv - first departure, last arrival, time in service and layovers of every block,
+- <name>_<day>_peak_vehicles.csv - peak number of blocks in service at once, by operator.
+
+Journeys without a running board can't be chained and count as a block of their own.
+
+"""
+import numpy as np
+import pandas as pd
+
+from connection_scan import ATCO_TIME_COLUMNS, get_minutes, get_time_strings, load_timetable
+from normalized_timetable import ORIGIN_RECORDS
+
+# Timetable columns needed to build blocks.
+BLOCK_COLUMNS = ['record_identity', 'operator', 'running_board', 'vehicle_type', 'unique_identifier',
+                 'route_number_(identifier)', 'location', 'first_date_of_operation', 'last_date_of_operation'] + \
+    list(ATCO_TIME_COLUMNS)
+
+
+def get_journeys(df):
+    """
+    Reduce a timetable to one row per journey, with its first departure and last arrival.
+    :param df: timetable dataframe, stops of each journey in order
+    :return: journeys dataframe, times in minutes past midnight - above 1440 past midnight
+    """
+    df = df.reset_index(drop=True)
+    starts = np.flatnonzero(df['record_identity'].isin(ORIGIN_RECORDS).to_numpy())
+    ends = np.r_[starts[1:], len(df)][:len(starts)] - 1
+    arrival, departure = ATCO_TIME_COLUMNS
+    first = df.iloc[starts]
+    last = df.iloc[ends]
+    journeys = pd.DataFrame({
+        'operator': first['operator'].to_numpy(),
+        'running_board': first['running_board'].to_numpy(),
+        'vehicle_type': first['vehicle_type'].to_numpy(),
+        'unique_identifier': first['unique_identifier'].to_numpy(),
+        'route_number_(identifier)': first['route_number_(identifier)'].to_numpy(),
+        'origin': first['location'].to_numpy(),
+        'destination': last['location'].to_numpy(),
+        'departure': get_minutes(first[departure]),
+        'arrival': get_minutes(last[arrival]),
+    })
+    # Journeys running past midnight arrive the next day.
+    journeys['arrival'] += np.where(journeys['arrival'] < journeys['departure'], 1440, 0)
+    for column in ['operator', 'running_board']:
+        journeys[column] = journeys[column].fillna('').astype(str).str.strip()
+    return journeys.dropna(subset=['departure', 'arrival']).reset_index(drop=True)
+
+
+def build_blocks(journeys):
+    """
+    Chain the journeys of every running board into blocks, in order of departure.
+    :param journeys: journeys dataframe of a single day - see get_journeys
+    :return: journeys dataframe sorted by operator, running board and departure, with block_id, block_sequence,
+    layover (minutes until the next journey of the block) and next_origin_matches (whether the next journey of the
+    block starts where this one ends)
+    """
+    # Journeys without a running board are blocks of their own.
+    no_board = journeys['running_board'] == ''
+    board = journeys['running_board'].where(~no_board, '#' + journeys.index.astype(str))
+    order = np.lexsort((journeys['departure'].to_numpy(), board.to_numpy(), journeys['operator'].to_numpy()))
+    blocks = journeys.iloc[order].reset_index(drop=True)
+    board = board.to_numpy()[order]
+
+    operator = blocks['operator'].to_numpy()
+    new_block = np.ones(len(blocks), dtype=bool)
+    new_block[1:] = (operator[1:] != operator[:-1]) | (board[1:] != board[:-1])
+    blocks.insert(0, 'block_id', np.cumsum(new_block) - 1)
+    starts = np.flatnonzero(new_block)
+    blocks.insert(1, 'block_sequence',
+                  np.arange(len(blocks)) - np.repeat(starts, np.diff(np.r_[starts, len(blocks)])) + 1)
+
+    chained = np.r_[~new_block[1:], False][:len(blocks)]
+    departure = blocks['departure'].to_numpy()
+    blocks['layover'] = np.where(chained, np.r_[departure[1:], np.nan][:len(blocks)] - blocks['arrival'].to_numpy(),
+                                 np.nan)
+    next_origin = np.r_[blocks['origin'].to_numpy()[1:], None][:len(blocks)]
+    blocks['next_origin_matches'] = np.where(chained, next_origin == blocks['destination'].to_numpy(), None)
+    return blocks
+
+
+def get_block_summary(blocks):
+    """
+    Summarize every block - first departure, last arrival, time in service, driving time and layovers. Negative
+    layovers mean journeys of a block overlap, e.g. boards reused with different calendars.
+    :param blocks: dataframe returned by build_blocks
+    :return: block summary dataframe
+    """
+    blocks = blocks.assign(running_time=blocks['arrival'] - blocks['departure'], overlaps=blocks['layover'] < 0)
+    summary = blocks.groupby('block_id', sort=True).agg(
+        operator=('operator', 'first'),
+        running_board=('running_board', 'first'),
+        vehicle_type=('vehicle_type', 'first'),
+        journeys=('unique_identifier', 'size'),
+        start=('departure', 'first'),
+        end=('arrival', 'max'),
+        running_time=('running_time', 'sum'),
+        layover=('layover', 'sum'),
+        overlaps=('overlaps', 'sum'),
+    ).reset_index()
+    summary['time_in_service'] = summary['end'] - summary['start']
+    return summary
+
+
+def get_peak_vehicles(summary):
+    """
+    Peak vehicle requirement of every operator - the largest number of blocks in service at once. A block is in
+    service from its first departure to its last arrival; a block starting when another one ends needs a vehicle of
+    its own.
+    :param summary: dataframe returned by get_block_summary
+    :return: dataframe of operator, blocks, peak_vehicles and peak_time
+    """
+    operator = summary['operator'].to_numpy()
+    n = len(summary)
+    events = pd.DataFrame({
+        'operator': np.r_[operator, operator],
+        'time': np.r_[summary['start'].to_numpy(), summary['end'].to_numpy()],
+        # Starts sort before ends at the same time.
+        'kind': np.r_[np.zeros(n, dtype=int), np.ones(n, dtype=int)],
+        'change': np.r_[np.ones(n, dtype=int), -np.ones(n, dtype=int)],
+    }).sort_values(['operator', 'time', 'kind'], kind='stable')
+    events['vehicles'] = events.groupby('operator', sort=False)['change'].cumsum()
+    peaks = events.loc[events.groupby('operator', sort=True)['vehicles'].idxmax(), ['operator', 'vehicles', 'time']]
+    peaks = peaks.rename(columns={'vehicles': 'peak_vehicles', 'time': 'peak_time'})
+    peaks.insert(1, 'blocks', summary.groupby('operator', sort=True).size().to_numpy())
+    return peaks.reset_index(drop=True)
+
+
+def format_times(df, columns):
+    """
+    Turn columns of minutes past midnight into hh:mm:ss strings.
+    """
+    df = df.copy()
+    for column in columns:
+        df[column] = get_time_strings(df[column].to_numpy()).to_numpy()
+    return df
+
+
+def filter_date(df, date):
+    """
+    Keep the journeys operating on a date - boards are often reused by journeys of different periods.
+    :param df: timetable dataframe
+    :param date: date string, e.g. 2019-07-02
+    :return: timetable dataframe
+    """
+    date = pd.Timestamp(date)
+    first = pd.to_datetime(df['first_date_of_operation'], format='mixed', errors='coerce')
+    last = pd.to_datetime(df['last_date_of_operation'], format='mixed', errors='coerce')
+    return df[~(first > date) & ~(last < date)]
+
+
+def get_vehicle_blocks(path, day, date=None):
+    """
+    Build the vehicle blocks of a timetable for a day of operation.
+    :param path: path to flat timetable .csv, stop_times table of a normalized timetable or timetable store
+    :param day: day of week
+    :param date: optional date, to keep only journeys operating on it
+    :return: tuple of (blocks, block summary, peak vehicles) dataframes, times as hh:mm:ss strings
+    """
+    df = load_timetable(path, day=day, columns=BLOCK_COLUMNS)
+    if 'running_board' not in df.columns:
+        raise ValueError("Timetable has no running boards - vehicle blocks need an ATCO-CIF timetable.")
+    if date:
+        df = filter_date(df, date)
+    journeys = get_journeys(df)
+    blocks = build_blocks(journeys)
+    summary = get_block_summary(blocks)
+    peaks = get_peak_vehicles(summary)
+    return format_times(blocks, ['departure', 'arrival']), format_times(summary, ['start', 'end']), \
+        format_times(peaks, ['peak_time'])